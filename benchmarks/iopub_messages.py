@@ -0,0 +1,117 @@
+"""
+Micro-benchmark of the iopub message path.
+
+Pushes stream messages through a ZMQ socket pair and handles them the
+way nbval does while a cell runs, comparing the current path (headers
+peeked first, messages of other requests dropped unpacked) with
+unpacking and wrapping every message as nbval used to.
+
+    python benchmarks/iopub_messages.py [-n 100000] [--foreign 0.5]
+"""
+
+import argparse
+import time
+from pprint import pformat
+
+import zmq
+from jupyter_client.session import Session
+from nbformat import NotebookNode
+
+from nbval.engine import NotebookEngine
+from nbval.kernel import recv_message
+
+
+class BenchKernel(object):
+    """Just enough of a RunningKernel for the engine to register a cell."""
+    def __init__(self, session):
+        self.session = session
+
+    def start_iopub_consumer(self, handler, accept=None):
+        pass
+
+    def stop_iopub_consumer(self):
+        pass
+
+    def execute_cell_input(self, cell_input, allow_stdin=None):
+        return self.session.msg('execute_request')['header']['msg_id']
+
+
+def send_messages(session, socket, parent, other, count, foreign):
+    # Spread the messages of the other request evenly
+    sent_foreign = 0
+    for i in range(count):
+        if sent_foreign < foreign * (i + 1):
+            header, sent_foreign = other, sent_foreign + 1
+        else:
+            header = parent
+        session.send(socket, 'stream', content=dict(name='stdout', text='%d\n' % i),
+                     parent=header)
+    session.send(socket, 'status', content=dict(execution_state='idle'), parent=parent)
+
+
+def eager(session, socket, parent_id, count):
+    outputs = []
+    for _ in range(count + 1):
+        _, msg_list = session.feed_identities(socket.recv_multipart())
+        msg = session.deserialize(msg_list)
+        pformat(msg)
+        out = NotebookNode(output_type=msg['msg_type'])
+        if msg['parent_header'].get('msg_id') != parent_id:
+            continue
+        if msg['msg_type'] == 'stream':
+            out.name = msg['content']['name']
+            out.text = msg['content']['text']
+            outputs.append(out)
+    return outputs
+
+
+def lazy(session, socket, engine, count):
+    for _ in range(count + 1):
+        msg = recv_message(session, socket, engine._accept_iopub)
+        if msg is not None:
+            engine._handle_iopub(msg)
+    return engine.submit('cell').outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-n', type=int, default=100000, help='number of stream messages')
+    parser.add_argument('--foreign', type=float, default=0.5,
+                        help='fraction of messages belonging to another request')
+    args = parser.parse_args()
+
+    context = zmq.Context()
+    sender, receiver = context.socket(zmq.PAIR), context.socket(zmq.PAIR)
+    for socket in (sender, receiver):
+        socket.sndhwm = socket.rcvhwm = 0
+    receiver.bind('inproc://iopub')
+    sender.connect('inproc://iopub')
+    session = Session(key=b'benchmark')
+    other = session.msg_header('execute_request')
+
+    kernel = BenchKernel(session)
+    engine = NotebookEngine(kernel)
+    runs = [
+        ('eager', lambda parent: eager(session, receiver, parent['msg_id'], args.n)),
+        ('lazy', lambda parent: lazy(session, receiver, engine, args.n)),
+    ]
+    for name, run in runs:
+        if name == 'lazy':
+            engine.submit('cell', '')
+            parent = dict(msg_id=engine._results['cell'].msg_id, msg_type='execute_request')
+        else:
+            parent = session.msg_header('execute_request')
+        send_messages(session, sender, parent, other, args.n, args.foreign)
+        start = time.perf_counter()
+        outputs = run(parent)
+        elapsed = time.perf_counter() - start
+        print('%-6s %8.3fs  %9.0f msg/s  (%d outputs)' % (
+            name, elapsed, args.n / elapsed, len(outputs)))
+
+    sender.close()
+    receiver.close()
+    context.term()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Benchmark of stream normalization on progress bar output.
+
+Builds the stream outputs of a cell updating a progress bar many times
+with carriage returns, as tqdm does, and normalizes them the way nbval
+does now (StreamNormalizer, chunk by chunk) and as it used to (joining
+the chunks with += and then applying the carriage returns with a regex).
+
+    python benchmarks/progress_streams.py [-n 10000] [--lines 2]
+"""
+
+import argparse
+import re
+import time
+
+from nbformat import NotebookNode
+
+from nbval.plugin import coalesce_streams
+
+
+carriagereturn_pat = re.compile(r'^.*\r(?=[^\n])', re.MULTILINE)
+
+
+def progress_outputs(updates, lines):
+    outputs = []
+    for line in range(lines):
+        for i in range(updates):
+            bar = '#' * (40 * i // updates)
+            text = '\r%3d%%|%-40s| %d/%d [00:01<00:00, 9999.99it/s]' % (
+                100 * i // updates, bar, i, updates)
+            outputs.append(NotebookNode(output_type='stream', name='stderr', text=text))
+        outputs.append(NotebookNode(output_type='stream', name='stderr', text='\n'))
+    return outputs
+
+
+def regex(outputs):
+    merged = NotebookNode(outputs[0])
+    for output in outputs[1:]:
+        merged.text += output.text
+    merged.text = carriagereturn_pat.sub('', merged.text)
+    return [merged]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-n', type=int, default=10000, help='updates per progress bar')
+    parser.add_argument('--lines', type=int, default=2, help='number of progress bars')
+    args = parser.parse_args()
+
+    outputs = progress_outputs(args.n, args.lines)
+    size = sum(len(output.text) for output in outputs)
+    print('%d outputs, %.1f MB of text' % (len(outputs), size / 1e6))
+    results = {}
+    for name, run in [('regex', regex), ('normalizer', coalesce_streams)]:
+        start = time.perf_counter()
+        results[name] = run(outputs)
+        elapsed = time.perf_counter() - start
+        print('%-10s %8.3fs  %9.0f outputs/s' % (name, elapsed, len(outputs) / elapsed))
+    assert results['regex'][0].text == results['normalizer'][0].text
+
+
+if __name__ == '__main__':
+    main()
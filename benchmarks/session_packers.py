@@ -0,0 +1,91 @@
+"""
+Benchmark of the session packers available to --nbval-session-packer.
+
+Runs a cell that displays large rich outputs (an HTML table, a JSON
+document and a base64 encoded PNG) in a kernel for each packer, and
+reports how long it takes for nbval to receive all outputs. The time to
+pack and unpack one such message in this process is reported as well.
+
+    python benchmarks/session_packers.py [--displays 50] [--repeat 3]
+"""
+
+import argparse
+import time
+
+from jupyter_client.session import Session
+
+from nbval.engine import NotebookEngine
+from nbval.kernel import RunningKernel, CURRENT_ENV_KERNEL_NAME, SESSION_PACKERS
+
+
+CELL = '''
+import base64, os
+from IPython.display import display, HTML, JSON
+rows = ''.join('<tr><td>%d</td><td>%s</td></tr>' % (i, 'x' * 40) for i in range(2000))
+table = HTML('<table>%s</table>' % rows)
+document = JSON({'items': [{'id': i, 'name': 'item %d' % i, 'value': i / 3} for i in range(2000)]})
+png = base64.b64encode(os.urandom(150000)).decode('ascii')
+for _ in range(DISPLAYS):
+    display(table)
+    display(document)
+    display({'image/png': png}, raw=True)
+'''
+
+
+def rich_content():
+    rows = ''.join('<tr><td>%d</td><td>%s</td></tr>' % (i, 'x' * 40) for i in range(2000))
+    items = [{'id': i, 'name': 'item %d' % i, 'value': i / 3} for i in range(2000)]
+    return {
+        'data': {'text/html': '<table>%s</table>' % rows, 'application/json': {'items': items}},
+        'metadata': {},
+        'transient': {},
+    }
+
+
+def time_packing(packer, repeat=20):
+    session = Session(packer=packer)
+    content = rich_content()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        session.unpack(session.pack(content))
+    return (time.perf_counter() - start) / repeat
+
+
+def time_kernel(packer, displays, repeat):
+    kernel = RunningKernel(CURRENT_ENV_KERNEL_NAME, session_packer=packer)
+    engine = NotebookEngine(kernel)
+    try:
+        source = CELL.replace('DISPLAYS', str(displays))
+        best = None
+        for i in range(repeat):
+            start = time.perf_counter()
+            result = engine.result(i, source, timeout=600)
+            elapsed = time.perf_counter() - start
+            assert len(result.outputs) == 3 * displays, result.outputs[-1:]
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+    finally:
+        engine.close()
+        kernel.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--displays', type=int, default=50,
+                        help='number of times each rich output is displayed')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs per packer, the best is reported')
+    args = parser.parse_args()
+
+    for packer, available in SESSION_PACKERS.items():
+        if not available:
+            print('%-8s not installed' % packer)
+            continue
+        packing = time_packing(packer)
+        cell = time_kernel(packer, args.displays, args.repeat)
+        print('%-8s cell %7.3fs   pack+unpack %6.2fms per message' % (
+            packer, cell, packing * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Benchmark of the round trip time of execute requests over each transport.
+
+Starts a kernel for the current environment over tcp and over ipc, and
+times how long it takes for an empty cell to be executed (from sending
+the execute_request until the kernel goes idle) through nbval's engine.
+
+    python benchmarks/transport_latency.py [-n 1000]
+"""
+
+import argparse
+import shutil
+import statistics
+import tempfile
+import time
+
+from nbval.engine import NotebookEngine
+from nbval.kernel import RunningKernel, CURRENT_ENV_KERNEL_NAME
+
+
+def round_trips(transport, count, runtime_dir):
+    kernel = RunningKernel(CURRENT_ENV_KERNEL_NAME, transport=transport, runtime_dir=runtime_dir)
+    engine = NotebookEngine(kernel)
+    try:
+        # Warm up
+        for i in range(20):
+            engine.result(('warmup', i), 'pass')
+        times = []
+        for i in range(count):
+            start = time.perf_counter()
+            engine.result(i, 'pass')
+            times.append(time.perf_counter() - start)
+        return times
+    finally:
+        engine.close()
+        kernel.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-n', type=int, default=1000, help='number of execute requests')
+    args = parser.parse_args()
+
+    runtime_dir = tempfile.mkdtemp(prefix='nbval-')
+    try:
+        for transport in ('tcp', 'ipc'):
+            times = sorted(round_trips(transport, args.n, runtime_dir))
+            print('%s  mean %.3fms  median %.3fms  p95 %.3fms' % (
+                transport,
+                statistics.mean(times) * 1000,
+                statistics.median(times) * 1000,
+                times[int(len(times) * 0.95)] * 1000,
+            ))
+    finally:
+        shutil.rmtree(runtime_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,340 @@
+"""
+Static dataflow analysis of notebook cells, to find the earlier cells a
+cell depends on.
+
+The names each cell binds, mutates and reads are found with :mod:`ast`.
+Cells that can't be analysed, because they don't parse or use IPython
+magics or star imports, are assumed to affect every later cell.
+"""
+
+import ast
+
+try:
+    from IPython.core.inputtransformer2 import TransformerManager
+except ImportError:
+    TransformerManager = None
+
+
+_scopes = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda,
+           ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+
+# Names and modules giving access to files, processes and other state that
+# kernels share
+_shared_state = frozenset(['open', 'os', 'shutil', 'pathlib', 'Path', 'subprocess',
+                           'tempfile', 'glob', 'sqlite3', 'socket'])
+
+
+class CellNames(object):
+    """
+    The names a cell's source binds (``defines``), modifies in place
+    (``mutates``) and reads (``uses``) at the top level of the notebook,
+    and the names its functions read (``lazy_uses``). ``opaque`` is True
+    if the cell couldn't be analysed.
+
+    ``passes`` are the names passed to functions, which may modify them,
+    ``calls`` the names whose attributes are called, ``modules`` the names
+    the cell imports, and ``shared`` those imported from modules giving
+    access to state shared between kernels, such as files. The
+    ``lazy_defines``, ``lazy_mutates`` and ``lazy_calls`` of the functions
+    the cell defines are the names they declare ``global`` or
+    ``nonlocal``, the free names they modify in place, and the free names
+    whose attributes they call.
+    """
+    def __init__(self, source):
+        self.defines = set()
+        self.mutates = set()
+        self.uses = set()
+        # Names read by the functions the cell defines, when they are called
+        self.lazy_uses = set()
+        self.lazy_defines = set()
+        self.lazy_mutates = set()
+        self.lazy_calls = set()
+        self.passes = set()
+        self.calls = set()
+        self.modules = set()
+        self.shared = set()
+        self.opaque = False
+        if TransformerManager is not None:
+            source = TransformerManager().transform_cell(source)
+        try:
+            tree = ast.parse(source)
+        except SyntaxError:
+            self.opaque = True
+            return
+        self._visit(tree, 'top')
+
+    def _visit(self, node, scope):
+        for child in ast.iter_child_nodes(node):
+            self._visit_node(child, scope)
+
+    def _visit_node(self, node, scope):
+        # scope is 'top' for the notebook's namespace, 'eager' for nested
+        # scopes run right away (classes and comprehensions), and 'lazy' for
+        # function bodies, which read names when they are called
+        top = scope == 'top'
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)):
+            if top and not isinstance(node, ast.Lambda):
+                self.defines.add(node.name)
+            if scope != 'lazy':
+                # Nested functions are part of the effects of this one
+                defines, mutates, calls = _function_effects(node)
+                self.lazy_defines |= defines
+                self.lazy_mutates |= mutates
+                self.lazy_calls |= calls
+            for child in ast.iter_child_nodes(node):
+                if child in getattr(node, 'decorator_list', ()):
+                    self._visit_node(child, scope)
+                else:
+                    self._visit_node(child, 'lazy')
+            return
+        if isinstance(node, _scopes):
+            if top and isinstance(node, ast.ClassDef):
+                self.defines.add(node.name)
+            self._visit(node, 'lazy' if scope == 'lazy' else 'eager')
+            return
+        if isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Load):
+                (self.lazy_uses if scope == 'lazy' else self.uses).add(node.id)
+                if node.id == 'get_ipython':
+                    # Magics and shell commands: side effects unknown
+                    self.opaque = True
+            elif top:
+                self.defines.add(node.id)
+            return
+        if top and isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                if alias.name == '*':
+                    self.opaque = True
+                name = (alias.asname or alias.name).split('.')[0]
+                self.defines.add(name)
+                self.modules.add(name)
+                module = getattr(node, 'module', None) or alias.name
+                if module.split('.')[0] in _shared_state:
+                    self.shared.add(name)
+        elif top and isinstance(node, (ast.Global, ast.Nonlocal)):
+            self.defines.update(node.names)
+        elif top and isinstance(node, (ast.Attribute, ast.Subscript)):
+            base = _base_name(node)
+            if base is not None and not isinstance(node.ctx, ast.Load):
+                self.mutates.add(base)
+        elif top and isinstance(node, ast.AugAssign):
+            # x += 1 reads and modifies x, rather than binding it anew
+            base = _base_name(node.target)
+            if base is not None:
+                self.mutates.add(base)
+                self.uses.add(base)
+            if not isinstance(node.target, ast.Name):
+                self._visit_node(node.target, scope)
+            self._visit_node(node.value, scope)
+            return
+        elif (top and isinstance(node, ast.Expr) and isinstance(node.value, ast.Call)
+                and isinstance(node.value.func, ast.Attribute)):
+            # Method calls made for their side effects may modify their
+            # object, e.g. list.append() or np.random.seed()
+            base = _base_name(node.value.func)
+            if base is not None:
+                self.mutates.add(base)
+        elif top and isinstance(node, ast.ExceptHandler) and node.name:
+            self.defines.add(node.name)
+        elif scope != 'lazy' and isinstance(node, ast.Call):
+            # Functions may modify their arguments, e.g. random.shuffle(data)
+            self.passes |= _argument_names(node)
+            if isinstance(node.func, ast.Attribute):
+                self.calls.add(_base_name(node.func))
+                self.calls.discard(None)
+        self._visit(node, scope)
+
+
+def _argument_names(call):
+    names = set()
+    for arg in call.args + [keyword.value for keyword in call.keywords]:
+        if isinstance(arg, ast.Starred):
+            arg = arg.value
+        base = _base_name(arg)
+        if base is not None:
+            names.add(base)
+    return names
+
+
+def _function_effects(node):
+    # The names a function declares global or nonlocal, the free names it
+    # modifies in place, and the free names whose attributes it calls
+    declared = set()
+    local = set()
+    mutates = set()
+    calls = set()
+    for child in ast.walk(node):
+        if isinstance(child, (ast.Global, ast.Nonlocal)):
+            declared.update(child.names)
+        elif isinstance(child, ast.arg):
+            local.add(child.arg)
+        elif isinstance(child, ast.Name) and not isinstance(child.ctx, ast.Load):
+            local.add(child.id)
+        elif isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            if child is not node:
+                local.add(child.name)
+        elif isinstance(child, (ast.Attribute, ast.Subscript)):
+            if not isinstance(child.ctx, ast.Load):
+                mutates.add(_base_name(child))
+        elif isinstance(child, ast.AugAssign):
+            mutates.add(_base_name(child.target))
+        elif isinstance(child, ast.Expr) and isinstance(child.value, ast.Call):
+            if isinstance(child.value.func, ast.Attribute):
+                mutates.add(_base_name(child.value.func))
+        if isinstance(child, ast.Call):
+            mutates |= _argument_names(child)
+            if isinstance(child.func, ast.Attribute):
+                calls.add(_base_name(child.func))
+    local -= declared
+    return declared, mutates - local - {None}, calls - local - {None}
+
+
+def _base_name(node):
+    while isinstance(node, (ast.Attribute, ast.Subscript)):
+        node = node.value
+    if isinstance(node, ast.Name):
+        return node.id
+    return None
+
+
+def _called_functions_uses(names, cells):
+    # Names read by the functions defined in ``cells`` that these cells,
+    # or the functions themselves, call
+    called = set().union(*(names[index].uses for index in cells))
+    lazy = set()
+    changed = True
+    while changed:
+        changed = False
+        for index in cells:
+            cell = names[index]
+            if cell.defines & called and not cell.lazy_uses <= lazy:
+                lazy |= cell.lazy_uses
+                called |= cell.lazy_uses
+                changed = True
+    return lazy
+
+
+def _prerequisites(names, selected):
+    last = max(selected, default=-1)
+    required = set(selected)
+    while True:
+        needed = _called_functions_uses(names, required)
+        found = set(selected)
+        for index in range(last, -1, -1):
+            cell = names[index]
+            if index not in found:
+                if not (cell.opaque or (cell.defines | cell.mutates) & needed):
+                    continue
+                found.add(index)
+            needed = (needed - cell.defines) | cell.uses | cell.mutates
+        if found <= required:
+            return required - set(selected)
+        required |= found
+
+
+def _analyse(sources, opaque=()):
+    # The CellNames of the cells, with the names passed to functions and
+    # the modules whose functions they call counted as modified by them,
+    # as well as the names the functions they call bind and modify, and
+    # imports reading sys
+    names = [CellNames(source) for source in sources]
+    for index in opaque:
+        names[index].opaque = True
+    modules = set().union(*(cell.modules for cell in names))
+    effects = []
+    for index, cell in enumerate(names):
+        called = set(cell.uses)
+        while True:
+            defining = [other for other in names[:index + 1] if other.defines & called]
+            reached = called.union(*(other.lazy_uses for other in defining))
+            if reached == called:
+                break
+            called = reached
+        defines = set().union(*(other.lazy_defines for other in defining))
+        mutates = set().union(*(other.lazy_mutates | (other.lazy_calls & modules)
+                                for other in defining))
+        effects.append((defines, mutates | cell.passes | (cell.calls & modules)))
+    for cell, (defines, mutates) in zip(names, effects):
+        cell.defines |= defines
+        cell.mutates |= mutates
+        if cell.modules:
+            # Imports depend on sys.path and the rest of the import machinery
+            cell.uses.add('sys')
+    return names
+
+
+def prerequisites(sources, selected):
+    """
+    Return the indices of the cells that the ``selected`` cells depend on.
+
+    ``sources`` is the list of the sources of the cells that run, in order,
+    and ``selected`` the indices of the selected ones. A cell is a
+    prerequisite if it binds or modifies a name that a later selected cell
+    or prerequisite reads before it is bound again, or if it is opaque.
+    The names read by the functions they call are taken to be read by the
+    last selected cell, as they are read when the function runs, and the
+    names the functions bind or modify to be bound or modified by the
+    cells calling them. Names passed to a function, and modules whose
+    functions are called (e.g. ``np.random.rand()``), are taken to be
+    modified by the call. The result doesn't include the selected cells
+    themselves.
+    """
+    names = _analyse(sources)
+    return sorted(_prerequisites(names, selected))
+
+
+def independent_chains(sources, opaque=()):
+    """
+    Split cells into a shared prefix and chains of cells that don't depend
+    on each other, to run each chain in its own kernel after the prefix.
+
+    ``opaque`` are the indices of cells to treat as if they couldn't be
+    analysed, e.g. because of hidden side effects: they depend on all
+    earlier cells, and all later cells depend on them. Dependencies are
+    found as by :func:`prerequisites`. Cells that use files or other state
+    shared between kernels, directly or through the functions they call,
+    are kept in one chain, and out of the prefix, which each kernel runs.
+    The prefix is chosen to minimize the number of cells run by the
+    longest chain, prefix included.
+
+    Returns ``(prefix, chains)``: the number of cells in the prefix, and
+    the lists of the indices of the cells of each chain, in order. Returns
+    None if the cells can't be split.
+    """
+    names = _analyse(sources, opaque)
+    depends = [set(range(index)) if cell.opaque else _prerequisites(names, [index])
+               for index, cell in enumerate(names)]
+    # Chain the cells using shared state to each other
+    shared = set(_shared_state)
+    external = []
+    for index, cell in enumerate(names):
+        shared |= cell.shared
+        if (cell.uses | cell.lazy_uses) & shared:
+            if external:
+                depends[index].add(external[-1])
+            external.append(index)
+            if cell.lazy_uses & shared:
+                # Its functions use shared state when they are called
+                shared |= cell.defines
+    best, best_cost = None, len(names)
+    for prefix in range(min(external, default=len(names)) + 1):
+        # Connected components of the cells after the prefix
+        component = {}
+        members = {}
+        for index in range(prefix, len(names)):
+            linked = set(component[dep] for dep in depends[index] if dep >= prefix)
+            target = min(linked) if linked else index
+            members.setdefault(target, [])
+            for other in linked - {target}:
+                for cell in members.pop(other):
+                    component[cell] = target
+                    members[target].append(cell)
+            component[index] = target
+            members[target].append(index)
+        if len(members) < 2:
+            continue
+        cost = prefix + max(len(cells) for cells in members.values())
+        if cost < best_cost:
+            best = (prefix, sorted(sorted(cells) for cells in members.values()))
+            best_cost = cost
+    return best
@@ -0,0 +1,405 @@
+"""
+Execution engine for the cells of a notebook.
+
+The engine sends cells to the kernel, ahead of time if asked to, and
+routes the shell and iopub messages it receives to per-cell results by
+the ``msg_id`` of their parent request. Test items then only have to
+collect their result.
+
+Iopub messages are handled by a background thread as soon as they
+arrive, so the outputs of a long running cell do not pile up unread
+until it finishes.
+
+"""
+
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+
+from nbformat import NotebookNode
+
+from .streams import StreamNormalizer, TruncatedText
+
+
+logger = logging.getLogger('nbval')
+
+
+class CellResult(object):
+    """
+    Everything the kernel sent back for the execution of one cell.
+
+    Stream outputs longer than ``output_budget`` characters are truncated,
+    and compared by the digest of their text passed line by line through
+    ``sanitize`` (see :class:`~nbval.streams.StreamNormalizer`). If
+    ``errors_only``, only the error output is kept, for cells whose outputs
+    are not compared.
+    """
+    def __init__(self, msg_id, started=None, output_budget=None, sanitize=None,
+                 errors_only=False):
+        self.msg_id = msg_id
+        self.output_budget = output_budget
+        self.sanitize = sanitize
+        self.errors_only = errors_only
+        # Time at which the kernel started executing the cell, as far as we know
+        self.started = started
+        # Outputs of the cell, as NotebookNodes
+        self.outputs = []
+        # The 'error' output, if the cell raised an exception
+        self.error = None
+        # Content of the execute_reply
+        self.reply = None
+        # When the execute reply was received, and the kernel went idle
+        self.replied = None
+        self.finished_at = None
+        # Whether the kernel has gone idle after executing the cell
+        self.idle = False
+        # Set once the kernel has gone idle
+        self.finished = threading.Event()
+        # Text of the stream outputs by name, normalized as it arrives and
+        # joined when the cell finishes
+        self._streams = {}
+        # Outputs showing each display ID, for update_display_data
+        self._displays = {}
+        # Whether to clear the outputs when the next one arrives
+        self._clear_pending = False
+        # No reply within the cell timeout, so the kernel was interrupted
+        self.timed_out = False
+        # No output before the kernel went idle, so the kernel was stopped
+        self.output_timed_out = False
+
+    @property
+    def done(self):
+        return self.idle or self.output_timed_out
+
+    def timings(self):
+        """
+        Return the seconds spent executing the cell (until its execute
+        reply) and receiving its last outputs (until the kernel went idle).
+        """
+        timings = dict(execute=None, drain=None)
+        if self.started is not None and self.replied is not None:
+            timings['execute'] = self.replied - self.started
+            if self.finished_at is not None:
+                # The reply and the last outputs come through different channels
+                timings['drain'] = max(0.0, self.finished_at - self.replied)
+        return timings
+
+    def clear_outputs(self):
+        """Remove the outputs received so far, as clear_output does."""
+        self.outputs = []
+        self._streams.clear()
+        self._displays.clear()
+        self._clear_pending = False
+
+    def _join_streams(self):
+        for out, normalizer in self._streams.values():
+            text = normalizer.getvalue()
+            if isinstance(text, TruncatedText):
+                out['truncated'] = {'size': text.size, 'digest': text.digest}
+            out.text = str(text)
+
+
+class NotebookEngine(object):
+    """
+    Executes the cells of one notebook in a kernel.
+
+    ``cells`` is a sequence of ``(key, source)`` pairs in the order the
+    cells will be asked for. Up to ``depth`` cells are sent to the kernel
+    ahead of the cell whose result is being waited for. Cells are always
+    executed with ``stop_on_error=False``, as it is up to nbval to decide
+    what happens after an error.
+
+    Iopub messages are handled by a background thread, started here and
+    stopped by :meth:`close`. ``output_budget`` and ``sanitize`` are
+    passed on to the :class:`CellResult` of each cell. The outputs of the
+    cells whose keys are in ``errors_only`` are dropped unread, except for
+    errors.
+    """
+    def __init__(self, kernel, cells=(), depth=0, output_budget=None, sanitize=None,
+                 errors_only=()):
+        self.kernel = kernel
+        self.depth = depth
+        self.output_budget = output_budget
+        self.sanitize = sanitize
+        self.errors_only = errors_only
+        # Cells not yet sent to the kernel
+        self._pending = deque(cells)
+        self._sources = OrderedDict(cells)
+        # CellResults of cells sent to the kernel, by key and by msg_id
+        self._results = OrderedDict()
+        self._by_msg_id = {}
+        # Guards the results against the iopub consumer thread
+        self._lock = threading.Lock()
+        # When the last iopub message was received
+        self._last_message = None
+        kernel.start_iopub_consumer(self._handle_iopub, accept=self._accept_iopub)
+
+    def close(self):
+        """Stop handling iopub messages, e.g. to use the kernel for something else."""
+        self.kernel.stop_iopub_consumer()
+
+    @property
+    def busy(self):
+        """Whether any cell sent to the kernel has not finished yet."""
+        return any(not r.done for r in self._results.values())
+
+    def submit(self, key, source=None):
+        """Send a cell to the kernel, unless it has already been sent."""
+        if key in self._results:
+            return self._results[key]
+        if source is None:
+            source = self._sources[key]
+        try:
+            self._pending.remove((key, source))
+        except ValueError:
+            pass
+        # The kernel starts on this cell right away, unless it is still
+        # executing an earlier one
+        started = None
+        if not any(r.reply is None and not r.done for r in self._results.values()):
+            started = time.monotonic()
+        # Register the result before the consumer thread can see its messages
+        with self._lock:
+            msg_id = self.kernel.execute_cell_input(source, allow_stdin=False)
+            result = CellResult(msg_id, started=started, output_budget=self.output_budget,
+                                sanitize=self.sanitize, errors_only=key in self.errors_only)
+            self._results[key] = result
+            self._by_msg_id[msg_id] = result
+        return result
+
+    def result(self, key, source=None, timeout=None, output_timeout=5):
+        """
+        Wait for a cell to finish, and return its :class:`CellResult`.
+
+        If no execute reply arrives within ``timeout`` seconds of the kernel
+        starting the cell, the kernel is interrupted. If the kernel then
+        sends nothing for ``output_timeout`` seconds before going idle, it
+        is stopped.
+        """
+        result = self.submit(key, source)
+        while self._pending and len(self._in_flight()) <= self.depth:
+            self.submit(*self._pending[0])
+
+        while result.reply is None and not result.timed_out:
+            if result.started is None:
+                # Still waiting for the cells before this one
+                self._receive(output_timeout)
+                continue
+            remaining = None
+            if timeout is not None:
+                remaining = result.started + timeout - time.monotonic()
+                if remaining <= 0:
+                    # Try to interrupt kernel, as this will give us traceback:
+                    self.kernel.interrupt()
+                    result.timed_out = True
+                    break
+            self._receive(remaining)
+
+        waiting = time.monotonic()
+        while not result.idle:
+            last = max(waiting, self._last_message or waiting)
+            remaining = last + output_timeout - time.monotonic()
+            if remaining <= 0:
+                self.kernel.stop()
+                result._join_streams()
+                result.output_timed_out = True
+                break
+            result.finished.wait(remaining)
+        return result
+
+    def _in_flight(self):
+        return [r for r in self._results.values() if not r.done]
+
+    def _receive(self, timeout):
+        """
+        Handle all shell messages that arrive within ``timeout`` seconds.
+
+        Returns whether any message was received.
+        """
+        streams = self.kernel.wait_for_messages(timeout, streams=('shell',))
+        for stream in streams:
+            msg = self.kernel.get_message(stream, timeout=0)
+            parent = self._by_msg_id.get(msg['parent_header'].get('msg_id'))
+            if parent is not None:
+                with self._lock:
+                    self._handle_reply(parent, msg)
+        return bool(streams)
+
+    def _handle_reply(self, result, msg):
+        if msg['msg_type'] != 'execute_reply':
+            return
+        result.reply = msg['content']
+        result.replied = time.monotonic()
+        # The kernel executes requests in order, so it is now
+        # starting on the next cell
+        for other in self._results.values():
+            if other.started is None:
+                other.started = time.monotonic()
+                break
+
+    def _accept_iopub(self, parent_id, msg_type):
+        """
+        Called by the iopub consumer thread with the headers of each
+        message, to skip unpacking the messages we don't use.
+        """
+        self._last_message = time.monotonic()
+
+        # execute_input: To let all frontends know what code is
+        # being executed at any given time, these messages contain a
+        # re-broadcast of the code portion of an execute_request,
+        # along with the execution_count.
+        # com? execute reply?
+        if msg_type in ('execute_input', 'execute_reply') or msg_type.startswith('comm'):
+            return False
+        with self._lock:
+            result = self._by_msg_id.get(parent_id)
+        if result is None:
+            return False
+        return not result.errors_only or msg_type in ('status', 'error')
+
+    def _handle_iopub(self, msg):
+        """Called by the iopub consumer thread for each accepted message."""
+        with self._lock:
+            result = self._by_msg_id.get(msg['parent_header'].get('msg_id'))
+            if result is not None:
+                handle_output(result, msg)
+
+
+class SplitEngine(object):
+    """
+    Executes the independent chains of cells of a notebook at the same time,
+    each with its own :class:`NotebookEngine` and kernel.
+
+    ``routes`` maps the key of each cell to the engine executing it. Has
+    the same :meth:`result` interface as :class:`NotebookEngine`.
+    """
+    def __init__(self, engines, routes):
+        self.engines = engines
+        self.routes = routes
+
+    @property
+    def busy(self):
+        return any(engine.busy for engine in self.engines)
+
+    def start(self):
+        """Send all cells to their kernels, so that the chains run concurrently."""
+        for engine in self.engines:
+            for key, source in list(engine._pending):
+                engine.submit(key, source)
+
+    def result(self, key, source=None, timeout=None, output_timeout=5):
+        return self.routes[key].result(
+            key, source, timeout=timeout, output_timeout=output_timeout)
+
+    def close(self):
+        for engine in self.engines:
+            engine.close()
+
+
+def handle_output(result, msg):
+    """
+    Add what an iopub ``msg`` of the cell of ``result`` tells us to it.
+    """
+    # now we must handle the message by checking the type and reply
+    # info and we store the output of the cell in a notebook node object
+    msg_type = msg['msg_type']
+    reply = msg['content']
+
+    # When the kernel starts to execute code, it will enter the 'busy'
+    # state and when it finishes, it will enter the 'idle' state.
+    # The kernel will publish state 'starting' exactly
+    # once at process startup.
+    if msg_type == 'status':
+        if reply['execution_state'] == 'idle':
+            result.finished_at = time.monotonic()
+            result._join_streams()
+            result.idle = True
+            result.finished.set()
+        return
+
+    if result.errors_only and msg_type != 'error':
+        return
+
+    # clear_output empties the output area of the cell, as the notebook
+    # UI does. With wait=True, that happens when the next output arrives,
+    # so only the outputs left at the end are kept.
+    if msg_type == 'clear_output':
+        if reply.get('wait'):
+            result._clear_pending = True
+        else:
+            result.clear_outputs()
+        return
+
+    # Outputs may be given a display ID, to update them in place later on.
+    # Only the outputs of the same cell are updated: earlier cells may
+    # already have been compared.
+    display_id = (reply.get('transient') or {}).get('display_id')
+    if display_id is not None and msg_type in ('display_data', 'update_display_data'):
+        for out in result._displays.get(display_id, ()):
+            out['metadata'] = reply['metadata']
+            out['data'] = reply['data']
+    if msg_type == 'update_display_data':
+        return
+
+    if result._clear_pending and msg_type in ('display_data', 'execute_result',
+                                              'stream', 'error'):
+        result.clear_outputs()
+
+    # 'execute_result' is equivalent to a display_data message.
+    # The object being displayed is passed to the display
+    # hook, i.e. the *result* of the execution.
+    # The only difference is that 'execute_result' has an
+    # 'execution_count' number which does not seems useful
+    # (we will filter it in the sanitize function)
+    #
+    # When the reply is display_data or execute_result,
+    # the dictionary contains
+    # a 'data' sub-dictionary with the 'text' AND the 'image/png'
+    # picture (in hexadecimal). There is also a 'metadata' entry
+    # but currently is not of much use, sometimes there is information
+    # as height and width of the image (CHECK the documentation)
+    # Thus we iterate through the keys (mimes) 'data' sub-dictionary
+    # to obtain the 'text' and 'image/png' information
+    if msg_type in ('display_data', 'execute_result'):
+        out = NotebookNode(output_type=msg_type)
+        out['metadata'] = reply['metadata']
+        out['data'] = reply['data']
+        result.outputs.append(out)
+        if display_id is not None:
+            result._displays.setdefault(display_id, []).append(out)
+
+        if msg_type == 'execute_result':
+            out.execution_count = reply['execution_count']
+
+    # if the message is a stream then we store the output, merged
+    # with the earlier output of the same stream as coalesce_streams()
+    # would do, so that chatty cells don't build up many small outputs
+    elif msg_type == 'stream':
+        stream = result._streams.get(reply['name'])
+        if stream is not None:
+            stream[1].feed(reply['text'])
+            return
+        out = NotebookNode(output_type=msg_type)
+        out.name = reply['name']
+        out.text = reply['text']
+        result.outputs.append(out)
+        normalizer = StreamNormalizer(result.output_budget, result.sanitize)
+        normalizer.feed(out.text)
+        result._streams[out.name] = (out, normalizer)
+
+    # if the message type is an error then an error has occurred during
+    # cell execution. It is up to the test item to decide whether
+    # that is a failure.
+    elif msg_type == 'error':
+        out = NotebookNode(output_type=msg_type)
+        out['ename'] = reply['ename']
+        out['evalue'] = reply['evalue']
+        out['traceback'] = reply['traceback']
+        result.outputs.append(out)
+        result.error = out
+
+    # any other message type is not expected
+    # should this raise an error?
+    else:
+        print("unhandled iopub msg:", msg_type)
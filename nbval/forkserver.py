@@ -0,0 +1,274 @@
+"""
+Fork-server kernel provider.
+
+A template process imports ipykernel and a configurable list of modules
+once. Kernels for the parent environment are then forked from it, so each
+kernel starts without paying the interpreter and import costs again.
+"""
+
+import os
+import sys
+import json
+import signal
+import logging
+import threading
+import subprocess
+import time
+import uuid
+
+from jupyter_client.manager import KernelManager
+from jupyter_client.provisioning import LocalProvisioner
+from jupyter_client.utils import run_sync
+
+
+logger = logging.getLogger('nbval')
+
+
+class ForkServer(object):
+    """
+    Handle to a template process that forks new kernels on request.
+
+    The template is started when the server is created, and preloads
+    ``preload`` (a list of module names) before checking that it can be
+    forked safely. If it can't (e.g. a preloaded module started a thread
+    or opened a socket), :attr:`available` is False and :attr:`reason`
+    says why; kernels should then be started normally.
+    """
+    def __init__(self, preload=()):
+        self.preload = list(preload)
+        self._lock = threading.Lock()
+        self._ready = None
+        self.reason = None
+        if not hasattr(os, 'fork'):
+            self._ready = False
+            self.reason = 'os.fork() is not available on this platform'
+            self.process = None
+            return
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'nbval.forkserver'] + self.preload,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        )
+
+    @property
+    def available(self):
+        """Whether the template process is up and can be forked safely."""
+        with self._lock:
+            if self._ready is None:
+                reply = self._read_reply()
+                self._ready = reply.get('ok', False)
+                self.reason = reply.get('reason')
+                if not self._ready:
+                    logger.debug('Fork server unavailable: %s', self.reason)
+        return self._ready
+
+    def fork(self, connection_file, cwd=None, env=None, args=()):
+        """
+        Fork a kernel from the template, returning its PID.
+
+        The kernel listens on the ports given in ``connection_file``, and
+        is configured with the command line arguments ``args``.
+        """
+        if not self.available:
+            raise RuntimeError('Fork server unavailable: %s' % self.reason)
+        request = dict(connection_file=connection_file, cwd=cwd, env=env, args=list(args))
+        with self._lock:
+            self.process.stdin.write(json.dumps(request) + '\n')
+            self.process.stdin.flush()
+            reply = self._read_reply()
+        if 'pid' not in reply:
+            raise RuntimeError('Fork server failed to start kernel: %s' % reply.get('reason'))
+        return reply['pid']
+
+    def stop(self):
+        """Stop the template process. Forked kernels are not affected."""
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.stdin.close()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+
+    def _read_reply(self):
+        line = self.process.stdout.readline()
+        if not line:
+            return dict(reason='fork server exited with code %s' % self.process.wait())
+        return json.loads(line)
+
+
+class ForkedProcess(object):
+    """
+    Minimal stand-in for the :class:`subprocess.Popen` of a forked kernel.
+
+    The kernel is a child of the template process, which reaps it, so
+    liveness can only be checked by signalling the PID.
+    """
+    stdin = stdout = stderr = None
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, 0)
+            except ProcessLookupError:
+                # The exit status is collected by the template process
+                self.returncode = 0
+        return self.returncode
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.poll() is None:
+            if deadline is not None and time.monotonic() > deadline:
+                raise subprocess.TimeoutExpired(str(self.pid), timeout)
+            time.sleep(0.01)
+        return self.returncode
+
+    def send_signal(self, signum):
+        os.kill(self.pid, signum)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class ForkServerProvisioner(LocalProvisioner):
+    """
+    Kernel provisioner that forks kernels from a :class:`ForkServer`
+    instead of launching a new process.
+    """
+    fork_server = None
+
+    async def launch_kernel(self, cmd, **kwargs):
+        km = self.parent
+        env = kwargs.get('env')
+        # Pass on the arguments added after those of the kernel spec
+        args = cmd[len(self.kernel_spec.argv):]
+        pid = self.fork_server.fork(
+            km.connection_file, cwd=kwargs.get('cwd'), env=env, args=args)
+        self.process = ForkedProcess(pid)
+        # Forked kernels start their own session, and so process group
+        self.pid = self.pgid = pid
+        self.cwd = kwargs.get('cwd')
+        return self.connection_info
+
+
+class ForkServerKernelManager(KernelManager):
+    """Kernel manager that starts its kernel with a :class:`ForkServerProvisioner`."""
+    fork_server = None
+
+    async def _async_pre_start_kernel(self, **kw):
+        if self.provisioner is None:
+            self.kernel_id = self.kernel_id or kw.pop('kernel_id', str(uuid.uuid4()))
+            self.provisioner = ForkServerProvisioner(
+                kernel_id=self.kernel_id,
+                kernel_spec=self.kernel_spec,
+                parent=self,
+            )
+            self.provisioner.fork_server = self.fork_server
+        return await super(ForkServerKernelManager, self)._async_pre_start_kernel(**kw)
+
+    pre_start_kernel = run_sync(_async_pre_start_kernel)
+
+
+def fork_safety_problems():
+    """
+    Return a list of reasons why the current process can't be forked safely.
+
+    Threads do not survive a fork, and sockets (including ZMQ contexts)
+    would be shared between the template and its kernels.
+    """
+    problems = []
+    if threading.active_count() > 1:
+        problems.append('%d Python threads are running' % threading.active_count())
+    if os.path.isdir('/proc/self/task'):
+        tasks = len(os.listdir('/proc/self/task'))
+        if tasks > 1:
+            problems.append('%d native threads are running' % tasks)
+    if os.path.isdir('/proc/self/fd'):
+        for fd in os.listdir('/proc/self/fd'):
+            try:
+                target = os.readlink('/proc/self/fd/%s' % fd)
+            except OSError:
+                continue
+            if target.startswith('socket:'):
+                problems.append('file descriptor %s is an open socket' % fd)
+    zmq = sys.modules.get('zmq')
+    if zmq is not None and getattr(zmq.Context, '_instance', None) is not None:
+        problems.append('a ZMQ context has been created')
+    return problems
+
+
+def _reply(**content):
+    sys.stdout.write(json.dumps(content) + '\n')
+    sys.stdout.flush()
+
+
+def _run_kernel(request):
+    """Entry point of a forked kernel process. Never returns."""
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    if request.get('env'):
+        os.environ.clear()
+        os.environ.update(request['env'])
+    if request.get('cwd'):
+        os.chdir(request['cwd'])
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    status = 0
+    try:
+        from ipykernel import kernelapp
+        sys.argv = (['ipykernel_launcher', '-f', request['connection_file']] +
+                    request.get('args', []))
+        kernelapp.launch_new_instance()
+    except BaseException:
+        status = 1
+    finally:
+        os._exit(status)
+
+
+def main(preload):
+    # Mirror ipykernel_launcher: don't import from the working directory
+    if sys.path and sys.path[0] in ('', os.getcwd()):
+        del sys.path[0]
+    try:
+        import importlib
+        import ipykernel.kernelapp  # noqa: F401
+        for name in preload:
+            importlib.import_module(name)
+    except Exception as e:
+        _reply(ok=False, reason='failed to preload modules: %r' % e)
+        return 1
+    problems = fork_safety_problems()
+    if problems:
+        _reply(ok=False, reason='; '.join(problems))
+        return 1
+    # Let the kernels be reaped automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    _reply(ok=True)
+
+    for line in sys.stdin:
+        request = json.loads(line)
+        try:
+            pid = os.fork()
+        except OSError as e:
+            _reply(reason=str(e))
+            continue
+        if pid == 0:
+            _run_kernel(request)
+        _reply(pid=pid)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,115 @@
+"""
+Duration history of notebooks and cells, kept in the pytest cache between sessions.
+"""
+
+from collections import defaultdict
+
+
+def notebook_of(nodeid):
+    """
+    Return the node ID of the notebook of a cell's node ID, or None if
+    ``nodeid`` is not the ID of a notebook cell.
+    """
+    path, sep, _ = nodeid.partition('::')
+    if sep and path.endswith('.ipynb'):
+        return path
+    return None
+
+
+class DurationHistory(object):
+    """
+    Records how long notebooks and cells take, and remembers it for the
+    next sessions.
+
+    Registered as a plugin, it adds up the setup, call and teardown
+    durations of all cells of each notebook run in the session. It also
+    collects the ``nbval_timings`` user property of each cell: the time
+    spent executing the cell, receiving its last outputs after the execute
+    reply, and comparing its outputs. Only notebooks with cells executed in
+    the session, i.e. with that property, are recorded, so skipped
+    notebooks and stored results don't replace their durations. Both are
+    saved to ``cache`` (a pytest
+    ``config.cache``, or None to keep nothing) at the end of the session.
+    Cell timings are kept by notebook and hash of the cell source, so they
+    are forgotten when a cell changes.
+    """
+    cache_key = 'nbval/durations'
+    # Size of a file without history that counts as one more item
+    bytes_per_item = 100 * 1024
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        # Seconds taken by each notebook the last time it ran, by node ID
+        self.notebooks = {}
+        # Timings of each cell the last time it ran, by notebook and cell hash
+        self.cells = {}
+        if cache is not None:
+            stored = cache.get(self.cache_key, {})
+            self.notebooks.update(stored.get('notebooks', {}))
+            self.cells.update(stored.get('cells', {}))
+        # Durations of this session
+        self.session_notebooks = defaultdict(float)
+        self.session_cells = defaultdict(dict)
+        # Notebooks with cells executed in this session
+        self.executed = set()
+
+    def estimate(self, scopes, sizes=None):
+        """
+        Estimate how long each unit of work will take.
+
+        ``scopes`` maps the node ID of each unit (a notebook or anything
+        else) to its number of items. Units without history are assumed
+        to take as long per item as those with history, or one second per
+        item if there are none. If ``sizes`` gives the size of their file
+        in bytes, every :attr:`bytes_per_item` adds one item, as large
+        notebooks tend to load or produce more data.
+        """
+        sizes = sizes or {}
+        known = [scope for scope in scopes if scope in self.notebooks]
+        known_items = sum(scopes[scope] for scope in known)
+        per_item = 1.0
+        if known_items:
+            per_item = sum(self.notebooks[scope] for scope in known) / known_items
+        return {
+            scope: self.notebooks[scope] if scope in self.notebooks else
+            (count + sizes.get(scope, 0) / self.bytes_per_item) * per_item
+            for scope, count in scopes.items()
+        }
+
+    def slowest_notebooks(self, count):
+        """Return the ``(nodeid, seconds)`` of the slowest notebooks of this session."""
+        return sorted(self.executed_notebooks().items(), key=lambda item: -item[1])[:count]
+
+    def executed_notebooks(self):
+        """Return the seconds taken by the notebooks with cells executed in this session."""
+        return {notebook: duration for notebook, duration in self.session_notebooks.items()
+                if notebook in self.executed}
+
+    def slowest_cells(self, count):
+        """Return the timings of the slowest cells of this session, with their node IDs."""
+        cells = [timings for notebook in self.session_cells.values()
+                 for timings in notebook.values()]
+        return sorted(cells, key=lambda timings: -timings['duration'])[:count]
+
+    def pytest_runtest_logreport(self, report):
+        notebook = notebook_of(report.nodeid)
+        if notebook is None:
+            return
+        self.session_notebooks[notebook] += report.duration
+        if report.when != 'call':
+            return
+        for name, timings in report.user_properties:
+            if name == 'nbval_timings':
+                self.executed.add(notebook)
+                timings = dict(timings, nodeid=report.nodeid, duration=report.duration)
+                self.session_cells[notebook][timings.pop('cell')] = timings
+
+    def pytest_sessionfinish(self, session):
+        # With pytest-xdist, the controller sees all reports and saves them
+        if self.cache is None or hasattr(session.config, 'workerinput'):
+            return
+        if not self.executed:
+            return
+        self.notebooks.update(self.executed_notebooks())
+        self.cells.update(self.session_cells)
+        self.cache.set(self.cache_key, {'notebooks': self.notebooks, 'cells': self.cells})
@@ -0,0 +1,97 @@
+"""
+Impact analysis: the local files each notebook depends on, as traced in
+its kernel, to only run the notebooks affected by a change
+(``--nbval-affected-by``).
+"""
+
+import os
+import subprocess
+
+from .history import notebook_of
+
+
+def _git(args, cwd):
+    return subprocess.run(
+        ['git'] + args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        universal_newlines=True)
+
+
+def changed_files(spec, root):
+    """
+    Return the absolute paths of the files changed according to ``spec``.
+
+    ``spec`` is either a git revision, to compare the working tree of the
+    repository containing ``root`` with, or a comma separated list of
+    files, relative to ``root`` unless absolute.
+    """
+    try:
+        resolved = _git(['rev-parse', '--verify', '--quiet', spec + '^{commit}'], root)
+    except OSError:
+        resolved = None
+    if resolved is not None and resolved.returncode == 0:
+        toplevel = _git(['rev-parse', '--show-toplevel'], root).stdout.strip()
+        diff = _git(['diff', '--name-only', '--no-renames', spec], root)
+        if diff.returncode != 0:
+            raise ValueError('git diff %s failed' % spec)
+        untracked = _git(['ls-files', '--others', '--exclude-standard', '--full-name'], root)
+        names = diff.stdout.splitlines() + untracked.stdout.splitlines()
+        return set(os.path.normpath(os.path.join(toplevel, name)) for name in names if name)
+    return set(os.path.normpath(os.path.join(root, name.strip()))
+               for name in spec.split(',') if name.strip())
+
+
+class DependencyMap(object):
+    """
+    Remembers the local files each notebook opened or imported from.
+
+    Registered as a plugin, it reads the ``nbval_dependencies`` user
+    property that notebooks attach to a report of their last cell: the
+    traced files, relative to ``root``. They replace the files recorded
+    for the notebook in ``cache`` (a pytest ``config.cache``, or None to
+    keep nothing) at the end of the session, or are added to them if the
+    notebook failed, as it may not have run all its cells.
+    """
+    cache_key = 'nbval/dependencies'
+
+    def __init__(self, cache=None, root='.'):
+        self.cache = cache
+        self.root = os.path.abspath(root)
+        # Files each notebook depends on, relative to the root, by node ID
+        self.dependencies = {}
+        if cache is not None:
+            self.dependencies.update(cache.get(self.cache_key, {}))
+        self.session = {}
+        self.failed = set()
+
+    def affected(self, nodeid, path, changed):
+        """
+        Return whether the notebook ``nodeid``, at ``path``, may be affected
+        by the ``changed`` files (absolute paths). Notebooks without
+        recorded dependencies always are.
+        """
+        if nodeid not in self.dependencies or os.path.abspath(path) in changed:
+            return True
+        return any(os.path.join(self.root, name) in changed
+                   for name in self.dependencies[nodeid])
+
+    def pytest_runtest_logreport(self, report):
+        notebook = notebook_of(report.nodeid)
+        if notebook is None:
+            return
+        if report.failed:
+            self.failed.add(notebook)
+        for name, value in report.user_properties:
+            if name == 'nbval_dependencies':
+                self.session[notebook] = value
+
+    def pytest_sessionfinish(self, session):
+        # With pytest-xdist, the controller sees all reports and saves them
+        if self.cache is None or hasattr(session.config, 'workerinput'):
+            return
+        if not self.session:
+            return
+        for notebook, files in self.session.items():
+            if notebook in self.failed:
+                files = sorted(set(files) | set(self.dependencies.get(notebook, ())))
+            self.dependencies[notebook] = files
+        self.cache.set(self.cache_key, self.dependencies)
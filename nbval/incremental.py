@@ -0,0 +1,125 @@
+"""
+Fingerprints of the inputs of notebooks, to skip the notebooks that
+passed before and haven't changed since (``--nbval-changed-only``).
+"""
+
+import glob
+import hashlib
+import json
+import os
+from collections import defaultdict
+
+from jupyter_client.kernelspec import NoSuchKernel
+
+from .history import notebook_of
+from .kernel import NbvalKernelspecManager
+
+
+def _hash_file(digest, path):
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+
+
+def expand_globs(patterns, root):
+    """
+    Return the sorted paths of the files matching any of ``patterns``,
+    relative to ``root`` unless absolute. ``**`` matches any number of
+    directories.
+    """
+    paths = set()
+    for pattern in patterns:
+        for path in glob.glob(os.path.join(root, pattern), recursive=True):
+            if os.path.isfile(path):
+                paths.add(os.path.abspath(path))
+    return sorted(paths)
+
+
+def kernel_fingerprint(kernel_name):
+    """Return a JSON-serializable description of a kernel, from its kernelspec."""
+    try:
+        spec = NbvalKernelspecManager().get_kernel_spec(kernel_name)
+    except NoSuchKernel:
+        return {'name': kernel_name}
+    return {'name': kernel_name, 'argv': spec.argv, 'env': spec.env,
+            'language': spec.language}
+
+
+def fingerprint(nb, kernel, files=(), settings=None):
+    """
+    Return a fingerprint of everything a notebook's results depend on.
+
+    That is the source and expected outputs of its code cells, the
+    ``kernel`` description, the contents of ``files`` (sanitize files and
+    declared dependencies), and ``settings``, a JSON-serializable value
+    for the options that affect the results.
+    """
+    digest = hashlib.sha256()
+    header = {'kernel': kernel, 'settings': settings,
+              'cells': [{'source': cell.source, 'metadata': cell.metadata,
+                         'outputs': cell.outputs}
+                        for cell in nb.cells if cell.cell_type == 'code']}
+    digest.update(json.dumps(header, sort_keys=True, default=str).encode('utf8'))
+    for path in files:
+        digest.update(b'\0' + path.encode('utf8') + b'\0')
+        try:
+            _hash_file(digest, path)
+        except OSError:
+            digest.update(b'<missing>')
+    return digest.hexdigest()
+
+
+class ChangeTracker(object):
+    """
+    Remembers the fingerprints of the notebooks that passed, to skip them
+    in the next sessions until they change.
+
+    Registered as a plugin, it reads the ``nbval_fingerprint`` user
+    property of each cell: the fingerprint of its notebook and its number
+    of code cells. Once that many cells of a notebook have passed (or been
+    skipped) and none failed, the fingerprint is saved to ``cache`` (a
+    pytest ``config.cache``, or None to keep nothing) at the end of the
+    session. A notebook that fails is forgotten.
+    """
+    cache_key = 'nbval/fingerprints'
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        # Fingerprint of each notebook when it last passed, by node ID
+        self.passed = {}
+        if cache is not None:
+            self.passed.update(cache.get(self.cache_key, {}))
+        # Notebooks of this session: fingerprint, cells expected and cells done
+        self.session = {}
+        self.done = defaultdict(int)
+        self.failed = set()
+
+    def unchanged(self, nodeid, fingerprint):
+        """Return whether the notebook passed with this fingerprint before."""
+        return self.passed.get(nodeid) == fingerprint
+
+    def pytest_runtest_logreport(self, report):
+        notebook = notebook_of(report.nodeid)
+        if notebook is None:
+            return
+        if report.failed:
+            self.failed.add(notebook)
+        if report.when != 'call':
+            return
+        for name, value in report.user_properties:
+            if name == 'nbval_fingerprint':
+                self.session[notebook] = value
+                self.done[notebook] += 1
+
+    def pytest_sessionfinish(self, session):
+        # With pytest-xdist, the controller sees all reports and saves them
+        if self.cache is None or hasattr(session.config, 'workerinput'):
+            return
+        if not (self.session or self.failed):
+            return
+        for notebook, value in self.session.items():
+            if notebook not in self.failed and self.done[notebook] == value['cells']:
+                self.passed[notebook] = value['fingerprint']
+        for notebook in self.failed:
+            self.passed.pop(notebook, None)
+        self.cache.set(self.cache_key, self.passed)
@@ -6,7 +6,16 @@ Authors: D. Cortes, O. Laslett, T. Kluyver, H. Fangohr, V.T. Fauske
 """
 
 import os
+import ast
+import sys
+import time
+import uuid
 import logging
+import tempfile
+import threading
+from hmac import compare_digest
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pformat
 
 try:
@@ -14,14 +23,173 @@ try:
 except:
     from queue import Empty
 
+import zmq
+
 # Kernel for jupyter notebooks
 from jupyter_client.manager import KernelManager
 from jupyter_client.kernelspec import KernelSpecManager
+from jupyter_client import session as jupyter_session
 import ipykernel.kernelspec
 
+from .forkserver import ForkServerKernelManager
+
 
 CURRENT_ENV_KERNEL_NAME = ':nbval-parent-env'
 
+# Interpreter state recorded by RunningKernel.save_state(), and restored by
+# RunningKernel.reset() when a kernel is reused for another notebook
+_python_save_state = """\
+def __nbval_save_state():
+    import os, sys, site, sysconfig, threading, warnings
+    state = dict(
+        cwd=os.getcwd(),
+        environ=dict(os.environ),
+        path=list(sys.path),
+        modules=set(sys.modules),
+        warnings=list(warnings.filters),
+        rc=None,
+        # State that can't be restored, but is checked after a reset
+        threads=set(t.ident for t in threading.enumerate()),
+        hooks=(list(sys.meta_path), list(sys.path_hooks), sys.gettrace(), sys.getprofile()),
+    )
+    if 'matplotlib' in sys.modules:
+        state['rc'] = sys.modules['matplotlib'].rcParams.copy()
+    # Modules imported from these are kept across a reset, so that heavy
+    # imports are only paid once per kernel:
+    state['installed'] = tuple(sorted(set(
+        [p for k, p in sysconfig.get_paths().items() if 'lib' in k] +
+        site.getsitepackages() + [site.getusersitepackages()])))
+    get_ipython()._nbval_state = state
+__nbval_save_state()
+del __nbval_save_state
+"""
+
+_python_reset = """\
+def __nbval_reset():
+    import os, sys, threading, warnings
+    ip = get_ipython()
+    state = ip._nbval_state
+    ip.reset()
+    os.chdir(state['cwd'])
+    os.environ.clear()
+    os.environ.update(state['environ'])
+    sys.path[:] = state['path']
+    # Resetting first invalidates the warnings already recorded as shown
+    warnings.resetwarnings()
+    warnings.filters[:] = state['warnings']
+    for name in set(sys.modules) - state['modules']:
+        filename = getattr(sys.modules[name], '__file__', None)
+        if filename and not filename.startswith(state['installed']):
+            del sys.modules[name]
+    if 'matplotlib.pyplot' in sys.modules:
+        sys.modules['matplotlib.pyplot'].close('all')
+    if 'matplotlib' in sys.modules:
+        matplotlib = sys.modules['matplotlib']
+        if state['rc'] is None:
+            matplotlib.rcdefaults()
+        else:
+            dict.update(matplotlib.rcParams, state['rc'])
+    # Threads started by the notebook and import or trace hooks it installed
+    # would carry over to the next notebook
+    threads = set(t.ident for t in threading.enumerate() if t.is_alive())
+    hooks = (list(sys.meta_path), list(sys.path_hooks), sys.gettrace(), sys.getprofile())
+    ip._nbval_reset_ok = threads <= state['threads'] and hooks == state['hooks']
+__nbval_reset()
+"""
+
+# Records the files opened by the notebook, for RunningKernel.traced_files().
+# Audit hooks can't be removed, so a reused kernel keeps its hook and only
+# forgets the files of the previous notebook.
+_python_trace = """\
+def __nbval_trace():
+    import os, sys, site, sysconfig
+    ip = get_ipython()
+    if not hasattr(ip, '_nbval_opened'):
+        opened = ip._nbval_opened = set()
+        def hook(event, args):
+            if event == 'open' and isinstance(args[0], str):
+                opened.add(args[0])
+        sys.addaudithook(hook)
+        installed = tuple(sorted(set(
+            [p for k, p in sysconfig.get_paths().items() if 'lib' in k] +
+            site.getsitepackages() + [site.getusersitepackages()])))
+        def traced(root):
+            files = set(opened)
+            for module in list(sys.modules.values()):
+                filename = getattr(module, '__file__', None)
+                if isinstance(filename, str):
+                    files.add(filename)
+            files = set(os.path.abspath(f) for f in files)
+            return sorted(f for f in files
+                          if f.startswith(root) and not f.startswith(installed)
+                          and os.path.isfile(f))
+        ip._nbval_traced = traced
+    ip._nbval_opened.clear()
+__nbval_trace()
+del __nbval_trace
+"""
+
+# Snapshots of the user namespace after each cell, taken by a post_run_cell
+# hook and named by the cumulative hash of the cell sources executed so far
+# (see nbval.snapshots.prefix_hashes). Snapshots start with the name of the
+# serializer module on their own line.
+_python_snapshots = """\
+def __nbval_snapshots(directory, digest, serializer):
+    import hashlib, os, tempfile
+    ip = get_ipython()
+    module = ip._nbval_serializer(serializer)
+    state = {'digest': digest}
+    def post_run_cell(result):
+        source = result.info.raw_cell if result.info is not None else ''
+        state['digest'] = hashlib.sha256(
+            (state['digest'] + source).encode('utf8')).hexdigest()
+        if not result.success:
+            return
+        try:
+            namespace = {k: v for k, v in ip.user_ns.items()
+                         if not k.startswith('_') and k not in ip.user_ns_hidden}
+            data = module.__name__.encode('utf8') + b'\\n' + module.dumps(namespace)
+        except Exception:
+            return
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(directory, state['digest'] + '.snapshot'))
+    ip._nbval_stop_snapshots()
+    ip._nbval_snapshot_hook = post_run_cell
+    ip.events.register('post_run_cell', post_run_cell)
+__nbval_snapshots(%r, %r, %r)
+del __nbval_snapshots
+"""
+
+_python_snapshot_helpers = """\
+def __nbval_snapshot_helpers():
+    import importlib
+    ip = get_ipython()
+    def serializer(name):
+        if name != 'auto':
+            return importlib.import_module(name)
+        for name in ('dill', 'cloudpickle', 'pickle'):
+            try:
+                return importlib.import_module(name)
+            except ImportError:
+                pass
+    def stop():
+        hook = getattr(ip, '_nbval_snapshot_hook', None)
+        if hook is not None:
+            ip.events.unregister('post_run_cell', hook)
+            ip._nbval_snapshot_hook = None
+    def restore(path):
+        with open(path, 'rb') as f:
+            name, _, data = f.read().partition(b'\\n')
+        ip.user_ns.update(serializer(name.decode('utf8')).loads(data))
+    ip._nbval_serializer = serializer
+    ip._nbval_stop_snapshots = stop
+    ip._nbval_restore = restore
+__nbval_snapshot_helpers()
+del __nbval_snapshot_helpers
+"""
+
 logger = logging.getLogger('nbval')
 # Uncomment to debug kernel communication:
 # logger.setLevel('DEBUG')
@@ -45,16 +213,97 @@ class NbvalKernelspecManager(KernelSpecManager):
             return super(NbvalKernelspecManager, self).get_kernel_spec(kernel_name)
 
 
-def start_new_kernel(startup_timeout=60, kernel_name='python', **kwargs):
-    """Start a new kernel, and return its Manager and Client"""
+# Session packers that can be chosen with --nbval-session-packer, and
+# whether they are available to nbval
+SESSION_PACKERS = OrderedDict([
+    ('json', True),
+    ('orjson', jupyter_session.has_orjson),
+    ('msgpack', getattr(jupyter_session, 'has_msgpack', False)),
+])
+
+
+def session_packer(packer, kernel_spec):
+    """
+    Work out how to use the session ``packer`` with a kernel.
+
+    Returns a ``(client_packer, kernel_packer)`` pair, either of which is
+    None where the default should be used. The packer can only be passed
+    on to ipykernel kernels that run in this interpreter; msgpack is not
+    compatible with JSON on the wire, so it is only used for those.
+    """
+    if packer is None or not SESSION_PACKERS.get(packer):
+        if packer is not None:
+            logger.debug('Session packer %s is not available, using the default', packer)
+        return None, None
+    argv = kernel_spec.argv if kernel_spec is not None else []
+    if argv and argv[0] == sys.executable and any('ipykernel' in arg for arg in argv):
+        return packer, packer
+    if packer == 'msgpack':
+        logger.debug('Kernel may not support session packer %s, using the default', packer)
+        return None, None
+    return packer, None
+
+
+def create_kernel_manager(kernel_name, manager_class=KernelManager, packer=None,
+                          transport='tcp', runtime_dir=None):
+    """
+    Create a kernel manager of ``manager_class`` for ``kernel_name``.
+
+    Returns the manager, and the extra arguments to start the kernel with.
+    See :func:`start_new_kernel` for the other arguments.
+    """
+    km_kwargs = dict(kernel_name=kernel_name, kernel_spec_manager=NbvalKernelspecManager())
+    if transport == 'ipc':
+        name = os.path.join(runtime_dir or tempfile.gettempdir(), 'nbval-%s' % uuid.uuid4().hex[:8])
+        km_kwargs.update(transport='ipc', ip=name, connection_file=name + '.json')
+    km = manager_class(**km_kwargs)
+    extra_arguments = []
+    client_packer, kernel_packer = session_packer(packer, km.kernel_spec)
+    if client_packer is not None:
+        # Clients created by the manager share its session
+        km.session.packer = client_packer
+    if kernel_packer is not None:
+        extra_arguments.append('--Session.packer=%s' % kernel_packer)
+    return km, extra_arguments
+
+
+def start_new_kernel(startup_timeout=60, kernel_name='python', fork_server=None,
+                     timings=None, packer=None, transport='tcp', runtime_dir=None,
+                     **kwargs):
+    """Start a new kernel, and return its Manager and Client
+
+    Kernels for the parent environment are forked from ``fork_server``
+    when one is given and available. If ``timings`` is a dict, the time
+    in seconds from the start until each startup milestone is recorded
+    in it: ``spawn``, ``connect``, ``shell_ready`` and ``iopub_ready``.
+    Messages are serialized with ``packer`` where the kernel supports it,
+    see :func:`session_packer`.
+
+    With the ``ipc`` ``transport``, the kernel's sockets and connection
+    file are created in ``runtime_dir`` (by default, the system's
+    temporary directory). They are removed when the kernel is shut down.
+    """
     logger.debug('Starting new kernel: "%s"' % kernel_name)
-    km = KernelManager(kernel_name=kernel_name,
-                       kernel_spec_manager=NbvalKernelspecManager())
+    if timings is None:
+        timings = OrderedDict()
+    start = time.monotonic()
+    if (fork_server is not None and kernel_name == CURRENT_ENV_KERNEL_NAME
+            and fork_server.available):
+        km, extra_arguments = create_kernel_manager(
+            kernel_name, ForkServerKernelManager, packer, transport, runtime_dir)
+        km.fork_server = fork_server
+    else:
+        km, extra_arguments = create_kernel_manager(
+            kernel_name, KernelManager, packer, transport, runtime_dir)
+    if extra_arguments:
+        kwargs['extra_arguments'] = list(kwargs.get('extra_arguments', ())) + extra_arguments
     km.start_kernel(**kwargs)
+    timings['spawn'] = time.monotonic() - start
     kc = km.client()
     kc.start_channels()
+    timings['connect'] = time.monotonic() - start
     try:
-        kc.wait_for_ready(timeout=startup_timeout)
+        wait_for_kernel(km, kc, startup_timeout, timings, start)
     except RuntimeError:
         logger.exception('Failure starting kernel "%s"', kernel_name)
         kc.stop_channels()
@@ -64,6 +313,96 @@ def start_new_kernel(startup_timeout=60, kernel_name='python', **kwargs):
     return km, kc
 
 
+def wait_for_kernel(km, kc, timeout, timings, start):
+    """
+    Wait until the kernel answers on the shell channel, and its IOPub
+    messages reach us.
+
+    A ``kernel_info`` request is sent once we are subscribed to IOPub. The
+    reply marks the shell as ready, and the first status message for the
+    request proves that IOPub is up. Both channels are waited on together,
+    and a new request is only sent if the kernel has replied but none of the
+    status messages arrived, which happens when they were published before
+    our IOPub subscription took effect.
+    """
+    deadline = start + timeout
+    shell_socket = kc.shell_channel.socket
+    iopub_socket = kc.iopub_channel.socket
+    poller = zmq.Poller()
+    poller.register(shell_socket, zmq.POLLIN)
+    poller.register(iopub_socket, zmq.POLLIN)
+
+    requests = set([kc.kernel_info()])
+    retry_delay = 0.05
+    while 'shell_ready' not in timings or 'iopub_ready' not in timings:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise RuntimeError("Kernel didn't respond in %d seconds" % timeout)
+        shell_ready = 'shell_ready' in timings
+        wait = retry_delay if shell_ready else 1
+        events = dict(poller.poll(int(min(wait, remaining) * 1000)))
+        if not events:
+            if not km.is_alive():
+                raise RuntimeError("Kernel died before replying to kernel_info")
+            if shell_ready:
+                # IOPub missed the status messages of earlier requests
+                requests.add(kc.kernel_info())
+                retry_delay = min(retry_delay * 2, 1)
+            continue
+        if shell_socket in events:
+            msg = kc.shell_channel.get_msg(timeout=0)
+            if (msg['msg_type'] == 'kernel_info_reply' and
+                    msg['parent_header'].get('msg_id') in requests):
+                if 'shell_ready' not in timings:
+                    timings['shell_ready'] = time.monotonic() - start
+                    handle_reply = getattr(kc, '_handle_kernel_info_reply', None)
+                    if handle_reply is not None:
+                        handle_reply(msg)
+        if iopub_socket in events:
+            msg = kc.iopub_channel.get_msg(timeout=0)
+            if (msg['msg_type'] == 'status' and
+                    msg['parent_header'].get('msg_id') in requests):
+                timings.setdefault('iopub_ready', time.monotonic() - start)
+
+    logger.debug('Kernel started: %s', ', '.join(
+        '%s after %.3fs' % item for item in timings.items()))
+
+
+def recv_message(session, socket, accept=None):
+    """
+    Receive a message waiting on ``socket`` with ``session``.
+
+    If ``accept`` is given, it is first called as ``accept(parent_msg_id,
+    msg_type)`` with only the headers unpacked. If it returns False, the
+    rest of the message is not unpacked (nor its signature checked) and
+    None is returned.
+
+    Unlike :meth:`Session.deserialize`, the dates in the headers are
+    left as strings, as parsing them is most of the cost of small
+    messages and nbval does not use them.
+    """
+    _, msg_list = session.feed_identities(socket.recv_multipart())
+    if len(msg_list) < 5:
+        raise TypeError('malformed message, must have at least 5 elements')
+    parent_header = session.unpack(msg_list[2])
+    header = session.unpack(msg_list[1])
+    if accept is not None and not accept(parent_header.get('msg_id'), header['msg_type']):
+        return None
+    if session.auth is not None:
+        signature = msg_list[0]
+        if not compare_digest(signature, session.sign(msg_list[1:5])):
+            raise ValueError('Invalid Signature: %r' % signature)
+    return dict(
+        header=header,
+        msg_id=header['msg_id'],
+        msg_type=header['msg_type'],
+        parent_header=parent_header,
+        metadata=session.unpack(msg_list[3]),
+        content=session.unpack(msg_list[4]),
+        buffers=[memoryview(b) for b in msg_list[5:]],
+    )
+
+
 class RunningKernel(object):
     """
     Running a Kernel a Jupyter, info can be found at:
@@ -75,43 +414,31 @@ class RunningKernel(object):
     this class.
 
     """
-    def __init__(self, kernel_name, cwd=None, startup_timeout=60):
+    reusable = False
+
+    def __init__(self, kernel_name, cwd=None, startup_timeout=60, fork_server=None,
+                 session_packer=None, transport='tcp', runtime_dir=None):
         """
         Initialise a new kernel
         specify that matplotlib is inline and connect the stderr.
         Stores the active kernel process and its manager.
         """
 
+        # Seconds from the start until each startup milestone, see start_new_kernel()
+        self.startup_timings = OrderedDict()
         self.km, self.kc = start_new_kernel(
             startup_timeout=startup_timeout,
             kernel_name=kernel_name,
+            fork_server=fork_server,
+            timings=self.startup_timings,
+            packer=session_packer,
+            transport=transport,
+            runtime_dir=runtime_dir,
             stderr=open(os.devnull, 'w'),
             cwd=cwd,
         )
-
-        self._ensure_iopub_up()
-
-    def _ensure_iopub_up(self):
-        total_timeout = 30
-        individual_timeout = 1
-        shell_timeout = 10
-        for _ in range(total_timeout // individual_timeout):
-            msg_id = self.kc.kernel_info()
-
-            try:
-                self.await_reply(msg_id, timeout=shell_timeout)
-            except Empty:
-                raise RuntimeError('Kernel info reqest timed out after %d seconds!' % shell_timeout)
-
-            try:
-                self.await_idle(msg_id, individual_timeout)
-            except Empty:
-                continue
-            else:
-                # got IOPub
-                break
-        else:
-            raise RuntimeError("Wasn't able to establish IOPub after %d seconds." % total_timeout)
+        # Background thread handling iopub messages, see start_iopub_consumer()
+        self._iopub_consumer = None
 
     def get_message(self, stream, timeout=None):
         """
@@ -129,9 +456,70 @@ class RunningKernel(object):
         except Empty:
             logger.debug('Kernel: Timeout waiting for message on %s', stream)
             raise
-        logger.debug("Kernel message (%s):\n%s", stream, pformat(msg))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Kernel message (%s):\n%s", stream, pformat(msg))
         return msg
 
+    def wait_for_messages(self, timeout=None, streams=('shell', 'iopub')):
+        """
+        Wait until messages are available on the given streams.
+
+        Returns the names of the streams with messages, empty if the
+        timeout was reached first.
+        """
+        poller = zmq.Poller()
+        channels = {'shell': self.kc.shell_channel, 'iopub': self.kc.iopub_channel}
+        sockets = {channels[stream].socket: stream for stream in streams}
+        for socket in sockets:
+            poller.register(socket, zmq.POLLIN)
+        timeout_ms = None if timeout is None else int(timeout * 1000)
+        return [sockets[socket] for socket, _ in poller.poll(timeout_ms)]
+
+    def start_iopub_consumer(self, handler, accept=None):
+        """
+        Pass each iopub message to ``handler`` as soon as it arrives, from
+        a background thread, until :meth:`stop_iopub_consumer` is called.
+        Messages can be dropped before they are fully unpacked with
+        ``accept``, see :func:`recv_message`.
+
+        While the consumer runs, nothing else may read from the iopub
+        channel.
+        """
+        self.stop_iopub_consumer()
+        stopping = threading.Event()
+        thread = threading.Thread(
+            target=self._consume_iopub, args=(handler, accept, stopping),
+            name='nbval-iopub', daemon=True)
+        self._iopub_consumer = (thread, stopping)
+        thread.start()
+
+    def stop_iopub_consumer(self):
+        """Stop the background iopub consumer, if any, and wait for it."""
+        if self._iopub_consumer is None:
+            return
+        thread, stopping = self._iopub_consumer
+        self._iopub_consumer = None
+        stopping.set()
+        thread.join()
+
+    def _consume_iopub(self, handler, accept, stopping):
+        session = self.kc.session
+        socket = self.kc.iopub_channel.socket
+        debug = logger.isEnabledFor(logging.DEBUG)
+        while not stopping.is_set():
+            # Wake up regularly to check whether we should stop
+            if not socket.poll(10):
+                continue
+            try:
+                msg = recv_message(session, socket, accept)
+                if msg is None:
+                    continue
+                if debug:
+                    logger.debug("Kernel message (iopub):\n%s", pformat(msg))
+                handler(msg)
+            except Exception:
+                logger.error('Failed to handle iopub message', exc_info=True)
+
     def execute_cell_input(self, cell_input, allow_stdin=None):
         """
         Executes a string of python code in cell input.
@@ -167,7 +555,7 @@ class RunningKernel(object):
                 if msg['content']['status'] == 'aborted':
                     # This should not occur!
                     raise RuntimeError('Kernel aborted execution request')
-                return
+                return msg
 
     def await_idle(self, parent_id, timeout):
         """Poll the iopub stream until an idle message is received for the given parent ID"""
@@ -181,6 +569,147 @@ class RunningKernel(object):
                 if msg['content']['execution_state'] == 'idle':
                     break
 
+    def run_silently(self, code, user_expressions=None, timeout=60):
+        """
+        Execute code that is not part of the notebook, and wait for it to finish.
+
+        Returns the content of the execute reply.
+        """
+        msg_id = self.kc.execute(
+            code,
+            silent=True,
+            store_history=False,
+            user_expressions=user_expressions,
+            stop_on_error=False,
+        )
+        reply = self.await_reply(msg_id, timeout=timeout)
+        self.await_idle(msg_id, timeout)
+        return reply['content']
+
+    def save_state(self):
+        """
+        Record the interpreter state that :meth:`reset` returns to.
+
+        Only Python kernels are supported. Returns whether the state
+        was recorded.
+        """
+        language = self.language
+        if not language or not language.startswith('python'):
+            return False
+        try:
+            reply = self.run_silently(_python_save_state)
+        except Empty:
+            return False
+        return reply['status'] == 'ok'
+
+    def reset(self):
+        """
+        Reset the kernel to the state recorded by :meth:`save_state`, so that
+        it can be reused for another notebook.
+
+        The user namespace is cleared and the working directory, environment
+        variables, ``sys.path``, warning filters, modules imported from
+        outside the installed packages and matplotlib state are restored.
+        Returns whether the reset was complete: False if the notebook left
+        threads running or import or trace hooks installed, which can't be
+        undone. Changes made to installed modules, such as attributes set
+        on them or ``np.set_printoptions()``, are not detected.
+        """
+        try:
+            reply = self.run_silently(
+                _python_reset,
+                user_expressions={'ok': 'get_ipython()._nbval_reset_ok'},
+            )
+        except Empty:
+            return False
+        if reply['status'] != 'ok':
+            logger.debug('Kernel reset failed: %s', reply.get('evalue'))
+            return False
+        result = reply['user_expressions']['ok']
+        return result['status'] == 'ok' and result['data']['text/plain'] == 'True'
+
+    def start_tracing(self):
+        """
+        Start recording the files that the kernel opens.
+
+        Only Python kernels are supported. Returns whether tracing started.
+        """
+        language = self.language
+        if not language or not language.startswith('python'):
+            return False
+        try:
+            reply = self.run_silently(_python_trace)
+        except Empty:
+            return False
+        return reply['status'] == 'ok'
+
+    def traced_files(self, root):
+        """
+        Return the files under ``root`` opened or imported from since
+        :meth:`start_tracing`, leaving out installed packages, or None if
+        they could not be retrieved.
+
+        Modules imported before tracing started, e.g. by the fork server
+        template, are included.
+        """
+        root = os.path.join(os.path.abspath(root), '')
+        try:
+            reply = self.run_silently(
+                'pass', user_expressions={'files': 'get_ipython()._nbval_traced(%r)' % root})
+        except Empty:
+            return None
+        result = reply.get('user_expressions', {}).get('files', {})
+        if result.get('status') != 'ok':
+            return None
+        return ast.literal_eval(result['data']['text/plain'])
+
+    def start_snapshots(self, directory, digest, serializer='auto'):
+        """
+        Save the user namespace into ``directory`` after each cell that
+        runs successfully, with ``serializer`` (the name of a module with
+        ``dumps`` and ``loads`` functions, or 'auto' for the first of dill,
+        cloudpickle and pickle that is installed).
+
+        Snapshots are named after the cumulative hash of the cells executed
+        so far, starting from ``digest``. Namespaces that can't be
+        serialized are skipped. Only Python kernels are supported. Returns
+        whether snapshots were started.
+        """
+        language = self.language
+        if not language or not language.startswith('python'):
+            return False
+        try:
+            reply = self.run_silently(_python_snapshot_helpers)
+            if reply['status'] == 'ok':
+                reply = self.run_silently(_python_snapshots % (directory, digest, serializer))
+        except Empty:
+            return False
+        if reply['status'] != 'ok':
+            logger.debug('Could not start snapshots: %s', reply.get('evalue'))
+        return reply['status'] == 'ok'
+
+    def restore_snapshot(self, path):
+        """
+        Load a snapshot saved after :meth:`start_snapshots` into the user
+        namespace. Returns whether it was restored.
+        """
+        try:
+            reply = self.run_silently(_python_snapshot_helpers)
+            if reply['status'] == 'ok':
+                reply = self.run_silently('get_ipython()._nbval_restore(%r)' % path)
+        except Empty:
+            return False
+        if reply['status'] != 'ok':
+            logger.debug('Could not restore snapshot %s: %s', path, reply.get('evalue'))
+        return reply['status'] == 'ok'
+
+    def stop_snapshots(self):
+        """Stop taking the snapshots started by :meth:`start_snapshots`."""
+        try:
+            self.run_silently('get_ipython()._nbval_stop_snapshots()')
+        except Empty:
+            pass
+
     def is_alive(self):
         if hasattr(self, 'km'):
             return self.km.is_alive()
@@ -209,6 +738,7 @@ class RunningKernel(object):
         and the kernel manager to then shutdown the process.
         """
         logger.debug('Stopping kernel')
+        self.stop_iopub_consumer()
         self.kc.stop_channels()
         self.km.shutdown_kernel(now=True)
         del self.km
@@ -218,3 +748,149 @@ class RunningKernel(object):
         if self.km.kernel_spec is None:
             return None
         return self.km.kernel_spec.language
+
+
+class KernelPool(object):
+    """
+    Session-wide pool of kernels that are started ahead of time.
+
+    Kernels are keyed by ``(kernel_name, cwd)``. While one notebook is
+    executing, :meth:`prefetch` starts kernels for the notebooks that
+    will run next on background threads, so that :meth:`acquire` can
+    usually hand out a kernel that is already up (a *hit*) instead of
+    starting one on the critical path (a *miss*).
+
+    With ``reuse`` enabled, kernels handed back with :meth:`release` are
+    reset and kept for the next notebook with the same key.
+    """
+    def __init__(self, factory, size=1, max_idle=None, reuse=False):
+        """
+        ``factory(kernel_name, cwd=cwd)`` must return a new
+        :class:`RunningKernel`. ``size`` is the number of kernels to start
+        ahead of time, and ``max_idle`` caps how many kernels may sit in
+        the pool unused (defaults to ``size``, plus one when reusing kernels).
+        """
+        self.factory = factory
+        self.size = size
+        if max_idle is None:
+            max_idle = size + 1 if reuse else size
+        self.max_idle = max_idle
+        self.reuse = reuse
+        self.hits = 0
+        self.misses = 0
+        self.reused = 0
+        self._lock = threading.Lock()
+        # Futures of idle kernels (running or still starting), oldest
+        # first, mapped to whether they are reused kernels
+        self._idle = OrderedDict()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(size, 1), thread_name_prefix='nbval-kernel-pool')
+
+    def acquire(self, key, fresh=False):
+        """
+        Get a ready kernel for ``key``, starting one if none is pooled.
+        With ``fresh``, kernels used by another notebook are not taken.
+        """
+        with self._lock:
+            future = self._pop_idle(key, fresh)
+        if future is not None:
+            try:
+                kernel = future.result()
+            except Exception:
+                logger.debug('Pooled kernel for %r failed to start', key, exc_info=True)
+            else:
+                if kernel.is_alive():
+                    self.hits += 1
+                    return kernel
+                kernel.stop()
+        self.misses += 1
+        return self._start(key)
+
+    def release(self, key, kernel):
+        """
+        Hand a kernel back once its notebook is done with it.
+
+        The kernel is reset in the background, and replaced by a fresh
+        kernel if the reset was incomplete. Without ``reuse``, or when
+        the pool is full, the kernel is stopped.
+        """
+        with self._lock:
+            if (not (self.reuse and kernel.reusable and kernel.is_alive()) or
+                    (len(self._idle) >= self.max_idle and not self._evict([key]))):
+                kernel.stop()
+                return
+            future = self._executor.submit(self._recycle, key, kernel)
+            self._idle[(key, future)] = True
+
+    def prefetch(self, keys):
+        """
+        Start kernels in the background for the upcoming ``keys``, in
+        order, without exceeding :attr:`max_idle` idle kernels.
+        """
+        with self._lock:
+            available = Counter(key for (key, _) in self._idle)
+            for key in keys:
+                if available[key] > 0:
+                    available[key] -= 1
+                    continue
+                if len(self._idle) >= self.max_idle and not self._evict(keys):
+                    break
+                future = self._executor.submit(self._start, key)
+                self._idle[(key, future)] = False
+
+    def shutdown(self):
+        """Stop all idle kernels, including those still starting."""
+        with self._lock:
+            futures = [future for (_, future) in self._idle]
+            self._idle.clear()
+        for future in futures:
+            _discard_kernel(future)
+        self._executor.shutdown(wait=True)
+
+    def _start(self, key):
+        kernel_name, cwd = key
+        kernel = self.factory(kernel_name, cwd=cwd)
+        if self.reuse:
+            kernel.reusable = kernel.save_state()
+        return kernel
+
+    def _recycle(self, key, kernel):
+        if kernel.reset():
+            self.reused += 1
+            return kernel
+        logger.debug('Incomplete reset of kernel for %r, restarting it', key)
+        kernel.stop()
+        return self._start(key)
+
+    def _pop_idle(self, key, fresh=False):
+        # Prefer reused kernels, as their imports are already paid for
+        candidates = [entry for entry in self._idle
+                      if entry[0] == key and not (fresh and self._idle[entry])]
+        candidates.sort(key=lambda entry: not self._idle[entry])
+        if not candidates:
+            return None
+        del self._idle[candidates[0]]
+        return candidates[0][1]
+
+    def _evict(self, wanted):
+        """Stop the oldest idle kernel that is not wanted soon, if any."""
+        for idle_key, future in self._idle:
+            if idle_key not in wanted:
+                del self._idle[(idle_key, future)]
+                _discard_kernel(future)
+                return True
+        return False
+
+
+def _discard_kernel(future):
+    """Stop the kernel of ``future`` once it has started."""
+    if future.cancel():
+        return
+
+    def stop(future):
+        try:
+            kernel = future.result()
+        except Exception:
+            return
+        kernel.stop()
+    future.add_done_callback(stop)
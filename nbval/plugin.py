@@ -12,19 +12,33 @@ import pytest
 import sys
 import os
 import re
+import time
+import shutil
 import hashlib
+import tempfile
 import warnings
 from collections import OrderedDict, defaultdict
 from pathlib import Path
 
-from queue import Empty
 
 # for reading notebook files
 import nbformat
 from nbformat import NotebookNode
 
 # Kernel for running notebooks
-from .kernel import RunningKernel, CURRENT_ENV_KERNEL_NAME
+from .kernel import RunningKernel, KernelPool, CURRENT_ENV_KERNEL_NAME, SESSION_PACKERS
+from .forkserver import ForkServer
+from .engine import NotebookEngine, SplitEngine
+from .streams import StreamNormalizer, TruncatedText
+from .sanitize import Sanitizer
+from .runner import AsyncRunner
+from .history import DurationHistory
+from .sharding import parse_shard, assign_shards
+from .incremental import ChangeTracker, expand_globs, fingerprint, kernel_fingerprint
+from .impact import DependencyMap, changed_files
+from .store import open_store, parse_size, environment_lock, result_key, make_entry, StoredRun
+from .snapshots import SnapshotDirectory, ResumedEngine, prefix_hashes, snapshot_seed
+from .dataflow import prerequisites, independent_chains
 from .cover import setup_coverage, teardown_coverage
 
 
@@ -46,6 +60,30 @@ class nocolors:
     ENDC = ''
 
 
+# Session-wide KernelPool, when --nbval-kernel-pool or --nbval-reuse-kernel is used
+kernel_pool_key = pytest.StashKey()
+# IPyNbFile collectors, in the order they will run
+notebook_order_key = pytest.StashKey()
+# ForkServer, when --nbval-fork-server is used
+fork_server_key = pytest.StashKey()
+# RunningKernel.startup_timings of all kernels started in this session
+startup_timings_key = pytest.StashKey()
+# Directory for the sockets and connection files of ipc kernels
+runtime_dir_key = pytest.StashKey()
+# AsyncRunner, when --nbval-concurrency is used
+runner_key = pytest.StashKey()
+# DurationHistory of the notebooks
+history_key = pytest.StashKey()
+shard_key = pytest.StashKey()
+changes_key = pytest.StashKey()
+dependencies_key = pytest.StashKey()
+changed_files_key = pytest.StashKey()
+store_key = pytest.StashKey()
+environment_lock_key = pytest.StashKey()
+snapshots_key = pytest.StashKey()
+# Sanitizer of each set of sanitize patterns, compiled once per session
+sanitizers_key = pytest.StashKey()
+
 
 class NbCellError(Exception):
     """ custom exception for error reporting. """
@@ -97,10 +135,163 @@ def pytest_addoption(parser):
                     type=float,
                     help='Timeout for cell execution, in seconds.')
 
+    group.addoption('--nbval-pipeline-depth', action='store', default=0,
+                    type=int,
+                    help='Number of cells to send to the kernel ahead of the '
+                         'cell being checked, so that the kernel does not '
+                         'wait for nbval between cells.')
+
+    group.addoption('--nbval-concurrency', action='store', default=0,
+                    type=int,
+                    help='Number of notebooks to execute at the same time from '
+                         'this process, ahead of reporting their cells. '
+                         'Kernels are then started by an asynchronous runner, '
+                         'without the kernel pool or fork server.')
+
     group.addoption('--nbval-kernel-startup-timeout', action='store', default=60,
                     type=float,
                     help='Timeout for kernel startup, in seconds.')
 
+    group.addoption('--nbval-kernel-pool', action='store', default=0,
+                    type=int,
+                    help='Number of kernels to start in the background, '
+                         'ahead of the notebooks that will use them.')
+
+    group.addoption('--nbval-kernel-pool-max-idle', action='store', default=None,
+                    type=int,
+                    help='Maximum number of unused kernels kept in the kernel '
+                         'pool. Defaults to the value of --nbval-kernel-pool.')
+
+    group.addoption('--nbval-reuse-kernel', action='store_true',
+                    help='Reuse kernels between notebooks with the same kernel '
+                         'and directory, resetting the kernel state in between. '
+                         'Notebooks can opt out by setting '
+                         '"nbval": {"reuse_kernel": false} in their metadata.')
+
+    group.addoption('--nbval-fork-server', action='store_true',
+                    help='Fork kernels for the current environment from a '
+                         'template process, instead of starting a new '
+                         'interpreter for each. Only applies with '
+                         '--nbval-current-env. See also: --nbval-preload')
+
+    group.addoption('--nbval-preload', action='append', default=[],
+                    help='Module to import in the fork server template, so '
+                         'that it is imported once per session. Can be given '
+                         'multiple times, or as a comma separated list.')
+
+    group.addoption('--nbval-session-packer', action='store', default=None,
+                    choices=list(SESSION_PACKERS),
+                    help='Serializer for the messages exchanged with kernels. '
+                         'Kernels that may not support it, and packers that '
+                         'are not installed, fall back to the default.')
+
+    group.addoption('--nbval-transport', action='store', default='tcp',
+                    choices=['tcp', 'ipc'],
+                    help='ZMQ transport between nbval and its kernels. ipc uses '
+                         'Unix domain sockets in a temporary directory instead '
+                         'of TCP ports on the loopback interface.')
+
+    group.addoption('--nbval-durations', action='store', default=0,
+                    type=int, metavar='N',
+                    help='Show the N slowest notebooks and cells, with the time '
+                         'spent executing, receiving outputs and comparing.')
+
+    group.addoption('--nbval-order', action='store', default='collection',
+                    choices=['collection', 'slowest-first'],
+                    help='Order in which to run notebooks. slowest-first uses the '
+                         'durations recorded in earlier sessions.')
+
+    group.addoption('--nbval-shard', action='store', default=None, metavar='I/N',
+                    help='Only run shard I of N, for splitting a session across '
+                         'machines. Test files are split into shards of similar '
+                         'duration, using the durations recorded in earlier '
+                         'sessions, or else their number of tests and size.')
+
+    group.addoption('--nbval-changed-only', action='store_true',
+                    help='Skip the notebooks that passed in an earlier session, '
+                         'if their cells, kernelspec, sanitize file and '
+                         'dependencies (see --nbval-depends) are unchanged.')
+
+    group.addoption('--nbval-force', action='store_true',
+                    help='Run all notebooks, even with --nbval-changed-only.')
+
+    group.addoption('--nbval-depends', action='append', default=[], metavar='GLOB',
+                    help='Files that all notebooks depend on, for '
+                         '--nbval-changed-only, relative to the rootdir. Can be '
+                         'given multiple times. Notebooks can add their own with '
+                         '"nbval": {"depends": [...]} in their metadata, '
+                         'relative to the notebook.')
+
+    group.addoption('--nbval-record-dependencies', action='store_true',
+                    help='Record the local files (modules and data) that each '
+                         'notebook imports or opens, for --nbval-affected-by. '
+                         'Only applies to Python kernels, and not with '
+                         '--nbval-concurrency.')
+
+    group.addoption('--nbval-affected-by', action='store', default=None,
+                    metavar='REF|FILES',
+                    help='Only run the notebooks that changed, or whose recorded '
+                         'dependencies changed, compared to a git revision or in '
+                         'a comma separated list of files. Notebooks without '
+                         'recorded dependencies are run, and recorded.')
+
+    group.addoption('--nbval-store', action='store', default=None, metavar='PATH|URL',
+                    help='Result store to keep the executed outputs of notebooks '
+                         'in: a directory, possibly on a shared filesystem. '
+                         'Notebooks whose sources, kernelspec, environment and '
+                         'sanitize file are unchanged since they were stored are '
+                         'compared with their stored outputs instead of being run.')
+
+    group.addoption('--nbval-store-max-size', action='store', default=None,
+                    type=parse_size, metavar='SIZE',
+                    help='Size to keep the result store under, e.g. 500M or 2G, '
+                         'by evicting the least recently used entries.')
+
+    group.addoption('--nbval-store-lock', action='append', default=[], metavar='FILE',
+                    help='Lock file describing the environment, for the result '
+                         'store. Can be given multiple times. Defaults to the '
+                         'versions of the packages installed for the current '
+                         'interpreter.')
+
+    group.addoption('--nbval-snapshots', action='store', default=None, metavar='DIR',
+                    help='Save the kernel namespace in DIR after each cell, and '
+                         'resume notebooks from their first changed cell in the '
+                         'next sessions. Only applies to Python kernels, and not '
+                         'with --nbval-concurrency.')
+
+    group.addoption('--nbval-snapshot-serializer', action='store', default='auto',
+                    metavar='MODULE',
+                    help='Module serializing the namespace snapshots, with dumps() '
+                         'and loads() functions, e.g. dill, cloudpickle or pickle. '
+                         'By default, the first of these that the kernel can import.')
+
+    group.addoption('--nbval-no-prerequisites', action='store_true',
+                    help='Only run the selected cells of a notebook (e.g. with -k '
+                         'or --lf), instead of also running the earlier cells '
+                         'they depend on.')
+
+    group.addoption('--nbval-split-independent', action='store_true',
+                    help='Split notebooks into chains of cells that do not depend '
+                         'on each other, and run each chain in its own kernel at '
+                         'the same time, after the cells they share. Cells with '
+                         'hidden side effects can be marked with a '
+                         '"# NBVAL_SIDE_EFFECTS" comment or "nbval-side-effects" '
+                         'tag. Not used with snapshots, dependency recording or '
+                         'coverage.')
+
+    group.addoption('--nbval-output-budget', action='store', default=None,
+                    type=parse_size, metavar='SIZE',
+                    help='Characters of each stream output of a cell to keep, e.g. '
+                         '10M. Longer outputs only keep their start and end, and '
+                         'are compared by a digest of their sanitized text, with '
+                         'the sanitize patterns applied line by line.')
+
+    group.addoption('--nbval-notebook-failfast', action='store_true',
+                    help='Skip the remaining cells of a notebook once a cell '
+                         'raises an error, and stop its kernel right away. '
+                         'Notebooks can override this with "failfast" in their '
+                         '"nbval" metadata.')
+
     group.addoption('--sanitize-with',
                     help='(deprecated) Alias of --nbval-sanitize-with')
 
@@ -131,6 +322,321 @@ def pytest_configure(config):
     if config.option.nbval or config.option.nbval_lax:
         if config.option.nbval_kernel_name and config.option.current_env:
             raise ValueError("--current-env and --nbval-kernel-name are mutually exclusive.")
+        history = config.stash[history_key] = DurationHistory(getattr(config, 'cache', None))
+        config.pluginmanager.register(history, 'nbval-durations')
+        if not config.option.nbval_no_prerequisites:
+            config.pluginmanager.register(PrerequisiteSelection(), 'nbval-prerequisites')
+        if config.option.nbval_shard:
+            try:
+                config.stash[shard_key] = parse_shard(config.option.nbval_shard)
+            except ValueError as e:
+                raise pytest.UsageError("--nbval-shard: %s" % e)
+        if config.option.nbval_changed_only:
+            tracker = config.stash[changes_key] = ChangeTracker(getattr(config, 'cache', None))
+            config.pluginmanager.register(tracker, 'nbval-changed-only')
+        if config.option.nbval_record_dependencies or config.option.nbval_affected_by:
+            dependencies = config.stash[dependencies_key] = DependencyMap(
+                getattr(config, 'cache', None), str(config.rootpath))
+            config.pluginmanager.register(dependencies, 'nbval-dependencies')
+        if config.option.nbval_affected_by:
+            try:
+                config.stash[changed_files_key] = changed_files(
+                    config.option.nbval_affected_by, str(config.rootpath))
+            except ValueError as e:
+                raise pytest.UsageError("--nbval-affected-by: %s" % e)
+        if config.option.nbval_store and not getattr(config.option, 'cov_source', None):
+            try:
+                config.stash[store_key] = open_store(
+                    config.option.nbval_store, max_size=config.option.nbval_store_max_size)
+            except ValueError as e:
+                raise pytest.UsageError("--nbval-store: %s" % e)
+            config.stash[environment_lock_key] = environment_lock(config.option.nbval_store_lock)
+        if config.option.nbval_snapshots and not getattr(config.option, 'cov_source', None):
+            config.stash[snapshots_key] = SnapshotDirectory(config.option.nbval_snapshots)
+        if config.option.nbval_transport == 'ipc':
+            if sys.platform == 'win32':
+                raise pytest.UsageError("--nbval-transport ipc is not supported on Windows.")
+            config.stash[runtime_dir_key] = tempfile.mkdtemp(prefix='nbval-')
+        if config.option.nbval_kernel_pool > 0 or config.option.nbval_reuse_kernel:
+            config.stash[kernel_pool_key] = KernelPool(
+                kernel_factory(config),
+                size=config.option.nbval_kernel_pool,
+                max_idle=config.option.nbval_kernel_pool_max_idle,
+                reuse=config.option.nbval_reuse_kernel,
+            )
+
+
+def pytest_unconfigure(config):
+    runner = config.stash.get(runner_key, None)
+    if runner is not None:
+        runner.shutdown()
+    pool = config.stash.get(kernel_pool_key, None)
+    if pool is not None:
+        pool.shutdown()
+    fork_server = config.stash.get(fork_server_key, None)
+    if fork_server is not None:
+        fork_server.stop()
+    runtime_dir = config.stash.get(runtime_dir_key, None)
+    if runtime_dir is not None:
+        shutil.rmtree(runtime_dir, ignore_errors=True)
+
+
+def _select_shard(config, items, history):
+    index, count = config.stash[shard_key]
+    units = OrderedDict()
+    sizes = {}
+    for item in items:
+        unit = item.nodeid.split('::', 1)[0]
+        units.setdefault(unit, []).append(item)
+        if isinstance(item, IPyNbCell) and unit not in sizes:
+            try:
+                sizes[unit] = os.path.getsize(str(item.parent.fspath))
+            except OSError:
+                pass
+    costs = history.estimate({unit: len(unit_items) for unit, unit_items in units.items()}, sizes)
+    shards = assign_shards(costs, count)
+    selected, deselected = [], []
+    for item in items:
+        (selected if shards[item.nodeid.split('::', 1)[0]] == index else deselected).append(item)
+    if deselected:
+        config.hook.pytest_deselected(items=deselected)
+        items[:] = selected
+
+
+def _skip_unchanged(config, items, tracker):
+    depends = expand_globs(config.option.nbval_depends, str(config.rootpath))
+    notebooks = OrderedDict()
+    for item in items:
+        if isinstance(item, IPyNbCell):
+            notebooks.setdefault(item.parent, []).append(item)
+    for nbfile, cells in notebooks.items():
+        value = {'fingerprint': nbfile.fingerprint(depends),
+                 'cells': sum(cell.cell_type == 'code' for cell in nbfile.nb.cells)}
+        if not config.option.nbval_force and tracker.unchanged(nbfile.nodeid, value['fingerprint']):
+            nbfile.unchanged = True
+            for item in cells:
+                item.add_marker(pytest.mark.skip(reason='nbval: unchanged since it last passed'))
+        else:
+            for item in cells:
+                item.user_properties.append(('nbval_fingerprint', value))
+
+
+class PrerequisiteSelection(object):
+    """
+    Adds back the cells that the selected cells of a notebook depend on,
+    once other plugins have deselected items (e.g. with -k or --lf).
+    Prerequisite cells are run without comparing their outputs.
+    """
+    @pytest.hookimpl(hookwrapper=True, tryfirst=True)
+    def pytest_collection_modifyitems(self, session, config, items):
+        yield
+        self.add_prerequisites(items)
+
+    def add_prerequisites(self, items):
+        notebooks = OrderedDict()
+        for item in items:
+            if isinstance(item, IPyNbCell):
+                notebooks.setdefault(item.parent, []).append(item)
+        added = {}
+        for nbfile, chosen in notebooks.items():
+            count = sum(cell.cell_type == 'code' for cell in nbfile.nb.cells)
+            if nbfile.unchanged or len(chosen) == count:
+                continue
+            # --lf filters the cells at collection, so collect them again
+            existing = {cell.name: cell for cell in chosen}
+            cells = [existing.get(cell.name, cell) for cell in nbfile.collect()]
+            runnable = [cell for cell in cells if not cell.options['skip']]
+            indices = prerequisites(
+                [cell.cell.source for cell in runnable],
+                [i for i, cell in enumerate(runnable) if cell.name in existing])
+            if indices:
+                added[nbfile] = [runnable[i] for i in indices]
+        if not added:
+            return
+        reordered = []
+        for item in items:
+            nbfile = item.parent if isinstance(item, IPyNbCell) else None
+            if nbfile not in added:
+                reordered.append(item)
+            elif added[nbfile] is not None:
+                for cell in added[nbfile]:
+                    cell.prerequisite = True
+                    cell.options['check'] = False
+                cells = added[nbfile] + notebooks[nbfile]
+                reordered.extend(sorted(cells, key=lambda cell: cell.cell_num))
+                added[nbfile] = None
+        items[:] = reordered
+
+
+def _select_affected(config, items, dependencies):
+    changed = config.stash[changed_files_key]
+    affected = {}
+    selected, deselected = [], []
+    for item in items:
+        if isinstance(item, IPyNbCell):
+            nbfile = item.parent
+            if nbfile not in affected:
+                affected[nbfile] = dependencies.affected(nbfile.nodeid, str(nbfile.fspath), changed)
+            if not affected[nbfile]:
+                deselected.append(item)
+                continue
+        selected.append(item)
+    if deselected:
+        config.hook.pytest_deselected(items=deselected)
+        items[:] = selected
+
+
+def pytest_collection_modifyitems(session, config, items):
+    history = config.stash.get(history_key, None)
+    if changed_files_key in config.stash:
+        _select_affected(config, items, config.stash[dependencies_key])
+    if shard_key in config.stash:
+        _select_shard(config, items, history)
+    tracker = config.stash.get(changes_key, None)
+    if tracker is not None:
+        _skip_unchanged(config, items, tracker)
+    if history is None or config.option.nbval_order != 'slowest-first':
+        return
+    # Group consecutive cells of each notebook, leaving other items in place
+    blocks = []
+    for item in items:
+        nbfile = item.parent if isinstance(item, IPyNbCell) else None
+        if nbfile is not None and blocks and blocks[-1][0] is nbfile:
+            blocks[-1][1].append(item)
+        else:
+            blocks.append((nbfile, [item]))
+    notebooks = [block for block in blocks if block[0] is not None]
+    costs = history.estimate({nbfile.nodeid: len(cells) for nbfile, cells in notebooks})
+    slowest = iter(sorted(notebooks, key=lambda block: -costs[block[0].nodeid]))
+    reordered = []
+    for nbfile, block_items in blocks:
+        if nbfile is not None:
+            nbfile, block_items = next(slowest)
+        reordered.extend(block_items)
+    items[:] = reordered
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_xdist_make_scheduler(config, log):
+    """
+    Keep the cells of each notebook on one pytest-xdist worker, and start
+    with the slowest notebooks.
+    """
+    if not (config.option.nbval or config.option.nbval_lax):
+        return None
+    if config.getoption('dist') not in ('load', 'loadscope', 'loadfile'):
+        return None
+    from .scheduling import NotebookScheduling
+    return NotebookScheduling(config, log, history=config.stash.get(history_key, None))
+
+
+def pytest_collection_finish(session):
+    order = []
+    for item in session.items:
+        if not isinstance(item, IPyNbCell) or item.parent.unchanged or item.parent.stored:
+            continue
+        if not order or order[-1] is not item.parent:
+            order.append(item.parent)
+            item.parent.run_cells = []
+        item.parent.run_cells.append(item)
+    for index, nbfile in enumerate(order):
+        nbfile.run_index = index
+    session.config.stash[notebook_order_key] = order
+
+    option = session.config.option
+    if order and option.nbval_concurrency > 0 and not getattr(option, 'cov_source', None):
+        session.config.stash[runner_key] = AsyncRunner(
+            option.nbval_concurrency,
+            startup_timeout=option.nbval_kernel_startup_timeout,
+            timeout=option.nbval_cell_timeout,
+            output_budget=option.nbval_output_budget,
+            packer=option.nbval_session_packer,
+            transport=option.nbval_transport,
+            runtime_dir=session.config.stash.get(runtime_dir_key, None),
+        )
+        if not hasattr(session.config, 'workerinput'):
+            order[0].submit_upcoming()
+        return
+    if order and option.nbval_fork_server and option.nbval_current_env:
+        # Start the template now, so that it preloads while we get going
+        preload = [name.strip() for names in option.nbval_preload
+                   for name in names.split(',') if name.strip()]
+        session.config.stash[fork_server_key] = ForkServer(preload)
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    fork_server = config.stash.get(fork_server_key, None)
+    if fork_server is not None and not fork_server.available:
+        terminalreporter.write_sep('-', 'nbval fork server')
+        terminalreporter.write_line(
+            'Fork server unavailable, kernels were started normally: %s' %
+            fork_server.reason)
+    startup_timings = config.stash.get(startup_timings_key, [])
+    if startup_timings and config.option.verbose > 0:
+        terminalreporter.write_sep('-', 'nbval kernel startup')
+        milestones = ['spawn', 'connect', 'shell_ready', 'iopub_ready']
+        terminalreporter.write_line(
+            'mean of %d kernels: ' % len(startup_timings) + ', '.join(
+                '%s after %.3fs' % (
+                    name.replace('_', ' '),
+                    sum(t[name] for t in startup_timings) / len(startup_timings))
+                for name in milestones))
+    pool = config.stash.get(kernel_pool_key, None)
+    if pool is not None and (pool.hits or pool.misses):
+        terminalreporter.write_sep('-', 'nbval kernel pool')
+        terminalreporter.write_line(
+            '%d kernels acquired: %d pool hits, %d misses' %
+            (pool.hits + pool.misses, pool.hits, pool.misses))
+        if pool.reuse:
+            terminalreporter.write_line('%d kernels reused' % pool.reused)
+    history = config.stash.get(history_key, None)
+    if history is not None and config.option.nbval_durations > 0:
+        count = config.option.nbval_durations
+        terminalreporter.write_sep('-', 'nbval slowest %d notebooks' % count)
+        for nodeid, duration in history.slowest_notebooks(count):
+            terminalreporter.write_line('%.2fs %s' % (duration, nodeid))
+        terminalreporter.write_sep('-', 'nbval slowest %d cells' % count)
+        for timings in history.slowest_cells(count):
+            terminalreporter.write_line('%.2fs %s (%s)' % (
+                timings['duration'], timings['nodeid'], ', '.join(
+                    '%s %s' % (name, 'n/a' if timings[name] is None else '%.2fs' % timings[name])
+                    for name in ('execute', 'drain', 'compare'))))
+    sanitizers = config.stash.get(sanitizers_key, {})
+    if sanitizers and config.option.verbose > 0:
+        # The same pattern may be in several sanitizers
+        patterns = OrderedDict()
+        for sanitizer in sanitizers.values():
+            for stats in sanitizer.stats:
+                total = patterns.setdefault(
+                    stats['pattern'], dict(calls=0, skipped=0, hits=0, time=0.0))
+                for name in total:
+                    total[name] += stats[name]
+        terminalreporter.write_sep('-', 'nbval sanitize patterns')
+        for pattern, total in sorted(patterns.items(), key=lambda item: -item[1]['time']):
+            terminalreporter.write_line('%.3fs %d hits, %d applied, %d skipped: %s' % (
+                total['time'], total['hits'], total['calls'], total['skipped'], pattern))
+
+
+def kernel_factory(config):
+    """
+    Return a callable ``factory(kernel_name, cwd=cwd)`` that starts a
+    kernel with the options given on the command line.
+    """
+    startup_timings = config.stash.setdefault(startup_timings_key, [])
+
+    def factory(kernel_name, cwd=None):
+        kernel = RunningKernel(
+            kernel_name,
+            cwd=cwd,
+            startup_timeout=config.option.nbval_kernel_startup_timeout,
+            fork_server=config.stash.get(fork_server_key, None),
+            session_packer=config.option.nbval_session_packer,
+            transport=config.option.nbval_transport,
+            runtime_dir=config.stash.get(runtime_dir_key, None),
+        )
+        startup_timings.append(kernel.startup_timings)
+        return kernel
+    return factory
 
 
 
@@ -150,6 +656,7 @@ comment_markers = {
     'NBVAL_CHECK_OUTPUT': 'check',
     'NBVAL_RAISES_EXCEPTION': 'check_exception',
     'NBVAL_SKIP': 'skip',
+    'NBVAL_SIDE_EFFECTS': 'side_effects',
 }
 
 metadata_tags = {
@@ -232,6 +739,8 @@ class IPyNbFile(pytest.File):
         self.sanitize_patterns = OrderedDict()  # Filled in setup_sanitize_patterns()
         self.compare_outputs = not config.option.nbval_lax
         self.timed_out = False
+        # Whether a cell raised an error, with --nbval-notebook-failfast
+        self.failed = False
         self.skip_compare = (
             'metadata',
             'traceback',
@@ -244,14 +753,178 @@ class IPyNbFile(pytest.File):
         )
         if not config.option.nbdime:
             self.skip_compare = self.skip_compare + ('image/png', 'image/jpeg')
+        # CellResults of the cells run in this session, by cell number
+        self.cell_results = OrderedDict()
 
     kernel = None
+    engine = None
+    # NotebookRun, when the notebook is executed by an AsyncRunner
+    run = None
+    run_index = None
+    # IPyNbCell items of this notebook that will run, in order
+    run_cells = ()
+    # Whether the notebook is skipped by --nbval-changed-only
+    unchanged = False
+    # Whether the files opened by the kernel are being recorded
+    tracing = False
+    # Key of the notebook's results in the result store, and whether it has them
+    store_entry_key = None
+    stored = False
+    # Numbers of the cells that are executed when the notebook runs, and
+    # their (cell_num, options) as set in the notebook
+    executable_cells = ()
+    run_options = ()
+    # Cumulative hashes of the cells, by item, when taking snapshots
+    prefix_hashes = {}
+    # Kernels running the other chains of cells, with --nbval-split-independent
+    extra_kernels = ()
+    # Sanitizer of the sanitize patterns, once they are used
+    sanitizer = None
 
     def setup(self):
         """
         Called by pytest to setup the collector cells in .
         Here we start a kernel and setup the sanitize patterns.
         """
+        if runner_key in self.config.stash and self.run_index is not None:
+            self.submit_upcoming()
+        if self.stored:
+            entry = self.config.stash[store_key].get(self.store_entry_key)
+            # An entry missing some cells is a miss, and the notebook runs again
+            if entry is not None and StoredRun(entry).covers(self.executable_cells):
+                self.engine = StoredRun(entry)
+                self.setup_sanitize_files()
+                return
+        if self.run is not None:
+            self.run.wait_started()
+            self.engine = self.run
+            self.setup_sanitize_files()
+            return
+        self.kernel = self.acquire_kernel()
+        pool = self.config.stash.get(kernel_pool_key, None)
+        if pool is not None:
+            pool.prefetch(self.upcoming_kernel_keys(pool.size))
+        self.setup_sanitize_files()
+        if dependencies_key in self.config.stash:
+            self.tracing = self.kernel.start_tracing()
+        if getattr(self.parent.config.option, 'cov_source', None):
+            setup_coverage(self.parent.config, self.kernel, getattr(self, "fspath", None))
+        restored = None
+        if snapshots_key in self.config.stash:
+            restored = self.setup_snapshots()
+        cells = self.run_cell_sources()
+        if restored is not None:
+            cells = [(item, source) for item, source in cells
+                     if str(item.cell_num) not in restored.entry['cells']]
+        elif (self.config.option.nbval_split_independent and not self.tracing
+                and snapshots_key not in self.config.stash
+                and not getattr(self.parent.config.option, 'cov_source', None)):
+            self.engine = self.split_engine(cells)
+            if self.engine is not None:
+                return
+        self.engine = NotebookEngine(
+            self.kernel,
+            cells,
+            depth=self.config.option.nbval_pipeline_depth,
+            output_budget=self.config.option.nbval_output_budget,
+            sanitize=self.sanitize,
+            errors_only=self.unchecked_cells(),
+        )
+        if restored is not None:
+            self.engine = ResumedEngine(self.engine, restored)
+
+
+    @property
+    def failfast(self):
+        """Whether to skip the remaining cells after a cell raises an error."""
+        return self.nb.metadata.get('nbval', {}).get(
+            'failfast', self.config.option.nbval_notebook_failfast)
+
+    def stop_early(self):
+        """
+        Stop executing this notebook after a cell failed, releasing its
+        kernel. The remaining cells are skipped.
+        """
+        self.failed = True
+        self.teardown()
+        self.engine = self.kernel = None
+        self.extra_kernels = ()
+
+    def acquire_kernel(self):
+        """Start a kernel for this notebook, or take one from the kernel pool."""
+        pool = self.config.stash.get(kernel_pool_key, None)
+        if pool is not None:
+            # Notebooks opting out of reuse don't get another notebook's kernel
+            fresh = not self.nb.metadata.get('nbval', {}).get('reuse_kernel', True)
+            return pool.acquire(self.kernel_key(), fresh=fresh)
+        kernel_name, cwd = self.kernel_key()
+        return kernel_factory(self.config)(kernel_name, cwd=cwd)
+
+    def release_kernel(self, kernel):
+        """Return a kernel to the kernel pool if it can be reused, or stop it."""
+        pool = self.config.stash.get(kernel_pool_key, None)
+        reusable = (self.nb.metadata.get('nbval', {}).get('reuse_kernel', True)
+                    and not (self.engine is not None and self.engine.busy))
+        if pool is not None and reusable:
+            pool.release(self.kernel_key(), kernel)
+        else:
+            kernel.stop()
+
+    def split_engine(self, cells):
+        """
+        Return a SplitEngine running the independent chains of ``cells``, a
+        list of ``(item, source)`` pairs, in kernels of their own after
+        the cells they share, or None if they can't be split.
+        """
+        split = independent_chains(
+            [source for _, source in cells],
+            opaque=[i for i, (item, _) in enumerate(cells) if item.options['side_effects']])
+        if split is None:
+            return None
+        prefix, chains = split
+        self.extra_kernels = [self.acquire_kernel() for _ in chains[1:]]
+        unchecked = self.unchecked_cells()
+        engines = []
+        routes = {}
+        for index, chain in enumerate(chains):
+            chain_cells = [cells[i] for i in chain]
+            if index == 0:
+                kernel = self.kernel
+                chain_cells = cells[:prefix] + chain_cells
+            else:
+                kernel = self.extra_kernels[index - 1]
+                # Results of the shared cells are reported from the first chain
+                chain_cells = [(('prefix', item.cell_num), source)
+                               for item, source in cells[:prefix]] + chain_cells
+            engine = NotebookEngine(kernel, chain_cells,
+                                    depth=self.config.option.nbval_pipeline_depth,
+                                    output_budget=self.config.option.nbval_output_budget,
+                                    sanitize=self.sanitize,
+                                    errors_only=unchecked | set(
+                                        key for key, _ in chain_cells
+                                        if isinstance(key, tuple)))
+            engines.append(engine)
+            routes.update((key, engine) for key, _ in chain_cells)
+        engine = SplitEngine(engines, routes)
+        engine.start()
+        return engine
+
+    def unchecked_cells(self):
+        """
+        Return the set of the items whose outputs are not compared, so that
+        only their errors need to be kept. Empty if outputs are also kept
+        for the nbdime reporter, the result store or snapshots.
+        """
+        stash = self.config.stash
+        if (self.config.option.nbdime or store_key in stash or snapshots_key in stash):
+            return set()
+        return set(item for item in self.run_cells
+                   if not item.options['check'] or item.cell.execution_count is None)
+
+    def kernel_key(self):
+        """
+        Return the ``(kernel_name, cwd)`` pair this notebook should be run with.
+        """
         # we've already checked that --nbval-current-env and
         # --nbval-kernel-name were not both supplied
         if self.parent.config.option.nbval_current_env:
@@ -261,15 +934,127 @@ class IPyNbFile(pytest.File):
         else:
             kernel_name = self.nb.metadata.get(
                 'kernelspec', {}).get('name', 'python')
-        self.kernel = RunningKernel(
-            kernel_name,
-            cwd=str(self.fspath.dirname),
-            startup_timeout=self.config.option.nbval_kernel_startup_timeout, 
+        return kernel_name, str(self.fspath.dirname)
+
+    def fingerprint(self, depends=()):
+        """
+        Return the fingerprint of this notebook for --nbval-changed-only,
+        with the files in ``depends`` as dependencies.
+        """
+        own = expand_globs(self.nb.metadata.get('nbval', {}).get('depends', []),
+                           str(self.fspath.dirname))
+        files = [os.path.abspath(f) for f in self.get_sanitize_files()]
+        return fingerprint(
+            self.nb,
+            kernel_fingerprint(self.kernel_key()[0]),
+            files=files + sorted(set(depends) | set(own)),
+            settings={'compare_outputs': self.compare_outputs},
         )
-        self.setup_sanitize_files()
-        if getattr(self.parent.config.option, 'cov_source', None):
-            setup_coverage(self.parent.config, self.kernel, getattr(self, "fspath", None))
 
+    def record_dependencies(self):
+        """
+        Attach the files traced in the kernel, relative to the rootdir, to
+        the report of the last cell, for the DependencyMap.
+        """
+        root = str(self.config.rootpath)
+        files = self.kernel.traced_files(root)
+        if files is not None:
+            self.run_cells[-1].user_properties.append(
+                ('nbval_dependencies', sorted(os.path.relpath(f, root) for f in files)))
+
+    def compute_store_entry_key(self):
+        """Return the key of this notebook's results in the result store."""
+        sanitize = ''
+        for fname in self.get_sanitize_files():
+            with open(fname, 'r', encoding="utf-8") as f:
+                sanitize += f.read()
+        return result_key(
+            self.nb,
+            kernel_fingerprint(self.kernel_key()[0]),
+            self.config.stash[environment_lock_key],
+            sanitize,
+            self.run_options,
+        )
+
+    def store_results(self):
+        """
+        Put the results of the cells in the result store, if all cells
+        were executed to the end.
+        """
+        results = [self.cell_results.get(cell_num) for cell_num in self.executable_cells]
+        if any(r is None or not r.idle or r.timed_out for r in results):
+            return
+        self.config.stash[store_key].put(
+            self.store_entry_key, make_entry(self.nodeid, self.cell_results))
+
+    def setup_snapshots(self):
+        """
+        Remove the snapshots of cells the notebook no longer starts with,
+        restore the kernel namespace after the longest unchanged prefix of
+        cells, and start taking snapshots after each cell.
+
+        Returns a StoredRun of the outputs of the restored cells, or None
+        if no cells were restored.
+        """
+        snapshots = self.config.stash[snapshots_key]
+        cells = [item for item, _ in self.run_cell_sources()]
+        if [item.cell_num for item in cells] != list(self.executable_cells):
+            # Some cells are deselected, so the snapshots wouldn't match
+            return None
+        seed = snapshot_seed(self.nodeid, kernel_fingerprint(self.kernel_key()[0]))
+        hashes = prefix_hashes(seed, [item.cell.source for item in cells])
+        snapshots.prune(seed, hashes)
+        count = snapshots.restorable(hashes)
+        restored = None
+        if count and self.kernel.restore_snapshot(snapshots.snapshot_path(hashes[count - 1])):
+            restored = snapshots.load_outputs(
+                [(item.cell_num, digest) for item, digest in zip(cells[:count], hashes)])
+            seed = hashes[count - 1]
+        if self.kernel.start_snapshots(
+                snapshots.path, seed, self.config.option.nbval_snapshot_serializer):
+            self.prefix_hashes = dict(zip(cells, hashes))
+        return restored
+
+    def run_cell_sources(self):
+        """
+        Return the ``(item, source)`` pairs of the cells that will be executed.
+        """
+        return [(item, item.cell.source) for item in self.run_cells if not item.options['skip']]
+
+    def submit_upcoming(self):
+        """
+        Submit this notebook and the ones to run after it, up to twice the
+        concurrency in all, to the AsyncRunner, unless they already were.
+
+        On a pytest-xdist worker, the notebooks collected after this one are
+        scheduled on any of the workers, so only this one is submitted.
+        """
+        order = self.config.stash[notebook_order_key]
+        option = self.config.option
+        count = 1 if hasattr(self.config, 'workerinput') else 2 * option.nbval_concurrency
+        for nbfile in order[self.run_index:self.run_index + count]:
+            if nbfile.run is not None:
+                continue
+            kernel_name, cwd = nbfile.kernel_key()
+            if option.nbval_output_budget is not None:
+                # Truncated outputs are sanitized as they arrive
+                nbfile.setup_sanitize_files()
+            nbfile.run = self.config.stash[runner_key].submit(
+                kernel_name, cwd, nbfile.run_cell_sources(), sanitize=nbfile.sanitize,
+                errors_only=nbfile.unchecked_cells())
+
+    def upcoming_kernel_keys(self, count):
+        """
+        Return the kernel keys of the next ``count`` notebooks to run after this one.
+
+        On a pytest-xdist worker, the notebooks collected after this one are
+        scheduled on any of the workers, so none are returned.
+        """
+        order = self.config.stash.get(notebook_order_key, [])
+        if self.run_index is None or hasattr(self.config, 'workerinput'):
+            return []
+        return [nbfile.kernel_key()
+                for nbfile in order[self.run_index + 1:self.run_index + 1 + count]]
 
     def setup_sanitize_files(self):
         """
@@ -279,7 +1064,25 @@ class IPyNbFile(pytest.File):
         for fname in self.get_sanitize_files():
             with open(fname, 'r', encoding="utf-8") as f:
                 self.sanitize_patterns.update(get_sanitize_patterns(f.read()))
+        self.sanitizer = None
 
+    def sanitize(self, s):
+        """
+        Apply the sanitize patterns to a string. Truncated stream outputs
+        were sanitized line by line as they arrived, and are left as they are.
+        """
+        if not isinstance(s, str) or isinstance(s, TruncatedText):
+            return s
+        if self.sanitizer is None:
+            if not self.sanitize_patterns:
+                return s
+            # The regex replacements are taken from the sanitize file
+            sanitizers = self.config.stash.setdefault(sanitizers_key, {})
+            patterns = tuple(self.sanitize_patterns.items())
+            if patterns not in sanitizers:
+                sanitizers[patterns] = Sanitizer(patterns)
+            self.sanitizer = sanitizers[patterns]
+        return self.sanitizer(s)
 
     def get_sanitize_files(self):
         """
@@ -309,6 +1112,8 @@ class IPyNbFile(pytest.File):
         """
 
         self.nb = nbformat.read(str(self.fspath), as_version=4)
+        self.executable_cells = []
+        self.run_options = []
 
         # Start the cell count
         cell_num = 1
@@ -342,6 +1147,9 @@ class IPyNbFile(pytest.File):
                         lineno=0
                     )
                 options.update(comment_opts)
+                if not options['skip']:
+                    self.executable_cells.append(cell_num)
+                    self.run_options.append((cell_num, dict(options)))
                 options.setdefault('check', self.compare_outputs)
                 name = 'Cell ' + str(cell_num)
                 yield IPyNbCell.from_parent(
@@ -351,11 +1159,31 @@ class IPyNbFile(pytest.File):
                 # Update 'code' cell count
                 cell_num += 1
 
+        store = self.config.stash.get(store_key, None)
+        if store is not None:
+            self.store_entry_key = self.compute_store_entry_key()
+            self.stored = store.contains(self.store_entry_key)
+
     def teardown(self):
+        if self.engine is not None:
+            self.engine.close()
+        if self.store_entry_key is not None and not isinstance(self.engine, StoredRun):
+            self.store_results()
         if self.kernel is not None and self.kernel.is_alive():
+            idle = not (self.engine is not None and self.engine.busy)
+            if self.tracing and self.run_cells and idle:
+                self.record_dependencies()
+            if self.prefix_hashes and idle:
+                self.kernel.stop_snapshots()
             if getattr(self.parent.config.option, 'cov_source', None):
                 teardown_coverage(self.parent.config, self.kernel)
-            self.kernel.stop()
+            self.release_kernel(self.kernel)
+        for kernel in self.extra_kernels:
+            if kernel.is_alive():
+                self.release_kernel(kernel)
+        # The results are not needed any more
+        self.engine = self.run = None
+        self.cell_results = OrderedDict()
 
 
 class IPyNbCell(pytest.Item):
@@ -376,6 +1204,9 @@ class IPyNbCell(pytest.Item):
         # _pytest.skipping assumes all pytest.Item have this attribute:
         self.obj = Dummy()
 
+    # Whether the cell only runs because a selected cell depends on it
+    prerequisite = False
+
     """ *****************************************************
         *****************  TESTING FUNCTIONS  ***************
         ***************************************************** """
@@ -515,6 +1346,15 @@ class IPyNbCell(pytest.Item):
 
             for ref_out, test_out in zip(ref_values, test_values):
                 # Compare the individual values
+                if isinstance(test_out, TruncatedText):
+                    if test_out.matches(ref_out):
+                        continue
+                    self.comparison_traceback.append(
+                        cc.OKBLUE
+                        + 'output "%s" of %d characters was truncated to its start '
+                          'and end by --nbval-output-budget, and compared by digest'
+                        % (key, test_out.size)
+                        + cc.ENDC)
                 if ref_out != test_out:
                     self.format_output_compare(key, ref_out, test_out)
                     return False
@@ -571,6 +1411,8 @@ class IPyNbCell(pytest.Item):
                 reason='Previous cell timed out, expected cell to fail'
             )
             self.add_marker(xfail_mark)
+        if self.parent.failed:
+            pytest.skip('nbval: a previous cell of the notebook failed')
 
 
     def raise_cell_error(self, message, *args, **kwargs):
@@ -592,174 +1434,83 @@ class IPyNbCell(pytest.Item):
             pytest.skip()
 
         kernel = self.parent.kernel
-        if not kernel.is_alive():
+        if kernel is not None and not kernel.is_alive():
             raise RuntimeError("Kernel dead on test start")
 
-        # Execute the code in the current cell in the kernel. Returns the
-        # message id of the corresponding response from iopub.
-        msg_id = kernel.execute_cell_input(
-            self.cell.source, allow_stdin=False)
-
         # Timeout for the cell execution
         # after code is sent for execution, the kernel sends a message on
         # the shell channel. Timeout if no message received.
         timeout = self.config.option.nbval_cell_timeout
-        timed_out_this_run = False
-
-        # Poll the shell channel to get a message
-        try:
-            self.parent.kernel.await_reply(msg_id, timeout=timeout)
-        except Empty:  # Timeout reached
-            # Try to interrupt kernel, as this will give us traceback:
-            kernel.interrupt()
+
+        # Execute the code in the current cell in the kernel (unless the
+        # engine already sent it ahead of time), and collect the reply
+        # and outputs.
+        result = self.parent.engine.result(
+            self, self.cell.source, timeout=timeout, output_timeout=self.output_timeout)
+        if result.timed_out:
             self.parent.timed_out = True
-            timed_out_this_run = True
+        self.parent.cell_results[self.cell_num] = result
+        digest = self.parent.prefix_hashes.get(self)
+        if (digest is not None and result.msg_id is not None and result.idle
+                and not result.timed_out):
+            self.config.stash[snapshots_key].save_outputs(digest, result)
+
+        # Reported to the DurationHistory, from pytest-xdist workers too, if
+        # the cell was executed rather than taken from a store or snapshot
+        timings = dict(result.timings(), compare=None, cell=hash_string(self.cell.source))
+        if result.msg_id is not None:
+            self.user_properties.append(('nbval_timings', timings))
 
         # This list stores the output information for the entire cell
-        outs = []
-        # TODO: Only store if comparing with nbdime, to save on memory usage
-        self.test_outputs = outs
-
-        # Now get the outputs from the iopub channel
-        while True:
-            # The iopub channel broadcasts a range of messages. We keep reading
-            # them until we find the message containing the side-effects of our
-            # code execution.
-            try:
-                # Get a message from the kernel iopub channel
-                msg = self.parent.get_kernel_message(timeout=self.output_timeout)
-
-            except Empty:
-                # This is not working: ! The code will not be checked
-                # if the time is out (when the cell stops to be executed?)
-                # Halt kernel here!
-                kernel.stop()
-                if timed_out_this_run:
-                    self.raise_cell_error(
-                        "Timeout of %g seconds exceeded while executing cell."
-                        " Failed to interrupt kernel in %d seconds, so "
-                        "failing without traceback." %
-                            (timeout, self.output_timeout),
-                    )
-                else:
-                    self.parent.timed_out = True
-                    self.raise_cell_error(
-                        "Timeout of %d seconds exceeded waiting for output." %
-                            self.output_timeout,
-                    )
-
-
-
-            # now we must handle the message by checking the type and reply
-            # info and we store the output of the cell in a notebook node object
-            msg_type = msg['msg_type']
-            reply = msg['content']
-            out = NotebookNode(output_type=msg_type)
-
-            # Is the iopub message related to this cell execution?
-            if msg['parent_header'].get('msg_id') != msg_id:
-                continue
-
-            # When the kernel starts to execute code, it will enter the 'busy'
-            # state and when it finishes, it will enter the 'idle' state.
-            # The kernel will publish state 'starting' exactly
-            # once at process startup.
-            if msg_type == 'status':
-                if reply['execution_state'] == 'idle':
-                    break
-                else:
-                    continue
-
-            # execute_input: To let all frontends know what code is
-            # being executed at any given time, these messages contain a
-            # re-broadcast of the code portion of an execute_request,
-            # along with the execution_count.
-            elif msg_type == 'execute_input':
-                continue
-
-            # com? execute reply?
-            elif msg_type.startswith('comm'):
-                continue
-            elif msg_type == 'execute_reply':
-                continue
-
-            # This message type is used to clear the output that is
-            # visible on the frontend
-            # elif msg_type == 'clear_output':
-            #     outs = []
-            #     continue
-
-
-            # elif (msg_type == 'clear_output'
-            #       and msg_type['execution_state'] == 'idle'):
-            #     outs = []
-            #     continue
-
-            # 'execute_result' is equivalent to a display_data message.
-            # The object being displayed is passed to the display
-            # hook, i.e. the *result* of the execution.
-            # The only difference is that 'execute_result' has an
-            # 'execution_count' number which does not seems useful
-            # (we will filter it in the sanitize function)
-            #
-            # When the reply is display_data or execute_result,
-            # the dictionary contains
-            # a 'data' sub-dictionary with the 'text' AND the 'image/png'
-            # picture (in hexadecimal). There is also a 'metadata' entry
-            # but currently is not of much use, sometimes there is information
-            # as height and width of the image (CHECK the documentation)
-            # Thus we iterate through the keys (mimes) 'data' sub-dictionary
-            # to obtain the 'text' and 'image/png' information
-            elif msg_type in ('display_data', 'execute_result'):
-                out['metadata'] = reply['metadata']
-                out['data'] = reply['data']
-                outs.append(out)
-
-                if msg_type == 'execute_result':
-                    out.execution_count = reply['execution_count']
-
-
-            # if the message is a stream then we store the output
-            elif msg_type == 'stream':
-                out.name = reply['name']
-                out.text = reply['text']
-                outs.append(out)
-
-
-            # if the message type is an error then an error has occurred during
-            # cell execution. Therefore raise a cell error and pass the
-            # traceback information.
-            elif msg_type == 'error':
-                # Store error in output first
-                out['ename'] = reply['ename']
-                out['evalue'] = reply['evalue']
-                out['traceback'] = reply['traceback']
-                outs.append(out)
-                if not self.options['check_exception']:
-                    # Ensure we flush iopub before raising error
-                    try:
-                        self.parent.kernel.await_idle(msg_id, self.output_timeout)
-                    except Empty:
-                        self.stop()
-                        raise RuntimeError('Timed out waiting for idle kernel!')
-                    traceback = '\n' + '\n'.join(reply['traceback'])
-                    if out['ename'] == 'KeyboardInterrupt' and self.parent.timed_out:
-                        msg = "Timeout of %g seconds exceeded executing cell" % timeout
-                    else:
-                        msg = "Cell execution caused an exception"
-                    self.raise_cell_error(msg, traceback)
-
-            # any other message type is not expected
-            # should this raise an error?
+        outs = result.outputs
+        # Only kept for the nbdime reporter, to save on memory usage
+        if self.config.option.nbdime:
+            self.test_outputs = outs
+
+        if result.output_timed_out:
+            # This is not working: ! The code will not be checked
+            # if the time is out (when the cell stops to be executed?)
+            # The engine has halted the kernel.
+            if result.timed_out:
+                self.raise_cell_error(
+                    "Timeout of %g seconds exceeded while executing cell."
+                    " Failed to interrupt kernel in %d seconds, so "
+                    "failing without traceback." %
+                        (timeout, self.output_timeout),
+                )
             else:
-                print("unhandled iopub msg:", msg_type)
+                self.parent.timed_out = True
+                self.raise_cell_error(
+                    "Timeout of %d seconds exceeded waiting for output." %
+                        self.output_timeout,
+                )
 
-        outs[:] = coalesce_streams(outs)
+        if result.reply is not None and result.reply['status'] == 'aborted':
+            # This should not occur!
+            raise RuntimeError('Kernel aborted execution request')
+
+        # if an error has occurred during cell execution, raise a cell
+        # error and pass the traceback information.
+        if result.error is not None and not self.options['check_exception']:
+            reply = result.error
+            traceback = '\n' + '\n'.join(reply['traceback'])
+            if reply['ename'] == 'KeyboardInterrupt' and self.parent.timed_out:
+                msg = "Timeout of %g seconds exceeded executing cell" % timeout
+            else:
+                msg = "Cell execution caused an exception"
+            if self.parent.failfast:
+                self.parent.stop_early()
+            self.raise_cell_error(msg, traceback)
 
         # Cells where the reference is not run, will not check outputs:
         unrun = self.cell.execution_count is None
         if unrun and self.cell.outputs:
             self.raise_cell_error('Unrun reference cell has outputs')
+        if unrun or not self.options['check']:
+            return
+
+        compare_start = time.monotonic()
+        outs[:] = coalesce_streams(outs)
 
         # Compare if the outputs have the same number of lines
         # and throw an error if it fails
@@ -767,9 +1518,9 @@ class IPyNbCell(pytest.Item):
         #     self.diff_number_outputs(outs, self.cell.outputs)
         #     failed = True
         failed = False
-        if self.options['check'] and not unrun:
-            if not self.compare_outputs(outs, coalesce_streams(self.cell.outputs)):
-                failed = True
+        if not self.compare_outputs(outs, coalesce_streams(self.cell.outputs)):
+            failed = True
+        timings['compare'] = time.monotonic() - compare_start
 
         # If the comparison failed then we raise an exception.
         if failed:
@@ -818,33 +1569,19 @@ class IPyNbCell(pytest.Item):
     def sanitize(self, s):
         """sanitize a string for comparison.
         """
-        if not isinstance(s, str):
-            return s
-
-        """
-        re.sub matches a regex and replaces it with another.
-        The regex replacements are taken from a file if the option
-        is passed when py.test is called. Otherwise, the strings
-        are not processed
-        """
-        for regex, replace in self.parent.sanitize_patterns.items():
-            s = re.sub(regex, replace, s)
-        return s
-
-
-carriagereturn_pat = re.compile(r'^.*\r(?=[^\n])', re.MULTILINE)
-backspace_pat = re.compile(r'[^\n]\b')
+        return self.parent.sanitize(s)
 
 
 def coalesce_streams(outputs):
     """
     Merge all stream outputs with shared names into single streams
-    to ensure deterministic outputs.
+    to ensure deterministic outputs, and apply the carriage returns in
+    their text (see :class:`~nbval.streams.StreamNormalizer`).
 
     Parameters
     ----------
     outputs : iterable of NotebookNodes
-        Outputs being processed
+        Outputs being processed. They are not modified.
     """
     if not outputs:
         return outputs
@@ -853,23 +1590,16 @@ def coalesce_streams(outputs):
     streams = {}
     for output in outputs:
         if (output.output_type == 'stream'):
-            if output.name in streams:
-                streams[output.name].text += output.text
-            else:
-                new_outputs.append(output)
-                streams[output.name] = output
+            if output.name not in streams:
+                merged = NotebookNode(output)
+                new_outputs.append(merged)
+                streams[output.name] = (merged, StreamNormalizer())
+            streams[output.name][1].feed(output.text)
         else:
             new_outputs.append(output)
 
-    # process \r and \b characters
-    for output in streams.values():
-        old = output.text
-        while len(output.text) < len(old):
-            old = output.text
-            # Cancel out anything-but-newline followed by backspace
-            output.text = backspace_pat.sub('', output.text)
-        # Replace all carriage returns not followed by newline
-        output.text = carriagereturn_pat.sub('', output.text)
+    for merged, normalizer in streams.values():
+        merged.text = normalizer.getvalue()
 
     return new_outputs
 
@@ -882,7 +1612,7 @@ def transform_streams_for_comparison(outputs):
             # Transform output
             new_outputs.append({
                 'output_type': 'stream',
-                output.name: output.text,
+                output.name: TruncatedText.from_output(output),
             })
         else:
             new_outputs.append(output)
@@ -0,0 +1,216 @@
+"""
+Asynchronous runner that executes several notebooks at the same time.
+
+A single event loop, in a background thread, drives kernels through
+jupyter_client's asynchronous API. Each notebook submitted to the runner
+is executed from start to end in its own kernel as soon as one of the
+``concurrency`` slots is free. The test items of a notebook then collect
+the results of their cells as pytest gets to them, so they are still
+reported one notebook after the other, in order.
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from queue import Empty
+
+from jupyter_client.manager import AsyncKernelManager
+
+from .engine import CellResult, handle_output
+from .kernel import create_kernel_manager
+
+
+logger = logging.getLogger('nbval')
+
+
+class NotebookRun(object):
+    """
+    Execution of the cells of one notebook by the :class:`AsyncRunner`.
+
+    Has the same :meth:`result` interface as :class:`~nbval.engine.NotebookEngine`.
+    """
+    def __init__(self, kernel_name, cwd, cells, output_budget=None, sanitize=None,
+                 errors_only=()):
+        self.kernel_name = kernel_name
+        self.cwd = cwd
+        self.cells = list(cells)
+        self.results = OrderedDict(
+            (key, CellResult(None, output_budget=output_budget, sanitize=sanitize,
+                             errors_only=key in errors_only))
+            for key, _ in self.cells)
+        # Set once the kernel has started, or failed to start
+        self.started = threading.Event()
+        # Set once the run is over, with or without executing all cells
+        self.done = threading.Event()
+        # Why the kernel failed to start, if it did
+        self.error = None
+        self.future = None
+
+    # The kernel is shut down as soon as the run is over
+    busy = False
+
+    def wait_started(self):
+        """Wait for the kernel to start, raising the error if it failed to."""
+        self.started.wait()
+        if self.error is not None:
+            raise self.error
+
+    def result(self, key, source=None, timeout=None, output_timeout=5):
+        """
+        Wait for a cell to finish, and return its :class:`CellResult`.
+
+        Timeouts are applied by the runner, and are only accepted here
+        for compatibility with :class:`~nbval.engine.NotebookEngine`.
+        """
+        result = self.results[key]
+        while not result.finished.wait(0.1):
+            if self.done.is_set() and not result.finished.is_set():
+                raise RuntimeError("Kernel dead on test start")
+        return result
+
+    def close(self):
+        """Stop executing the notebook."""
+        if self.future is not None:
+            self.future.cancel()
+
+
+class AsyncRunner(object):
+    """
+    Executes up to ``concurrency`` notebooks at a time, each in its own kernel.
+
+    ``timeout``, ``output_timeout`` and ``output_budget`` are applied as
+    for the cells run by :class:`~nbval.engine.NotebookEngine`. The other
+    keyword arguments are passed on to :func:`~nbval.kernel.create_kernel_manager`.
+    """
+    def __init__(self, concurrency, startup_timeout=60, timeout=None, output_timeout=5,
+                 output_budget=None, **kernel_kwargs):
+        self.startup_timeout = startup_timeout
+        self.timeout = timeout
+        self.output_timeout = output_timeout
+        self.output_budget = output_budget
+        self.kernel_kwargs = kernel_kwargs
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self.loop.run_forever, name='nbval-runner', daemon=True)
+        self._thread.start()
+        self._slots = self._call(self._create_semaphore, concurrency)
+
+    def submit(self, kernel_name, cwd, cells, sanitize=None, errors_only=()):
+        """
+        Queue a notebook for execution, and return its :class:`NotebookRun`.
+
+        ``cells`` is a sequence of ``(key, source)`` pairs, in order.
+        ``sanitize`` and ``errors_only`` are used as by
+        :class:`~nbval.engine.NotebookEngine`.
+        """
+        run = NotebookRun(kernel_name, cwd, cells, self.output_budget, sanitize, errors_only)
+        run.future = asyncio.run_coroutine_threadsafe(self._run(run), self.loop)
+        return run
+
+    def shutdown(self):
+        """Stop all runs, shutting down their kernels, and the event loop."""
+        async def cancel_all():
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self._call(cancel_all)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+    def _call(self, coroutine_function, *args):
+        return asyncio.run_coroutine_threadsafe(coroutine_function(*args), self.loop).result()
+
+    async def _create_semaphore(self, value):
+        # Created on the loop, as Python < 3.10 binds it to the current loop
+        return asyncio.Semaphore(value)
+
+    async def _run(self, run):
+        try:
+            async with self._slots:
+                try:
+                    km, kc = await self._start_kernel(run.kernel_name, run.cwd)
+                except Exception as e:
+                    run.error = e
+                    return
+                finally:
+                    run.started.set()
+                try:
+                    for key, source in run.cells:
+                        result = run.results[key]
+                        await self._execute(km, kc, result, source)
+                        if result.output_timed_out:
+                            # The kernel has been stopped
+                            break
+                finally:
+                    kc.stop_channels()
+                    await km.shutdown_kernel(now=True)
+        finally:
+            run.done.set()
+
+    async def _start_kernel(self, kernel_name, cwd):
+        logger.debug('Starting new kernel: "%s"' % kernel_name)
+        km, extra_arguments = create_kernel_manager(
+            kernel_name, AsyncKernelManager, **self.kernel_kwargs)
+        await km.start_kernel(
+            extra_arguments=extra_arguments, cwd=cwd, stderr=open(os.devnull, 'w'))
+        kc = km.client()
+        kc.start_channels()
+        try:
+            await kc.wait_for_ready(timeout=self.startup_timeout)
+        except RuntimeError:
+            logger.exception('Failure starting kernel "%s"', kernel_name)
+            kc.stop_channels()
+            await km.shutdown_kernel()
+            raise
+        return km, kc
+
+    async def _execute(self, km, kc, result, source):
+        result.msg_id = kc.execute(
+            source, store_history=False, allow_stdin=False, stop_on_error=False)
+        result.started = time.monotonic()
+        last_message = [result.started]
+        outputs = asyncio.ensure_future(self._read_outputs(kc, result, last_message))
+        try:
+            try:
+                result.reply = await asyncio.wait_for(
+                    self._await_reply(kc, result.msg_id), self.timeout)
+                result.replied = time.monotonic()
+            except asyncio.TimeoutError:
+                # Try to interrupt kernel, as this will give us traceback:
+                await km.interrupt_kernel()
+                result.timed_out = True
+
+            waiting = time.monotonic()
+            while not outputs.done():
+                remaining = max(waiting, last_message[0]) + self.output_timeout - time.monotonic()
+                if remaining <= 0:
+                    # The kernel is stopped by _run()
+                    result._join_streams()
+                    result.output_timed_out = True
+                    break
+                await asyncio.wait([outputs], timeout=remaining)
+        finally:
+            outputs.cancel()
+            result.finished.set()
+
+    async def _await_reply(self, kc, msg_id):
+        while True:
+            msg = await kc.get_shell_msg()
+            if (msg['parent_header'].get('msg_id') == msg_id and
+                    msg['msg_type'] == 'execute_reply'):
+                return msg['content']
+
+    async def _read_outputs(self, kc, result, last_message):
+        while not result.idle:
+            try:
+                msg = await kc.get_iopub_msg()
+            except Empty:
+                continue
+            last_message[0] = time.monotonic()
+            if msg['parent_header'].get('msg_id') == result.msg_id:
+                handle_output(result, msg)
@@ -0,0 +1,82 @@
+"""
+Compiled sanitize patterns.
+
+The regex/replace pairs of a sanitize file are compiled once into a
+:class:`Sanitizer`, which applies them in order like :func:`re.sub`.
+Patterns that can't match a string, because a literal part that all
+their matches contain is not in it, are skipped. The time spent on each
+pattern is measured, to find the expensive ones.
+"""
+
+import re
+import time
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+
+def required_literal(pattern):
+    """
+    Return the longest literal string that every match of the regex
+    ``pattern`` contains, or '' if none is found.
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except Exception:
+        # Invalid pattern, or a parser unlike the one we know
+        return ''
+    if parsed.state.flags & re.IGNORECASE:
+        return ''
+    runs = []
+    _literal_runs(parsed, runs)
+    return max(runs, key=len, default='')
+
+
+def _literal_runs(items, runs):
+    # Add the runs of literal characters of a sequence of parsed items, and
+    # of the groups in it, which all have to match for the sequence to match
+    run = []
+    for op, av in items:
+        if op == sre_parse.LITERAL:
+            run.append(chr(av))
+            continue
+        if run:
+            runs.append(''.join(run))
+            run = []
+        if op == sre_parse.SUBPATTERN and not av[1] & re.IGNORECASE:
+            _literal_runs(av[-1], runs)
+    if run:
+        runs.append(''.join(run))
+
+
+class Sanitizer(object):
+    """
+    Applies a sequence of ``(regex, replace)`` pairs to strings, in order.
+
+    Patterns are compiled once. If ``prefilter`` is true, a pattern is not
+    applied to strings missing its :func:`required_literal`. ``stats``
+    holds, for each pattern, the number of strings it was applied to
+    (``calls``) or skipped for (``skipped``), the number of replacements
+    it made (``hits``), and the seconds spent applying it (``time``).
+    """
+    def __init__(self, patterns, prefilter=True):
+        self.patterns = []
+        self.stats = []
+        for regex, replace in patterns:
+            literal = required_literal(regex) if prefilter else ''
+            self.patterns.append((re.compile(regex), replace, literal))
+            self.stats.append(dict(pattern=regex, calls=0, skipped=0, hits=0, time=0.0))
+
+    def __call__(self, s):
+        for (compiled, replace, literal), stats in zip(self.patterns, self.stats):
+            if literal and literal not in s:
+                stats['skipped'] += 1
+                continue
+            start = time.perf_counter()
+            s, hits = compiled.subn(replace, s)
+            stats['time'] += time.perf_counter() - start
+            stats['calls'] += 1
+            stats['hits'] += hits
+        return s
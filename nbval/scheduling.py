@@ -0,0 +1,52 @@
+"""
+Notebook-aware scheduling for pytest-xdist.
+
+All cells of a notebook share one kernel, so they must run on the same
+worker, in order. :class:`NotebookScheduling` hands each notebook to a
+worker as one unit of work, and hands out the notebooks that took the
+longest in earlier sessions first, so that a slow notebook doesn't end
+up running on its own at the end of the session.
+"""
+
+from xdist.scheduler import LoadScopeScheduling
+
+from .history import notebook_of
+
+
+class NotebookScheduling(LoadScopeScheduling):
+    """
+    Load scheduling that keeps the cells of each notebook together, and
+    starts with the most expensive units of work.
+
+    Other tests are each a unit of their own with ``--dist load``, and are
+    grouped by file with ``--dist loadfile`` and as with ``--dist
+    loadscope`` otherwise. ``history`` is the
+    :class:`~nbval.history.DurationHistory` used to estimate the cost of
+    each unit.
+    """
+    def __init__(self, config, log=None, history=None):
+        super(NotebookScheduling, self).__init__(config, log)
+        self.history = history
+        self.dist = config.getoption('dist')
+        self._ordered = False
+
+    def _split_scope(self, nodeid):
+        notebook = notebook_of(nodeid)
+        if notebook is not None:
+            return notebook
+        if self.dist == 'load':
+            return nodeid
+        if self.dist == 'loadfile':
+            return nodeid.split('::', 1)[0]
+        return super(NotebookScheduling, self)._split_scope(nodeid)
+
+    def _assign_work_unit(self, node):
+        # The work queue is complete by the time the first unit is assigned
+        if not self._ordered and self.history is not None:
+            costs = self.history.estimate(
+                {scope: len(nodeids) for scope, nodeids in self.workqueue.items()})
+            units = sorted(self.workqueue.items(), key=lambda unit: -costs[unit[0]])
+            self.workqueue.clear()
+            self.workqueue.update(units)
+        self._ordered = True
+        super(NotebookScheduling, self)._assign_work_unit(node)
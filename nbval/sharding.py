@@ -0,0 +1,63 @@
+"""
+Split the test files of a session into shards of similar duration, to
+run them on several machines with ``--nbval-shard I/N``.
+"""
+
+import hashlib
+
+
+# How much more than an equal share of the estimated time a shard may be
+# given, to keep files on their preferred shard
+SLACK = 0.1
+
+
+def parse_shard(value):
+    """
+    Parse ``'I/N'`` into the zero-based index of shard I of N, and N.
+
+    Raises ValueError if ``value`` is not of that form.
+    """
+    index, sep, count = value.partition('/')
+    if not sep:
+        raise ValueError('expected I/N, got %r' % value)
+    index, count = int(index), int(count)
+    if not 1 <= index <= count:
+        raise ValueError('shard %d is not between 1 and %d' % (index, count))
+    return index - 1, count
+
+
+def _preference(key, shard):
+    # Rendezvous hashing: every file ranks the shards in its own, fixed order
+    digest = hashlib.sha1(('%s\0%d' % (key, shard)).encode('utf8')).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+def assign_shards(costs, count):
+    """
+    Assign each unit of work to one of ``count`` shards.
+
+    ``costs`` maps a key for each unit (e.g. its node ID) to its estimated
+    duration. Units are handed out slowest first, as in the greedy
+    longest-processing-time partition, each to the first shard in its own
+    rendezvous hashing order that stays within :data:`SLACK` of an equal
+    share of the total (or the least loaded shard, if none does). The
+    result only depends on ``costs``, and adding a unit only moves the
+    few units that no longer fit on their shard.
+
+    Returns a dict mapping each key to its zero-based shard index.
+    """
+    if not costs:
+        return {}
+    capacity = max(sum(costs.values()) / count * (1 + SLACK), max(costs.values()))
+    loads = [0.0] * count
+    shards = {}
+    for key in sorted(costs, key=lambda key: (-costs[key], key)):
+        preferred = sorted(range(count), key=lambda shard: -_preference(key, shard))
+        for shard in preferred:
+            if loads[shard] + costs[key] <= capacity:
+                break
+        else:
+            shard = min(range(count), key=lambda shard: (loads[shard], shard))
+        loads[shard] += costs[key]
+        shards[key] = shard
+    return shards
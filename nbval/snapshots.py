@@ -0,0 +1,143 @@
+"""
+Resuming notebooks from the first changed cell (``--nbval-snapshots``).
+
+After each cell, the kernel saves its user namespace to a snapshot named
+by the cumulative hash of the sources of the cells executed so far, and
+nbval saves the cell's outputs next to it. When a notebook runs again,
+the snapshot of its longest unchanged prefix of cells is loaded into the
+kernel, and only the cells after it are executed. The stored outputs of
+the prefix are compared with the notebook as usual. The snapshots of
+cells a notebook no longer starts with are removed when it runs again.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+from .store import StoredRun
+
+
+def prefix_hashes(seed, sources):
+    """
+    Return the cumulative hash of the cell ``sources`` after each cell,
+    starting from ``seed``, as computed by the snapshot hook in the kernel.
+    """
+    digest = seed
+    hashes = []
+    for source in sources:
+        digest = hashlib.sha256((digest + source).encode('utf8')).hexdigest()
+        hashes.append(digest)
+    return hashes
+
+
+def snapshot_seed(nodeid, kernel):
+    """Return the hash that the cell hashes of a notebook start from."""
+    return hashlib.sha256(
+        json.dumps([nodeid, kernel], sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+
+class SnapshotDirectory(object):
+    """
+    Directory holding the namespace snapshots taken by the kernel, and the
+    outputs of the same cells.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        os.makedirs(self.path, exist_ok=True)
+
+    def snapshot_path(self, digest):
+        return os.path.join(self.path, digest + '.snapshot')
+
+    def outputs_path(self, digest):
+        return os.path.join(self.path, digest + '.outputs.json')
+
+    def index_path(self, seed):
+        return os.path.join(self.path, seed + '.index.json')
+
+    def prune(self, seed, hashes):
+        """
+        Record ``hashes`` as the cumulative hashes of the cells of the
+        notebook with the ``seed``, and remove the snapshots and outputs
+        of the cells it was last recorded with that aren't among them.
+        Returns the number of files removed.
+        """
+        try:
+            with open(self.index_path(seed), 'r', encoding='utf8') as f:
+                previous = json.load(f)
+        except (OSError, ValueError):
+            previous = []
+        removed = 0
+        for digest in set(previous) - set(hashes):
+            for path in (self.snapshot_path(digest), self.outputs_path(digest)):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                removed += 1
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=self.path)
+        with os.fdopen(fd, 'w', encoding='utf8') as f:
+            json.dump(list(hashes), f)
+        os.replace(tmp, self.index_path(seed))
+        return removed
+
+    def restorable(self, hashes):
+        """
+        Return how many cells, of those with the cumulative ``hashes``, can
+        be restored: the longest prefix with the outputs of all its cells
+        and a snapshot after its last cell.
+        """
+        with_outputs = 0
+        while (with_outputs < len(hashes)
+               and os.path.exists(self.outputs_path(hashes[with_outputs]))):
+            with_outputs += 1
+        for count in range(with_outputs, 0, -1):
+            if os.path.exists(self.snapshot_path(hashes[count - 1])):
+                return count
+        return 0
+
+    def save_outputs(self, digest, result):
+        """Save the outputs of the :class:`~nbval.engine.CellResult` of a cell."""
+        data = {
+            'status': result.reply['status'] if result.reply is not None else 'error',
+            'outputs': result.outputs,
+            'error': result.error,
+        }
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=self.path)
+        with os.fdopen(fd, 'w', encoding='utf8') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.outputs_path(digest))
+
+    def load_outputs(self, cells):
+        """
+        Return a :class:`~nbval.store.StoredRun` with the saved outputs of
+        ``cells``, a sequence of ``(cell_num, digest)`` pairs.
+        """
+        entry = {'cells': {}}
+        for cell_num, digest in cells:
+            with open(self.outputs_path(digest), 'r', encoding='utf8') as f:
+                entry['cells'][str(cell_num)] = json.load(f)
+        return StoredRun(entry)
+
+
+class ResumedEngine(object):
+    """
+    Wraps the engine of a notebook resumed from a snapshot: the cells in
+    ``restored``, a :class:`~nbval.store.StoredRun`, are answered from their
+    saved outputs, and the others by ``engine``.
+    """
+    def __init__(self, engine, restored):
+        self.engine = engine
+        self.restored = restored
+
+    @property
+    def busy(self):
+        return self.engine.busy
+
+    def result(self, key, source=None, timeout=None, output_timeout=5):
+        if str(key.cell_num) in self.restored.entry['cells']:
+            return self.restored.result(key)
+        return self.engine.result(key, source, timeout=timeout, output_timeout=output_timeout)
+
+    def close(self):
+        self.engine.close()
@@ -0,0 +1,281 @@
+"""
+Content-addressed store of executed notebook outputs.
+
+An entry holds the outputs of every cell of one notebook, as executed,
+keyed by a hash of everything the execution depends on: the cell sources,
+the cells that run and their options, the kernelspec, the environment lock
+and the sanitize configuration. With
+``--nbval-store``, notebooks found in the store are not executed again:
+their stored outputs are compared with the notebook instead.
+
+Stores are opened from a URL by :func:`open_store`. Directories (or
+``file://`` URLs) open a :class:`LocalDirectoryStore`, which may live on
+a shared filesystem; other backends can be added with
+:func:`register_backend`. Stores can be pruned from the command line:
+
+    python -m nbval.store prune PATH [--max-size 2G] [--max-age DAYS]
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+import nbformat
+
+from .engine import CellResult
+
+
+# Store backends by URL scheme, see register_backend()
+backends = {}
+
+
+def register_backend(scheme, factory):
+    """
+    Make ``factory(url, max_size=None)`` open the stores whose URL starts
+    with ``scheme://``.
+    """
+    backends[scheme] = factory
+
+
+def open_store(url, max_size=None):
+    """
+    Open the result store at ``url``: a directory, or a URL with the scheme
+    of a registered backend. Raises ValueError for unknown schemes.
+    """
+    scheme, sep, rest = url.partition('://')
+    if not sep:
+        return LocalDirectoryStore(url, max_size=max_size)
+    if scheme not in backends:
+        raise ValueError('no result store backend for %s://' % scheme)
+    return backends[scheme](url, max_size=max_size)
+
+
+def parse_size(value):
+    """Parse a size in bytes, with an optional K, M or G suffix (powers of 1024)."""
+    value = value.strip().upper().rstrip('B')
+    for power, suffix in enumerate('KMG', 1):
+        if value.endswith(suffix):
+            return int(float(value[:-1]) * 1024 ** power)
+    return int(value)
+
+
+def environment_lock(files=()):
+    """
+    Return a hash of the environment notebooks are executed in.
+
+    That is the contents of ``files`` (e.g. lock files) if any, or else
+    the name and version of the distributions installed for the current
+    interpreter.
+    """
+    digest = hashlib.sha256()
+    if files:
+        for path in files:
+            digest.update(path.encode('utf8') + b'\0')
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    else:
+        from importlib import metadata
+        names = sorted(set('%s==%s' % (dist.metadata['Name'], dist.version)
+                           for dist in metadata.distributions()))
+        digest.update('\n'.join(names).encode('utf8'))
+    return digest.hexdigest()
+
+
+def result_key(nb, kernel, lock, sanitize='', cells=()):
+    """
+    Return the key of a notebook's results: a hash of the sources of its
+    code cells, the ``kernel`` description, the environment ``lock``, the
+    ``sanitize`` configuration and ``cells``, the ``(cell_num, options)``
+    of the cells that run.
+    """
+    header = {'sources': [cell.source for cell in nb.cells if cell.cell_type == 'code'],
+              'kernel': kernel, 'lock': lock, 'sanitize': sanitize, 'cells': list(cells)}
+    return hashlib.sha256(
+        json.dumps(header, sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+
+def make_entry(nodeid, results):
+    """
+    Return a store entry for the :class:`~nbval.engine.CellResult` of each
+    cell of a notebook, by cell number.
+    """
+    cells = {}
+    for cell_num, result in results.items():
+        status = result.reply['status'] if result.reply is not None else 'error'
+        cells[str(cell_num)] = {
+            'status': status,
+            'outputs': result.outputs,
+            'error': result.error,
+        }
+    status = 'ok' if all(cell['status'] == 'ok' for cell in cells.values()) else 'error'
+    return {'notebook': nodeid, 'status': status, 'created': time.time(), 'cells': cells}
+
+
+class StoredRun(object):
+    """
+    Results of a notebook from a store entry.
+
+    Has the same :meth:`result` interface as :class:`~nbval.engine.NotebookEngine`,
+    for cell items whose ``cell_num`` is in the entry.
+    """
+    def __init__(self, entry):
+        self.entry = entry
+
+    def covers(self, cell_nums):
+        """Return whether the entry has the results of all cells in ``cell_nums``."""
+        return all(str(cell_num) in self.entry['cells'] for cell_num in cell_nums)
+
+    busy = False
+
+    def result(self, key, source=None, timeout=None, output_timeout=5):
+        cell = self.entry['cells'][str(key.cell_num)]
+        result = CellResult(None)
+        result.outputs = [nbformat.from_dict(out) for out in cell['outputs']]
+        result.error = cell['error']
+        result.reply = {'status': cell['status']}
+        result.idle = True
+        result.finished.set()
+        return result
+
+    def close(self):
+        pass
+
+
+class ResultStore(object):
+    """
+    Interface of result store backends.
+
+    Entries are JSON-serializable dicts, as made by :func:`make_entry`.
+    """
+    def contains(self, key):
+        """Return whether there is an entry for ``key``."""
+        raise NotImplementedError
+
+    def get(self, key):
+        """Return the entry for ``key``, or None, and mark it as recently used."""
+        raise NotImplementedError
+
+    def put(self, key, entry):
+        """Store an entry, evicting the least recently used ones if needed."""
+        raise NotImplementedError
+
+    def prune(self, max_size=None, max_age=None):
+        """
+        Remove the entries unused for ``max_age`` seconds, then the least
+        recently used ones until the store is no larger than ``max_size``
+        bytes. Returns the number of entries removed.
+        """
+        raise NotImplementedError
+
+
+class LocalDirectoryStore(ResultStore):
+    """
+    Stores each entry as a gzipped JSON file in a directory.
+
+    Entries are written atomically, so the directory can be shared by
+    several sessions and machines. The modification time of an entry is
+    updated whenever it is used, for least recently used eviction. If
+    ``max_size`` is given, the store is pruned down to that many bytes
+    after each :meth:`put`.
+    """
+    suffix = '.json.gz'
+
+    def __init__(self, path, max_size=None):
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+
+    def _path(self, key):
+        return os.path.join(self.path, key[:2], key + self.suffix)
+
+    def contains(self, key):
+        return os.path.exists(self._path(key))
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with gzip.open(path, 'rt', encoding='utf8') as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def put(self, key, entry):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wt', encoding='utf8') as f:
+                json.dump(entry, f)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        if self.max_size is not None:
+            self.prune(max_size=self.max_size)
+
+    def entries(self):
+        """Return the ``(path, size, mtime)`` of all entries, least recently used first."""
+        entries = []
+        for dirpath, _, filenames in os.walk(self.path):
+            for name in filenames:
+                if not name.endswith(self.suffix):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def prune(self, max_size=None, max_age=None):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        removed = 0
+        for path, size, mtime in entries:
+            expired = max_age is not None and now - mtime > max_age
+            if not expired and (max_size is None or total <= max_size):
+                continue
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+
+register_backend('file', lambda url, max_size=None: LocalDirectoryStore(
+    url[len('file://'):], max_size=max_size))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m nbval.store', description='Manage an nbval result store.')
+    commands = parser.add_subparsers(dest='command')
+    prune = commands.add_parser('prune', help='remove old entries')
+    prune.add_argument('store', help='directory or URL of the store')
+    prune.add_argument('--max-size', type=parse_size,
+                       help='size to prune the store down to, e.g. 500M or 2G')
+    prune.add_argument('--max-age', type=float,
+                       help='remove entries unused for this many days')
+    args = parser.parse_args(argv)
+    if args.command != 'prune':
+        parser.print_help()
+        return 2
+    store = open_store(args.store)
+    max_age = args.max_age * 86400 if args.max_age is not None else None
+    removed = store.prune(max_size=args.max_size, max_age=max_age)
+    print('Removed %d entries' % removed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+"""
+Normalization of the text of stream outputs.
+
+Progress bars redraw their line by writing a carriage return and the new
+text, so a cell showing one may send tens of thousands of updates of
+which only the last one is visible. :class:`StreamNormalizer` is fed the
+text of a stream chunk by chunk, e.g. as messages arrive, and only keeps
+what is left of each line once the carriage returns are applied.
+
+With a budget, only the start and end of a stream's text are kept once
+it grows past the budget, with a digest of all of it to compare it by.
+"""
+
+import hashlib
+from collections import deque
+
+
+def text_digest(text):
+    """Return the SHA-256 digest of a text, as compared for truncated outputs."""
+    return hashlib.sha256(text.encode('utf8')).hexdigest()
+
+
+class TruncatedText(str):
+    """
+    The start and end of the text of a stream output that was too long to
+    keep, with the ``size`` (in characters) and the ``digest`` of the
+    sanitized text of all of it.
+    """
+    def __new__(cls, text, size, digest):
+        self = super(TruncatedText, cls).__new__(cls, text)
+        self.size = size
+        self.digest = digest
+        return self
+
+    @classmethod
+    def from_output(cls, output):
+        """Return the text of a stream output, as a TruncatedText if it was truncated."""
+        truncated = output.get('truncated')
+        if truncated is None:
+            return output.text
+        return cls(output.text, truncated['size'], truncated['digest'])
+
+    def matches(self, text):
+        """Return whether ``text``, sanitized, is the text this was truncated from."""
+        return text_digest(text) == self.digest
+
+
+class StreamNormalizer(object):
+    """
+    Joins the chunks of text of one stream, dropping the text of each line
+    up to its last carriage return that more text of the line follows.
+
+    Carriage returns at the end of a line, or of the text, are kept, and
+    backspaces are left as they are. Each chunk is only looked at once,
+    so normalizing a stream takes time linear in its length.
+
+    If ``budget`` is given, once the text is longer than that many
+    characters only its first and last half a budget of characters are
+    kept, and the SHA-256 digest of the whole text is computed on the
+    fly, with each line passed through ``sanitize`` first. The current
+    line is always kept whole until it ends.
+    """
+    def __init__(self, budget=None, sanitize=None):
+        self.budget = budget
+        self.sanitize = sanitize
+        # Chunks of the complete lines, with their newlines, within the budget
+        self._lines = []
+        # Characters in the complete lines
+        self._size = 0
+        # Once over the budget: the start of the text, and its latest lines
+        self._head = None
+        self._tail = deque()
+        self._tail_size = 0
+        self._digest = hashlib.sha256() if budget is not None else None
+        # Chunks of the current line, after its last carriage return
+        self._line = []
+        # Whether the current line ends with a carriage return
+        self._return = False
+
+    def feed(self, text):
+        """Add the next chunk of text of the stream."""
+        *complete, last = text.split('\n')
+        for segment in complete:
+            self._add(segment)
+            if self.budget is None:
+                self._lines.extend(self._line)
+                self._lines.append('\n')
+            else:
+                self._add_line(''.join(self._line))
+            self._line = []
+            self._return = False
+        self._add(last)
+
+    def _add(self, segment):
+        # Add text without newlines to the current line
+        if not segment:
+            return
+        # Text after a carriage return overwrites the line
+        start = segment.rfind('\r', 0, len(segment) - 1) + 1
+        if self._return or start:
+            self._line = []
+        self._line.append(segment[start:])
+        self._return = segment.endswith('\r')
+
+    def _add_line(self, line):
+        # Add a complete line, without its newline, within the budget
+        self._digest.update(self._sanitized(line).encode('utf8') + b'\n')
+        line += '\n'
+        self._size += len(line)
+        if self._head is None:
+            self._lines.append(line)
+            if self._size <= self.budget:
+                return
+            text = ''.join(self._lines)
+            self._lines = []
+            self._head = text[:self.budget // 2]
+            line = text[self.budget // 2:]
+        self._tail.append(line)
+        self._tail_size += len(line)
+        keep = self.budget - self.budget // 2
+        while self._tail_size - len(self._tail[0]) >= keep:
+            self._tail_size -= len(self._tail.popleft())
+
+    def _sanitized(self, line):
+        return self.sanitize(line) if self.sanitize is not None else line
+
+    def getvalue(self):
+        """
+        Return the normalized text fed so far, as a :class:`TruncatedText`
+        if it is longer than the budget.
+        """
+        current = ''.join(self._line)
+        size = self._size + len(current)
+        if self.budget is None or size <= self.budget:
+            return ''.join(self._lines) + current
+        keep = self.budget - self.budget // 2
+        if self._head is None:
+            text = ''.join(self._lines) + current
+            head, tail = text[:self.budget // 2], text[-keep:]
+        else:
+            head = self._head
+            tail = (''.join(self._tail) + current)[-keep:]
+        digest = self._digest.copy()
+        digest.update(self._sanitized(current).encode('utf8'))
+        marker = '\n[... %d characters truncated ...]\n' % (size - len(head) - len(tail))
+        return TruncatedText(head + marker + tail, size, digest.hexdigest())
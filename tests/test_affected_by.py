@@ -0,0 +1,69 @@
+import os
+import subprocess
+
+import nbformat
+import pytest
+
+from nbval.impact import changed_files
+from utils import build_nb
+
+pytest_plugins = "pytester"
+
+
+def write_notebooks(testdir):
+    notebooks = {
+        'test_import': ["import mylib", "mylib.x"],
+        'test_open': ["open('data.txt').read()"],
+        'test_none': ["y = 1"],
+    }
+    for name, sources in notebooks.items():
+        nbformat.write(build_nb(sources), os.path.join(str(testdir.tmpdir), name + '.ipynb'))
+    testdir.makepyfile(mylib="x = 1")
+    testdir.makefile('.txt', data='a', other='b')
+
+
+def test_changed_files(tmpdir):
+    root = str(tmpdir)
+    assert changed_files('a.py, sub/b.py', root) == {
+        os.path.join(root, 'a.py'), os.path.join(root, 'sub', 'b.py')}
+
+
+def test_affected_by(testdir):
+    write_notebooks(testdir)
+    args = ('--nbval', '--nbval-current-env', '-v')
+
+    result = testdir.runpytest_subprocess(*(args + ('--nbval-record-dependencies',)))
+    result.assert_outcomes(passed=4)
+
+    result = testdir.runpytest_subprocess(*(args + ('--nbval-affected-by', 'mylib.py')))
+    result.assert_outcomes(passed=2)
+    result.stdout.fnmatch_lines(['*test_import*Cell 1 PASSED*', '*2 deselected*'])
+
+    result = testdir.runpytest_subprocess(*(args + ('--nbval-affected-by', 'data.txt')))
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines(['*test_open*Cell 1 PASSED*'])
+
+    # Changed notebooks are run, whatever their dependencies
+    result = testdir.runpytest_subprocess(
+        *(args + ('--nbval-affected-by', 'other.txt,test_none.ipynb')))
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines(['*test_none*Cell 1 PASSED*'])
+
+
+def test_affected_by_git_ref(testdir):
+    write_notebooks(testdir)
+    git = ['git', '-c', 'user.name=nbval', '-c', 'user.email=nbval@example.com']
+    try:
+        subprocess.check_call(git + ['init', '-q', '.'], cwd=str(testdir.tmpdir))
+    except (OSError, subprocess.CalledProcessError):
+        pytest.skip('git is not available')
+    subprocess.check_call(git + ['add', '.'], cwd=str(testdir.tmpdir))
+    subprocess.check_call(git + ['commit', '-q', '-m', 'initial'], cwd=str(testdir.tmpdir))
+
+    args = ('--nbval', '--nbval-current-env', '-v')
+    result = testdir.runpytest_subprocess(*(args + ('--nbval-record-dependencies',)))
+    result.assert_outcomes(passed=4)
+
+    testdir.makepyfile(mylib="x = 2")
+    result = testdir.runpytest_subprocess(*(args + ('--nbval-affected-by', 'HEAD')))
+    result.stdout.fnmatch_lines(['*test_import*Cell 1 PASSED*', '*2 deselected*'])
@@ -0,0 +1,43 @@
+import os
+
+import nbformat
+
+from utils import build_nb, add_expected_plaintext_outputs
+
+pytest_plugins = "pytester"
+
+
+def test_changed_only(testdir):
+    nb = build_nb(["x = 1", "open('data.txt').read()"], mark_run=True)
+    add_expected_plaintext_outputs(nb, [None, "'a'"])
+    nb.metadata['nbval'] = {'depends': ['data.txt']}
+    nbformat.write(nb, os.path.join(str(testdir.tmpdir), 'test_a.ipynb'))
+    nbformat.write(build_nb(["y = 2"]), os.path.join(str(testdir.tmpdir), 'test_b.ipynb'))
+    testdir.makefile('.txt', data='a')
+    testdir.makefile('.txt', shared='1')
+    args = ('--nbval', '--nbval-current-env', '--nbval-changed-only',
+            '--nbval-depends', 'shared.txt', '-rs')
+
+    result = testdir.runpytest_subprocess(*args)
+    result.assert_outcomes(passed=3)
+    result = testdir.runpytest_subprocess(*args)
+    result.assert_outcomes(skipped=3)
+    result.stdout.fnmatch_lines(['*nbval: unchanged since it last passed*'])
+
+    # A notebook's own dependencies only affect that notebook
+    testdir.makefile('.txt', data='b')
+    result = testdir.runpytest_subprocess(*args)
+    result.assert_outcomes(failed=1, passed=1, skipped=1)
+    # Failed notebooks are run again
+    result = testdir.runpytest_subprocess(*args)
+    result.assert_outcomes(failed=1, passed=1, skipped=1)
+    testdir.makefile('.txt', data='a')
+    result = testdir.runpytest_subprocess(*args)
+    result.assert_outcomes(passed=2, skipped=1)
+
+    testdir.makefile('.txt', shared='2')
+    result = testdir.runpytest_subprocess(*args)
+    result.assert_outcomes(passed=3)
+
+    result = testdir.runpytest_subprocess(*(args + ('--nbval-force',)))
+    result.assert_outcomes(passed=3)
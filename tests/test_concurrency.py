@@ -0,0 +1,79 @@
+import os
+
+import nbformat
+import pytest
+
+from utils import build_nb
+
+pytest_plugins = "pytester"
+
+
+def test_concurrent_notebooks(testdir):
+    for i in range(4):
+        nb = build_nb([
+            "import time\nx = %d" % i,
+            "time.sleep(1)\nprint(x)",
+            "x * 2",
+        ], mark_run=True)
+        nb.cells[1].outputs.append(nbformat.v4.new_output('stream', text=u'%d\n' % i))
+        nb.cells[2].outputs.append(nbformat.v4.new_output(
+            'execute_result', data={'text/plain': str(i * 2)}, execution_count=3))
+        nbformat.write(nb, os.path.join(str(testdir.tmpdir), 'test_nb%d.ipynb' % i))
+    nb = build_nb(["raise ValueError('failing')", "print('after')"], mark_run=True)
+    nb.cells[1].outputs.append(nbformat.v4.new_output('stream', text=u'after\n'))
+    nbformat.write(nb, os.path.join(str(testdir.tmpdir), 'test_raises.ipynb'))
+
+    result = testdir.runpytest_subprocess(
+        '--nbval', '--nbval-current-env', '--nbval-concurrency', '3', '-v')
+
+    result.assert_outcomes(passed=13, failed=1)
+    # Cells are still reported in order
+    result.stdout.fnmatch_lines([
+        '*test_nb0*Cell 1 PASSED*',
+        '*test_nb0*Cell 2 PASSED*',
+        '*test_nb0*Cell 3 PASSED*',
+        '*test_nb1*Cell 1 PASSED*',
+        '*test_raises*Cell 1 FAILED*',
+        '*test_raises*Cell 2 PASSED*',
+    ])
+
+
+def test_submission_window(testdir):
+    for i in range(4):
+        nbformat.write(build_nb(["x = %d" % i, "x"]),
+                       os.path.join(str(testdir.tmpdir), 'test_nb%d.ipynb' % i))
+    testdir.makeconftest("""
+        from nbval.plugin import notebook_order_key
+
+        def pytest_runtest_call(item):
+            if item.name == 'Cell 1':
+                order = item.config.stash[notebook_order_key]
+                print('submitted: ' + ''.join(
+                    str(int(nbfile.run is not None)) for nbfile in order))
+    """)
+
+    result = testdir.runpytest_subprocess(
+        '--nbval-lax', '--nbval-current-env', '--nbval-concurrency', '1', '-s')
+
+    result.assert_outcomes(passed=8)
+    # Up to two notebooks are submitted, and dropped once they are done
+    result.stdout.fnmatch_lines([
+        '*submitted: 1100*',
+        '*submitted: 0110*',
+        '*submitted: 0011*',
+        '*submitted: 0001*',
+    ])
+
+
+def test_concurrency_xdist(testdir):
+    pytest.importorskip('xdist')
+    for i in range(6):
+        nb = build_nb(["_ = open('runs.txt', 'a').write('%d')" % i])
+        nbformat.write(nb, os.path.join(str(testdir.tmpdir), 'test_nb%d.ipynb' % i))
+
+    result = testdir.runpytest_subprocess(
+        '--nbval-lax', '--nbval-current-env', '--nbval-concurrency', '2', '-n', '2')
+
+    result.assert_outcomes(passed=6)
+    # Workers only run the notebooks scheduled on them
+    assert sorted(testdir.tmpdir.join('runs.txt').read()) == list('012345')
@@ -0,0 +1,42 @@
+import os
+
+import nbformat
+
+from utils import build_nb
+
+pytest_plugins = "pytester"
+
+
+def test_clear_output_and_display_updates(testdir):
+    nb = build_nb([
+        "from IPython.display import display, clear_output\n"
+        "for i in range(100):\n"
+        "    clear_output(wait=True)\n"
+        "    print(i)",
+        "print('gone')\n"
+        "clear_output()\n"
+        "print('kept')",
+        "handle = display('a', display_id=True)\n"
+        "print('x')\n"
+        "handle.update('b')",
+        "_ = display('c', display_id='shared')\n"
+        "_ = display('d', display_id='shared')",
+    ], mark_run=True)
+    new_output = nbformat.v4.new_output
+    nb.cells[0].outputs.append(new_output('stream', text='99\n'))
+    nb.cells[1].outputs.append(new_output('stream', text='kept\n'))
+    nb.cells[2].outputs.extend([
+        new_output('display_data', data={'text/plain': "'b'"}),
+        new_output('stream', text='x\n'),
+    ])
+    # A new output with the display ID of earlier ones updates them too
+    nb.cells[3].outputs.extend([
+        new_output('display_data', data={'text/plain': "'d'"}),
+        new_output('display_data', data={'text/plain': "'d'"}),
+    ])
+    nbformat.write(nb, os.path.join(str(testdir.tmpdir), 'test_a.ipynb'))
+
+    for args in [(), ('--nbval-concurrency', '2')]:
+        result = testdir.runpytest_subprocess('--nbval', '--nbval-current-env', *args)
+        result.assert_outcomes(passed=4)
+        assert 'unhandled iopub msg' not in result.stdout.str()
@@ -0,0 +1,47 @@
+import os
+
+import nbformat
+import pytest
+
+from utils import build_nb
+
+pytest_plugins = "pytester"
+
+
+@pytest.mark.parametrize('use_metadata', [False, True])
+def test_notebook_failfast(testdir, use_metadata):
+    nb = build_nb([
+        "a = 1",
+        "raise ValueError('boom')",
+        "_ = open('ran.txt', 'w').write('ran')",
+        "b = 2",
+    ])
+    nbformat.write(nb, os.path.join(str(testdir.tmpdir), 'test_a.ipynb'))
+    nbformat.write(build_nb(["c = 3"]), os.path.join(str(testdir.tmpdir), 'test_b.ipynb'))
+
+    result = testdir.runpytest_subprocess('--nbval', '--nbval-current-env')
+    result.assert_outcomes(failed=1, passed=4)
+    assert testdir.tmpdir.join('ran.txt').check()
+    testdir.tmpdir.join('ran.txt').remove()
+
+    if use_metadata:
+        nb.metadata['nbval'] = {'failfast': True}
+        nbformat.write(nb, os.path.join(str(testdir.tmpdir), 'test_a.ipynb'))
+        args = ()
+    else:
+        args = ('--nbval-notebook-failfast',)
+    result = testdir.runpytest_subprocess('--nbval', '--nbval-current-env', '-rs', *args)
+    # The other notebooks still run
+    result.assert_outcomes(failed=1, passed=2, skipped=2)
+    result.stdout.fnmatch_lines(['*nbval: a previous cell of the notebook failed*'])
+    assert not testdir.tmpdir.join('ran.txt').check()
+
+
+def test_notebook_failfast_disabled_by_metadata(testdir):
+    nb = build_nb(["raise ValueError('boom')", "a = 1"])
+    nb.metadata['nbval'] = {'failfast': False}
+    nbformat.write(nb, os.path.join(str(testdir.tmpdir), 'test_a.ipynb'))
+
+    result = testdir.runpytest_subprocess(
+        '--nbval', '--nbval-current-env', '--nbval-notebook-failfast')
+    result.assert_outcomes(failed=1, passed=1)
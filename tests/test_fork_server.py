@@ -0,0 +1,52 @@
+import os
+import threading
+
+import nbformat
+import pytest
+
+from nbval.forkserver import fork_safety_problems
+from utils import build_nb
+
+pytest_plugins = "pytester"
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires os.fork()')
+def test_fork_server_preloads(testdir):
+    nb = build_nb([
+        "import sys\nprint('xml.dom.minidom' in sys.modules)",
+        "import os\nprint(os.path.basename(os.getcwd()))",
+    ], mark_run=True)
+    nb.cells[0].outputs.append(nbformat.v4.new_output('stream', text=u'True\n'))
+    nb.cells[1].outputs.append(nbformat.v4.new_output(
+        'stream', text=os.path.basename(str(testdir.tmpdir)) + '\n'))
+    nbformat.write(nb, os.path.join(str(testdir.tmpdir), 'test_fork.ipynb'))
+
+    result = testdir.runpytest_subprocess(
+        '--nbval', '--nbval-current-env', '--nbval-fork-server',
+        '--nbval-preload', 'xml.dom.minidom')
+
+    result.assert_outcomes(passed=2)
+    assert 'Fork server unavailable' not in result.stdout.str()
+
+
+def test_fork_server_fallback(testdir):
+    nbformat.write(build_nb(["a = 1"]), os.path.join(str(testdir.tmpdir), 'test_fork.ipynb'))
+
+    result = testdir.runpytest_subprocess(
+        '--nbval', '--nbval-current-env', '--nbval-fork-server',
+        '--nbval-preload', 'no_such_module_for_nbval')
+
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines(['*Fork server unavailable*no_such_module_for_nbval*'])
+
+
+def test_fork_safety_threads():
+    stop = threading.Event()
+    thread = threading.Thread(target=stop.wait)
+    thread.start()
+    try:
+        problems = fork_safety_problems()
+    finally:
+        stop.set()
+        thread.join()
+    assert any('threads are running' in problem for problem in problems)
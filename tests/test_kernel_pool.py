@@ -0,0 +1,119 @@
+import os
+
+import nbformat
+
+from nbval.kernel import KernelPool
+from utils import build_nb
+
+pytest_plugins = "pytester"
+
+
+class FakeKernel(object):
+    reset_ok = True
+
+    def __init__(self, kernel_name, cwd=None):
+        self.key = (kernel_name, cwd)
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+    def save_state(self):
+        return True
+
+    def reset(self):
+        return self.reset_ok
+
+    def stop(self):
+        self.alive = False
+
+
+def test_pool_hits_and_misses():
+    pool = KernelPool(FakeKernel, size=2)
+    try:
+        first = pool.acquire(('python3', 'a'))
+        assert first.key == ('python3', 'a')
+        assert (pool.hits, pool.misses) == (0, 1)
+
+        pool.prefetch([('python3', 'a'), ('python3', 'b')])
+        assert pool.acquire(('python3', 'b')).key == ('python3', 'b')
+        assert pool.acquire(('python3', 'a')).key == ('python3', 'a')
+        assert (pool.hits, pool.misses) == (2, 1)
+
+        # Nothing left in the pool:
+        pool.acquire(('python3', 'a'))
+        assert (pool.hits, pool.misses) == (2, 2)
+    finally:
+        pool.shutdown()
+
+
+def test_pool_max_idle():
+    started = []
+
+    def factory(kernel_name, cwd=None):
+        kernel = FakeKernel(kernel_name, cwd=cwd)
+        started.append(kernel)
+        return kernel
+
+    pool = KernelPool(factory, size=3, max_idle=1)
+    pool.prefetch([('python3', 'a'), ('python3', 'b'), ('python3', 'c')])
+    # Kernels not wanted by the next prefetch are evicted to make room
+    pool.prefetch([('python3', 'c')])
+    kernel = pool.acquire(('python3', 'c'))
+    pool.shutdown()
+
+    assert pool.hits == 1
+    # 'a' may have been cancelled before it started, 'b' never fit in the pool
+    assert 'b' not in [k.key[1] for k in started]
+    assert [k for k in started if k.is_alive()] == [kernel]
+
+
+def test_pool_reuse():
+    pool = KernelPool(FakeKernel, size=0, reuse=True)
+    try:
+        kernel = pool.acquire(('python3', 'a'))
+        pool.release(('python3', 'a'), kernel)
+        assert pool.acquire(('python3', 'a')) is kernel
+        assert pool.reused == 1
+
+        # Notebooks opting out of reuse get a kernel of their own
+        pool.release(('python3', 'a'), kernel)
+        assert pool.acquire(('python3', 'a'), fresh=True) is not kernel
+        assert pool.acquire(('python3', 'a')) is kernel
+        assert (pool.hits, pool.misses, pool.reused) == (2, 2, 2)
+
+        # An incomplete reset replaces the kernel with a fresh one
+        kernel.reset_ok = False
+        pool.release(('python3', 'a'), kernel)
+        replacement = pool.acquire(('python3', 'a'))
+        assert replacement is not kernel and replacement.is_alive()
+        assert not kernel.is_alive()
+        assert (pool.hits, pool.misses, pool.reused) == (3, 2, 2)
+    finally:
+        pool.shutdown()
+
+
+def test_kernel_pool_run(testdir):
+    for name in ('first', 'second', 'third'):
+        nb = build_nb(["a = 1", "print(a + 1)"], mark_run=True)
+        nb.cells[1].outputs.append(nbformat.v4.new_output('stream', text=u'2\n'))
+        nbformat.write(nb, os.path.join(str(testdir.tmpdir), '%s.ipynb' % name))
+
+    result = testdir.runpytest_subprocess(
+        '--nbval', '--nbval-current-env', '--nbval-kernel-pool', '1')
+
+    result.assert_outcomes(passed=6)
+    result.stdout.fnmatch_lines(['*3 kernels acquired: 2 pool hits, 1 misses*'])
+
+
+def test_kernel_pool_no_prefetch_on_xdist_worker(testdir):
+    for name in ('first', 'second', 'third'):
+        nbformat.write(build_nb(["a = 1"]), os.path.join(str(testdir.tmpdir), '%s.ipynb' % name))
+
+    items, _ = testdir.inline_genitems('--nbval', '--nbval-current-env', '--nbval-kernel-pool', '2')
+    nbfile = items[0].parent
+    assert [key[1] for key in nbfile.upcoming_kernel_keys(2)] == [str(testdir.tmpdir)] * 2
+
+    # Other workers may run the next notebooks
+    nbfile.config.workerinput = {'workerid': 'gw0'}
+    assert nbfile.upcoming_kernel_keys(2) == []
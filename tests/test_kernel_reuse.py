@@ -0,0 +1,87 @@
+import os
+
+import nbformat
+
+from utils import build_nb
+
+pytest_plugins = "pytester"
+
+
+def _write_nb(testdir, name, sources, outputs, metadata=None):
+    nb = build_nb(sources, mark_run=True)
+    for cell, text in zip(nb.cells, outputs):
+        if text is not None:
+            cell.outputs.append(nbformat.v4.new_output('stream', text=text))
+    nb.metadata.update(metadata or {})
+    nbformat.write(nb, os.path.join(str(testdir.tmpdir), name))
+
+
+def test_reuse_kernel_resets_state(testdir):
+    testdir.makepyfile(lib="value = 1")
+    os.mkdir(os.path.join(str(testdir.tmpdir), 'subdir'))
+    state_sources = [
+        "import os, sys\nprint(os.path.basename(os.getcwd()))",
+        "print('x' in globals(), 'lib' in sys.modules)",
+        "import lib\nx = lib.value\nos.chdir('subdir')\nprint(x)",
+    ]
+    state_outputs = [os.path.basename(str(testdir.tmpdir)) + '\n', 'False False\n', '1\n']
+    _write_nb(testdir, 'a.ipynb', state_sources, state_outputs)
+    _write_nb(testdir, 'b.ipynb', state_sources, state_outputs)
+
+    result = testdir.runpytest_subprocess(
+        '--nbval', '--nbval-current-env', '--nbval-reuse-kernel', '-p', 'no:python')
+
+    result.assert_outcomes(passed=6)
+    result.stdout.fnmatch_lines(['*2 kernels acquired: 1 pool hits, 1 misses*', '*1 kernels reused*'])
+
+
+def test_reuse_kernel_leaked_thread(testdir):
+    # A thread left running can't be reset, so the kernel is replaced by a new one
+    _write_nb(testdir, 'a.ipynb', [
+        "import threading, time\n"
+        "threading.Thread(target=time.sleep, args=(30,), daemon=True).start()"], [None])
+    _write_nb(testdir, 'b.ipynb', ["x = 1"], [None])
+    _write_nb(testdir, 'c.ipynb', ["x = 1"], [None])
+
+    result = testdir.runpytest_subprocess(
+        '--nbval', '--nbval-current-env', '--nbval-reuse-kernel', '-p', 'no:python')
+
+    result.assert_outcomes(passed=3)
+    result.stdout.fnmatch_lines(['*3 kernels acquired: 2 pool hits, 1 misses*', '*1 kernels reused*'])
+
+
+def test_reuse_kernel_opt_out(testdir):
+    _write_nb(testdir, 'a.ipynb', ["x = 1"], [None],
+              metadata={'nbval': {'reuse_kernel': False}})
+    _write_nb(testdir, 'b.ipynb', ["x = 1"], [None])
+
+    result = testdir.runpytest_subprocess(
+        '--nbval', '--nbval-current-env', '--nbval-reuse-kernel', '-p', 'no:python')
+
+    result.assert_outcomes(passed=2)
+    result.stdout.fnmatch_lines(['*2 kernels acquired: 0 pool hits, 2 misses*'])
+
+
+def test_reuse_kernel_opt_out_after_reused(testdir):
+    _write_nb(testdir, 'a.ipynb', ["import sys\nsys.modules['json'].leak = 1"], [None])
+    _write_nb(testdir, 'b.ipynb', ["import json\nprint(hasattr(json, 'leak'))"], ['False\n'],
+              metadata={'nbval': {'reuse_kernel': False}})
+
+    result = testdir.runpytest_subprocess(
+        '--nbval', '--nbval-current-env', '--nbval-reuse-kernel', '-p', 'no:python')
+
+    # b doesn't get the kernel a was reset in
+    result.assert_outcomes(passed=2)
+    result.stdout.fnmatch_lines(['*2 kernels acquired: 0 pool hits, 2 misses*'])
+
+
+def test_reuse_kernel_restores_warning_filters(testdir):
+    _write_nb(testdir, 'a.ipynb', ["import warnings\nwarnings.simplefilter('error')"], [None])
+    _write_nb(testdir, 'b.ipynb', ["import warnings\nwarnings.warn('careful')"], [None])
+
+    result = testdir.runpytest_subprocess(
+        '--nbval-lax', '--nbval-current-env', '--nbval-reuse-kernel', '-p', 'no:python')
+
+    # The warning isn't turned into an error in b
+    result.assert_outcomes(passed=2)
+    result.stdout.fnmatch_lines(['*1 kernels reused*'])
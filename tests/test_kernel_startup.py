@@ -0,0 +1,39 @@
+import os
+
+from nbval.kernel import RunningKernel, CURRENT_ENV_KERNEL_NAME
+from utils import build_nb
+
+import nbformat
+
+pytest_plugins = "pytester"
+
+
+def test_startup_timings():
+    kernel = RunningKernel(CURRENT_ENV_KERNEL_NAME)
+    try:
+        timings = kernel.startup_timings
+        assert set(timings) == {'spawn', 'connect', 'shell_ready', 'iopub_ready'}
+        assert 0 < timings['spawn'] <= timings['connect'] <= timings['shell_ready']
+        assert timings['connect'] <= timings['iopub_ready']
+
+        # IOPub is up, so the output of the first execution is not lost
+        msg_id = kernel.execute_cell_input("print('hello')", allow_stdin=False)
+        kernel.await_reply(msg_id, timeout=10)
+        while True:
+            msg = kernel.get_message('iopub', timeout=5)
+            if msg['parent_header'].get('msg_id') == msg_id and msg['msg_type'] == 'stream':
+                break
+        assert msg['content']['text'] == 'hello\n'
+    finally:
+        kernel.stop()
+
+
+def test_startup_summary(testdir):
+    nbformat.write(build_nb(["a = 1"]), os.path.join(str(testdir.tmpdir), 'test_startup.ipynb'))
+
+    result = testdir.runpytest_subprocess('--nbval', '--nbval-current-env', '-v')
+
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines([
+        '*mean of 1 kernels: spawn after *s, connect after *s, '
+        'shell ready after *s, iopub ready after *s'])
@@ -0,0 +1,32 @@
+import os
+
+import nbformat
+
+from utils import build_nb
+
+pytest_plugins = "pytester"
+
+
+def test_output_budget(testdir):
+    nb = build_nb([
+        "import time\n"
+        "for i in range(2000):\n"
+        "    print('line', i, time.time())",
+    ], mark_run=True)
+    text = ''.join('line %d 1700000000.%d\n' % (i, i) for i in range(2000))
+    nb.cells[0].outputs.append(nbformat.v4.new_output('stream', text=text))
+    nbformat.write(nb, os.path.join(str(testdir.tmpdir), 'test_a.ipynb'))
+    testdir.makefile('.cfg', sanitize='[time]\nregex: \\d+\\.\\d+\nreplace: TIME\n')
+    args = ('--nbval', '--nbval-current-env', '--nbval-sanitize-with', 'sanitize.cfg',
+            '--nbval-output-budget', '1K')
+
+    result = testdir.runpytest_subprocess(*args)
+    result.assert_outcomes(passed=1)
+
+    nb.cells[0].outputs[0].text = text.replace('line 1000 ', 'line 1001 ')
+    nbformat.write(nb, os.path.join(str(testdir.tmpdir), 'test_a.ipynb'))
+    result = testdir.runpytest_subprocess(*args)
+    result.assert_outcomes(failed=1)
+    result.stdout.fnmatch_lines([
+        '*output "stdout" of * characters was truncated to its start and end*'])
+    result.stdout.fnmatch_lines(['*characters truncated ...*'])
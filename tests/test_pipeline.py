@@ -0,0 +1,108 @@
+import os
+
+import nbformat
+import pytest
+import zmq
+from jupyter_client.session import Session
+
+from nbval.engine import NotebookEngine
+from nbval.kernel import RunningKernel, CURRENT_ENV_KERNEL_NAME, recv_message
+from utils import build_nb
+
+pytest_plugins = "pytester"
+
+
+def test_pipelined_outputs(testdir):
+    # Outputs of cells sent ahead of time must end up with their own cell
+    sources = ["import sys\nx = 0"]
+    for i in range(1, 30):
+        sources.append("x += 1\nprint(x)\nprint('err', x, file=sys.stderr)\nx")
+    sources.append("# NBVAL_RAISES_EXCEPTION\n# NBVAL_IGNORE_OUTPUT\nraise ValueError(x)")
+    sources.append("print('after error')")
+    nb = build_nb(sources, mark_run=True)
+    for i, cell in enumerate(nb.cells[1:-2], start=1):
+        cell.outputs.append(nbformat.v4.new_output('stream', text=u'%d\n' % i))
+        cell.outputs.append(nbformat.v4.new_output('stream', name='stderr', text=u'err %d\n' % i))
+        cell.outputs.append(nbformat.v4.new_output(
+            'execute_result', data={'text/plain': str(i)}, execution_count=i))
+    nb.cells[-1].outputs.append(nbformat.v4.new_output('stream', text=u'after error\n'))
+    nbformat.write(nb, os.path.join(str(testdir.tmpdir), 'test_pipeline.ipynb'))
+
+    result = testdir.runpytest_subprocess(
+        '--nbval', '--nbval-current-env', '--nbval-pipeline-depth', '1000')
+
+    result.assert_outcomes(passed=32)
+
+
+def test_outputs_while_running():
+    kernel = RunningKernel(CURRENT_ENV_KERNEL_NAME)
+    engine = NotebookEngine(kernel)
+    try:
+        source = (
+            "import sys, time\n"
+            "for i in range(200):\n"
+            "    print(i, flush=True)\n"
+            "    print('err', i, file=sys.stderr, flush=True)\n"
+            "    time.sleep(0.005)\n"
+            "time.sleep(1)\n")
+        result = engine.submit('cell', source)
+        # Outputs are handled while the cell is still running
+        assert not result.finished.wait(0.8)
+        assert result.outputs
+        assert engine.result('cell', timeout=10).idle
+        # and stream messages are merged as they arrive
+        assert [out.name for out in result.outputs] == ['stdout', 'stderr']
+        assert result.outputs[0].text == ''.join('%d\n' % i for i in range(200))
+    finally:
+        engine.close()
+        kernel.stop()
+
+
+def test_errors_only():
+    kernel = RunningKernel(CURRENT_ENV_KERNEL_NAME)
+    engine = NotebookEngine(kernel, errors_only={'quiet', 'raises'})
+    try:
+        loud = engine.submit('loud', "print('a')\n1")
+        quiet = engine.submit('quiet', "print('a')\n1")
+        raises = engine.submit('raises', "print('a')\nraise ValueError")
+        assert engine.result('raises', timeout=10).idle
+        assert [out.output_type for out in loud.outputs] == ['stream', 'execute_result']
+        # Only errors are kept for cells whose outputs are not compared
+        assert quiet.outputs == [] and quiet.idle
+        assert [out.output_type for out in raises.outputs] == ['error']
+        assert raises.error['ename'] == 'ValueError'
+    finally:
+        engine.close()
+        kernel.stop()
+
+
+def test_recv_message():
+    context = zmq.Context()
+    sender, receiver = context.socket(zmq.PAIR), context.socket(zmq.PAIR)
+    receiver.bind('inproc://test_recv_message')
+    sender.connect('inproc://test_recv_message')
+    session = Session(key=b'secret')
+    parent = session.msg_header('execute_request')
+    accepted = []
+
+    def accept(parent_id, msg_type):
+        accepted.append((parent_id, msg_type))
+        return msg_type == 'stream'
+
+    try:
+        session.send(sender, 'status', content=dict(execution_state='busy'), parent=parent)
+        assert recv_message(session, receiver, accept) is None
+        session.send(sender, 'stream', content=dict(name='stdout', text='hi'), parent=parent)
+        msg = recv_message(session, receiver, accept)
+        assert msg['content'] == dict(name='stdout', text='hi')
+        assert msg['parent_header']['msg_id'] == parent['msg_id']
+        assert accepted == [(parent['msg_id'], 'status'), (parent['msg_id'], 'stream')]
+
+        # Accepted messages must still be signed with our key
+        Session(key=b'other').send(sender, 'stream', content={}, parent=parent)
+        with pytest.raises(ValueError):
+            recv_message(session, receiver, accept)
+    finally:
+        sender.close()
+        receiver.close()
+        context.term()
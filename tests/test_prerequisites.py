@@ -0,0 +1,95 @@
+import os
+
+import nbformat
+
+from nbval.dataflow import CellNames, prerequisites
+from utils import build_nb, add_expected_plaintext_outputs
+
+pytest_plugins = "pytester"
+
+
+def test_cell_names():
+    cell = CellNames("import numpy as np\nx = np.zeros(3)\nx[0] += y\nlst.append(x)")
+    assert cell.defines == {'np', 'x'}
+    assert cell.mutates == {'x', 'lst'}
+    assert cell.uses == {'np', 'x', 'y', 'lst'}
+    assert not cell.opaque
+    assert CellNames("def f():\n    z = 1\n    return w").defines == {'f'}
+    assert CellNames("%matplotlib inline").opaque
+    assert CellNames("from os import *").opaque
+    assert CellNames("x = (").opaque
+
+
+def test_prerequisites():
+    sources = [
+        "import math",        # 0
+        "x = 1",              # 1
+        "y = 2",              # 2
+        "def f(a):\n    return math.sqrt(a) + x",  # 3
+        "total = 0",          # 4
+        "for i in range(3):\n    total += i",  # 5
+        "x = 5",              # 6
+        "z = f(total)",       # 7
+    ]
+    assert prerequisites(sources, [7]) == [0, 3, 4, 5, 6]
+    assert prerequisites(sources, [2]) == []
+    assert prerequisites(sources, [3, 5]) == [4]
+
+
+def test_prerequisites_function_effects():
+    # Globals bound by a called function
+    counter = ["n = 0", "def inc():\n    global n\n    n += 1", "inc()", "print(n)"]
+    assert prerequisites(counter, [2]) == [0, 1]
+    assert prerequisites(counter, [3]) == [0, 1, 2]
+    # Free names modified by a called function
+    closure = ["items = []", "def add(x):\n    items.append(x)", "add(1)", "y = 2", "items"]
+    assert prerequisites(closure, [4]) == [0, 1, 2]
+    # Names passed to a function
+    arguments = ["model = {}", "data = [1]", "train(model, data)", "model"]
+    assert prerequisites(arguments, [3]) == [0, 1, 2]
+    # Modules with hidden state
+    seeded = ["import random", "random.seed(0)", "a = random.random()", "b = random.random()"]
+    assert prerequisites(seeded, [3]) == [0, 1, 2]
+
+
+def test_select_cell_calling_function(testdir):
+    nb = build_nb(["n = 0", "def inc():\n    global n\n    n += 1", "inc()", "print(n)"],
+                  mark_run=True)
+    nb.cells[3].outputs.append(nbformat.v4.new_output('stream', text=u'1\n'))
+    nbformat.write(nb, os.path.join(str(testdir.tmpdir), 'counter.ipynb'))
+
+    # Each cell runs after all the cells before it
+    for cell_num in (3, 4):
+        result = testdir.runpytest(
+            '--nbval', '--nbval-current-env', 'counter.ipynb::Cell %d' % cell_num)
+        result.assert_outcomes(passed=cell_num)
+
+
+def test_select_cell(testdir):
+    nb = build_nb([
+        "_ = open('runs.txt', 'a').write('1')",
+        "x = 1",
+        "y = 2",
+        "x + y",
+        "y * 10",
+    ], mark_run=True)
+    # The output of the prerequisite cell 4 is wrong, but not checked
+    add_expected_plaintext_outputs(nb, [None, None, None, '4', '20'])
+    nbformat.write(nb, os.path.join(str(testdir.tmpdir), 'test_a.ipynb'))
+
+    result = testdir.runpytest('--nbval', '--nbval-current-env', '-v', '-k', '5')
+    result.assert_outcomes(passed=2)
+    result.stdout.fnmatch_lines(['*Cell 3 PASSED*', '*Cell 5 PASSED*'])
+    assert not testdir.tmpdir.join('runs.txt').exists()
+
+    result = testdir.runpytest('--nbval', '--nbval-current-env', '-k', '4')
+    result.assert_outcomes(passed=2, failed=1)
+
+    # With --lf, only the failed cell and its prerequisites run again
+    result = testdir.runpytest('--nbval', '--nbval-current-env', '-v', '--lf')
+    result.assert_outcomes(passed=2, failed=1)
+    result.stdout.fnmatch_lines(['*Cell 2 PASSED*', '*Cell 3 PASSED*', '*Cell 4 FAILED*'])
+
+    result = testdir.runpytest(
+        '--nbval', '--nbval-current-env', '-k', '5', '--nbval-no-prerequisites')
+    result.assert_outcomes(failed=1)
@@ -0,0 +1,65 @@
+import os
+import re
+
+import nbformat
+import pytest
+
+from nbval.plugin import get_sanitize_patterns
+from nbval.sanitize import Sanitizer, required_literal
+from utils import build_nb, add_expected_plaintext_outputs
+
+pytest_plugins = "pytester"
+
+
+@pytest.mark.parametrize('pattern, literal', [
+    ('foo', 'foo'),
+    ('[a-z]*', ''),
+    ('ab?c', 'a'),
+    ('x{2}yz', 'yz'),
+    (r'(<[a-z]+ at )(0x[0-9a-f]+)(>)', ' at '),
+    (r'\d+\.\d+ seconds', ' seconds'),
+    ('a|bc', ''),
+    ('(?i)abc', ''),
+    ('(?i:abc)d', 'd'),
+    ('(', ''),
+])
+def test_required_literal(pattern, literal):
+    assert required_literal(pattern) == literal
+
+
+def test_sanitizer_matches_re_sub():
+    here = os.path.dirname(__file__)
+    with open(os.path.join(here, 'sanitize_defaults.cfg'), encoding='utf8') as f:
+        patterns = get_sanitize_patterns(f.read())
+    patterns += [('[a-z]*', 'X'), ('at ', 'near ')]
+    strings = [
+        '',
+        'Started 2020-01-02 at 12:34:56',
+        '<Figure size 640x480 with 1 Axes>',
+        '<object object at 0x7f00deadbeef>',
+        'nothing to see',
+    ]
+    sanitizer = Sanitizer(patterns)
+    for s in strings:
+        expected = s
+        for regex, replace in patterns:
+            expected = re.sub(regex, replace, expected)
+        assert sanitizer(s) == expected
+
+    stats = {stats['pattern']: stats for stats in sanitizer.stats}
+    figure = stats[r'(Figure size )\d+x\d+( with \d+ Axes)']
+    assert figure['calls'] == 1 and figure['hits'] == 1
+    assert figure['skipped'] == len(strings) - 1
+    assert stats['[a-z]*']['skipped'] == 0
+
+
+def test_sanitize_stats(testdir):
+    nb = build_nb(["'id 123'"], mark_run=True)
+    add_expected_plaintext_outputs(nb, ["'id 456'"])
+    nbformat.write(nb, os.path.join(str(testdir.tmpdir), 'test_a.ipynb'))
+    testdir.makefile('.cfg', sanitize='[ids]\nregex: id \\d+\nreplace: ID\n')
+
+    result = testdir.runpytest_subprocess(
+        '--nbval', '--nbval-current-env', '--nbval-sanitize-with', 'sanitize.cfg', '-v')
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines(['*nbval sanitize patterns*', '*s 2 hits, 2 applied, 0 skipped: id \\d+'])
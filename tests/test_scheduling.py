@@ -0,0 +1,140 @@
+import json
+import os
+
+import nbformat
+import pytest
+
+from nbval.history import DurationHistory, notebook_of
+from utils import build_nb
+
+pytest_plugins = "pytester"
+
+
+class FakeCache(object):
+    def __init__(self, values=None):
+        self.values = dict(values or {})
+
+    def get(self, key, default):
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+
+def test_notebook_of():
+    assert notebook_of('dir/a.ipynb::Cell 3') == 'dir/a.ipynb'
+    assert notebook_of('dir/test_a.py::test_b') is None
+    assert notebook_of('dir/a.ipynb') is None
+
+
+def test_history_estimate():
+    history = DurationHistory(FakeCache({
+        DurationHistory.cache_key: {'notebooks': {'a.ipynb': 10.0, 'b.ipynb': 2.0}}}))
+    costs = history.estimate({'a.ipynb': 4, 'b.ipynb': 2, 'new.ipynb': 3})
+    # 12 seconds for 6 cells with history
+    assert costs == {'a.ipynb': 10.0, 'b.ipynb': 2.0, 'new.ipynb': 6.0}
+    assert DurationHistory().estimate({'a.ipynb': 2}) == {'a.ipynb': 2.0}
+    # Large files without history count as more items
+    sizes = {'new.ipynb': 2 * DurationHistory.bytes_per_item}
+    costs = history.estimate({'a.ipynb': 4, 'b.ipynb': 2, 'new.ipynb': 3}, sizes)
+    assert costs['new.ipynb'] == 10.0
+
+
+def test_history_skipped_notebooks(testdir):
+    nb = build_nb(["import time", "time.sleep(1)"], mark_run=True)
+    nbformat.write(nb, os.path.join(str(testdir.tmpdir), 'test_a.ipynb'))
+    args = ('--nbval', '--nbval-current-env', '--nbval-changed-only')
+
+    def recorded():
+        path = testdir.tmpdir.join('.pytest_cache', 'v', DurationHistory.cache_key)
+        return json.loads(path.read())['notebooks']
+
+    testdir.runpytest_subprocess(*args).assert_outcomes(passed=2)
+    duration = recorded()['test_a.ipynb']
+    assert duration >= 1
+    # Skipped notebooks keep the duration of their last run
+    testdir.runpytest_subprocess(*args).assert_outcomes(skipped=2)
+    assert recorded()['test_a.ipynb'] == duration
+
+
+def test_scheduler_order(testdir):
+    pytest.importorskip('xdist')
+    from nbval.scheduling import NotebookScheduling
+
+    class FakeNode(object):
+        def send_runtest_some(self, indexes):
+            self.indexes = indexes
+
+    history = DurationHistory(FakeCache({
+        DurationHistory.cache_key: {'notebooks': {'fast.ipynb': 1.0, 'slow.ipynb': 30.0}}}))
+    config = testdir.parseconfig('--tx', '2*popen', '--dist', 'load')
+    sched = NotebookScheduling(config, history=history)
+    collection = ['fast.ipynb::Cell 0', 'fast.ipynb::Cell 1', 'test_a.py::test_a',
+                  'slow.ipynb::Cell 0', 'slow.ipynb::Cell 1']
+    for nodeid in collection:
+        sched.workqueue.setdefault(sched._split_scope(nodeid), {})[nodeid] = False
+    node = FakeNode()
+    sched.registered_collections[node] = collection
+
+    sched._assign_work_unit(node)
+    assert node.indexes == [3, 4]
+    # test_a.py::test_a has no history, so is estimated at 31 / 4 seconds
+    assert list(sched.workqueue) == ['test_a.py::test_a', 'fast.ipynb']
+
+
+@pytest.mark.parametrize('dist, scope', [
+    ('load', 'test_a.py::test_a'),
+    ('loadfile', 'test_a.py'),
+    ('loadscope', 'test_a.py'),
+])
+def test_scheduler_scope(testdir, dist, scope):
+    pytest.importorskip('xdist')
+    from nbval.scheduling import NotebookScheduling
+
+    config = testdir.parseconfig('--tx', '2*popen', '--dist', dist)
+    sched = NotebookScheduling(config)
+    # Only notebook cells are grouped by notebook in every mode
+    assert sched._split_scope('fast.ipynb::Cell 1') == 'fast.ipynb'
+    assert sched._split_scope('test_a.py::test_a') == scope
+
+
+def test_xdist_run(testdir):
+    pytest.importorskip('xdist')
+    for i in range(3):
+        nb = build_nb(["import os\npid = os.getpid()", "assert os.getpid() == pid", "x = %d" % i])
+        nbformat.write(nb, os.path.join(str(testdir.tmpdir), 'test_nb%d.ipynb' % i))
+
+    # The default 'load' distribution would scatter the cells
+    result = testdir.runpytest_subprocess('--nbval', '--nbval-current-env', '-n', '2')
+    result.assert_outcomes(passed=9)
+
+    # Durations are recorded for the next session
+    result = testdir.runpytest_subprocess(
+        '--nbval', '--nbval-current-env', '--cache-show', 'nbval/*')
+    result.stdout.fnmatch_lines(['*test_nb0.ipynb*', '*test_nb2.ipynb*'])
+
+
+def test_durations_and_order(testdir):
+    for name, sleep in (('test_fast', 0), ('test_slow', 1), ('test_medium', 0.5)):
+        nb = build_nb(["import time", "time.sleep(%s)" % sleep], mark_run=True)
+        nbformat.write(nb, os.path.join(str(testdir.tmpdir), '%s.ipynb' % name))
+
+    result = testdir.runpytest_subprocess(
+        '--nbval', '--nbval-current-env', '--nbval-durations', '2')
+    result.assert_outcomes(passed=6)
+    result.stdout.fnmatch_lines([
+        '*nbval slowest 2 notebooks*',
+        '*s test_slow.ipynb',
+        '*s test_medium.ipynb',
+        '*nbval slowest 2 cells*',
+        '*s test_slow.ipynb::Cell 2 (execute *s, drain *s, compare *s)',
+        '*s test_medium.ipynb::Cell 2 (execute *s, drain *s, compare *s)',
+    ])
+
+    result = testdir.runpytest_subprocess(
+        '--nbval', '--nbval-current-env', '--nbval-order', 'slowest-first', '-v')
+    result.stdout.fnmatch_lines([
+        '*test_slow*Cell 1 PASSED*',
+        '*test_medium*Cell 1 PASSED*',
+        '*test_fast*Cell 1 PASSED*',
+    ])
@@ -0,0 +1,54 @@
+import os
+import sys
+
+import nbformat
+import pytest
+
+from nbval.forkserver import ForkServer
+from nbval.kernel import RunningKernel, CURRENT_ENV_KERNEL_NAME, SESSION_PACKERS, session_packer
+from utils import build_nb
+
+pytest_plugins = "pytester"
+
+
+class Spec(object):
+    def __init__(self, argv):
+        self.argv = argv
+
+
+def test_session_packer_fallback():
+    current = Spec([sys.executable, '-m', 'ipykernel_launcher', '-f', '{connection_file}'])
+    other = Spec(['/other/python', '-m', 'ipykernel_launcher', '-f', '{connection_file}'])
+    assert session_packer(None, current) == (None, None)
+    assert session_packer('json', current) == ('json', 'json')
+    # JSON packers are compatible on the wire, so only the client is configured
+    assert session_packer('json', other) == ('json', None)
+    assert session_packer('msgpack', other) == (None, None)
+    if not SESSION_PACKERS['msgpack']:
+        assert session_packer('msgpack', current) == (None, None)
+
+
+@pytest.mark.parametrize('fork', [False, True])
+@pytest.mark.parametrize('packer', [p for p, available in SESSION_PACKERS.items() if available])
+def test_kernel_session_packer(packer, fork):
+    server = ForkServer() if fork else None
+    kernel = RunningKernel(CURRENT_ENV_KERNEL_NAME, fork_server=server, session_packer=packer)
+    try:
+        assert kernel.kc.session.packer == packer
+        reply = kernel.run_silently(
+            'pass', user_expressions={'packer': 'get_ipython().kernel.session.packer'})
+        assert reply['user_expressions']['packer']['data']['text/plain'] == repr(packer)
+    finally:
+        kernel.stop()
+        if server is not None:
+            server.stop()
+
+
+def test_session_packer_run(testdir):
+    nb = build_nb(["print(1)"], mark_run=True)
+    nb.cells[0].outputs.append(nbformat.v4.new_output('stream', text=u'1\n'))
+    nbformat.write(nb, os.path.join(str(testdir.tmpdir), 'test_packer.ipynb'))
+
+    result = testdir.runpytest_subprocess('--nbval', '--nbval-current-env',
+                                          '--nbval-session-packer', 'json')
+    result.assert_outcomes(passed=1)
@@ -0,0 +1,57 @@
+import os
+import random
+
+import nbformat
+import pytest
+
+from nbval.sharding import assign_shards, parse_shard
+from utils import build_nb
+
+pytest_plugins = "pytester"
+
+
+def test_parse_shard():
+    assert parse_shard('1/4') == (0, 4)
+    assert parse_shard('4/4') == (3, 4)
+    for value in ('4', '0/4', '5/4', 'a/b'):
+        with pytest.raises(ValueError):
+            parse_shard(value)
+
+
+def test_assign_shards():
+    rng = random.Random(0)
+    costs = {'nb%d.ipynb' % i: rng.expovariate(1 / 60.) for i in range(100)}
+    shards = assign_shards(costs, 4)
+    assert shards == assign_shards(dict(reversed(list(costs.items()))), 4)
+    loads = [0] * 4
+    for key, shard in shards.items():
+        loads[shard] += costs[key]
+    assert max(loads) <= sum(costs.values()) / 4 * 1.1
+
+    # Adding a notebook only moves a few others
+    costs['new.ipynb'] = 60
+    moved = [key for key, shard in assign_shards(costs, 4).items()
+             if key in shards and shards[key] != shard]
+    assert len(moved) < 20
+
+
+def test_shard_option(testdir):
+    for i in range(4):
+        nb = build_nb(["x = %d" % i, "y = x"])
+        nbformat.write(nb, os.path.join(str(testdir.tmpdir), 'test_nb%d.ipynb' % i))
+    testdir.makepyfile(test_a="def test_a(): pass")
+
+    selected = []
+    for shard in ('1/2', '2/2'):
+        result = testdir.runpytest(
+            '--nbval', '--collect-only', '-q', '--nbval-shard', shard)
+        selected.append(sorted(line for line in result.outlines if '::' in line))
+    assert selected[0] and selected[1]
+    assert not set(selected[0]) & set(selected[1])
+    # Notebooks are not split across shards
+    assert set(line.split('::')[0] for line in selected[0]).isdisjoint(
+        line.split('::')[0] for line in selected[1])
+    assert len(selected[0]) + len(selected[1]) == 9
+
+    result = testdir.runpytest('--nbval', '--nbval-shard', '3/2')
+    result.stderr.fnmatch_lines(['*--nbval-shard: shard 3 is not between 1 and 2*'])
@@ -0,0 +1,82 @@
+import os
+
+import nbformat
+
+from nbval.snapshots import SnapshotDirectory, prefix_hashes
+from utils import build_nb, add_expected_plaintext_outputs
+
+pytest_plugins = "pytester"
+
+
+def test_prefix_hashes():
+    hashes = prefix_hashes('seed', ['a = 1', 'b = 2', 'c = 3'])
+    assert len(set(hashes)) == 3
+    assert prefix_hashes('seed', ['a = 1', 'b = 2', 'x'])[:2] == hashes[:2]
+    assert prefix_hashes('other', ['a = 1'])[0] != hashes[0]
+
+
+def test_prune(tmpdir):
+    snapshots = SnapshotDirectory(str(tmpdir))
+    old = prefix_hashes('seed', ['a = 1', 'b = 2'])
+    other = prefix_hashes('other', ['a = 1'])
+    for digest in old + other:
+        tmpdir.join(digest + '.snapshot').write('')
+        tmpdir.join(digest + '.outputs.json').write('{}')
+    assert snapshots.prune('seed', old) == 0
+    assert snapshots.prune('other', other) == 0
+
+    new = prefix_hashes('seed', ['a = 1', 'b = 3'])
+    assert snapshots.prune('seed', new) == 2
+    assert not tmpdir.join(old[1] + '.snapshot').check()
+    assert not tmpdir.join(old[1] + '.outputs.json').check()
+    # The unchanged prefix and other notebooks are kept
+    assert tmpdir.join(old[0] + '.snapshot').check()
+    assert tmpdir.join(other[0] + '.snapshot').check()
+
+
+def test_resume_from_changed_cell(testdir):
+    sources = [
+        "_ = open('runs.txt', 'a').write('1')",
+        "x = 41",
+        "def f():\n    return x + 1",
+        "f()",
+        "_ = open('runs.txt', 'a').write('5')",
+    ]
+    nb = build_nb(sources, mark_run=True)
+    add_expected_plaintext_outputs(nb, [None, None, None, '42', None])
+    path = os.path.join(str(testdir.tmpdir), 'test_a.ipynb')
+    nbformat.write(nb, path)
+    args = ('--nbval', '--nbval-current-env', '--nbval-snapshots', 'snapshots')
+
+    result = testdir.runpytest_subprocess(*args)
+    result.assert_outcomes(passed=5)
+    assert testdir.tmpdir.join('runs.txt').read() == '15'
+
+    # Only the changed cell and the ones after it are executed
+    nb.cells[3].source = "f() + 0"
+    nbformat.write(nb, path)
+    result = testdir.runpytest_subprocess(*args)
+    result.assert_outcomes(passed=5)
+    assert testdir.tmpdir.join('runs.txt').read() == '155'
+    # The outputs of the cells before the change are removed
+    assert len(testdir.tmpdir.join('snapshots').listdir('*.outputs.json')) == 5
+
+    # Outputs of restored cells are still compared
+    nb.cells[3].outputs[0]['data']['text/plain'] = '43'
+    nbformat.write(nb, path)
+    result = testdir.runpytest_subprocess(*args)
+    result.assert_outcomes(passed=4, failed=1)
+    assert testdir.tmpdir.join('runs.txt').read() == '155'
+
+
+def test_unserializable_namespace(testdir):
+    # Generators can't be pickled, so there is nothing to resume from
+    nb = build_nb(["g = (i for i in range(3))\n_ = open('runs.txt', 'a').write('1')",
+                   "y = 1", "z = 2"])
+    nbformat.write(nb, os.path.join(str(testdir.tmpdir), 'test_a.ipynb'))
+    args = ('--nbval', '--nbval-current-env', '--nbval-snapshots', 'snapshots',
+            '--nbval-snapshot-serializer', 'pickle')
+    for expected in ('1', '11'):
+        result = testdir.runpytest_subprocess(*args)
+        result.assert_outcomes(passed=3)
+        assert testdir.tmpdir.join('runs.txt').read() == expected
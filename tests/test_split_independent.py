@@ -0,0 +1,126 @@
+import os
+
+import nbformat
+
+from nbval.dataflow import independent_chains
+from utils import build_nb, add_expected_plaintext_outputs
+
+pytest_plugins = "pytester"
+
+
+def test_independent_chains():
+    sources = [
+        "data = [1, 2, 3]",
+        "a = data[0]",
+        "a * 2",
+        "b = data[-1]",
+        "b + 1",
+    ]
+    assert independent_chains(sources) == (1, [[1, 2], [3, 4]])
+    # Cells with side effects join everything around them
+    assert independent_chains(sources, opaque=[3]) is None
+    assert independent_chains(sources + ["c = data[1]", "c"], opaque=[3]) == (
+        4, [[4], [5, 6]])
+    assert independent_chains(["x = 1", "x + 1"]) is None
+
+
+def test_independent_chains_call_arguments():
+    # Functions may modify the names passed to them
+    assert independent_chains([
+        "import random\ndata = [3, 1, 2]",
+        "random.shuffle(data)",
+        "a = data[0]",
+    ]) is None
+    assert independent_chains([
+        "data = [3, 1, 2]",
+        "def sort_in_place(xs):\n    xs.sort()",
+        "sort_in_place(key=data)",
+        "data[0]",
+        "x = 1",
+        "x",
+    ]) == (0, [[0, 1, 2, 3], [4, 5]])
+
+
+def test_independent_chains_function_effects():
+    # Functions binding globals, or modifying free names, when called
+    assert independent_chains([
+        "n = 0",
+        "def inc():\n    global n\n    n += 1",
+        "inc()",
+        "print(n)",
+    ]) is None
+    assert independent_chains([
+        "items = []",
+        "def add(x):\n    items.append(x)",
+        "add(1)",
+        "items",
+    ]) is None
+    # Module functions with hidden state
+    assert independent_chains([
+        "import random",
+        "random.seed(0)",
+        "a = random.random()",
+        "b = random.random()",
+    ]) is None
+    assert independent_chains([
+        "import sys",
+        "sys.path.append('lib')",
+        "import foo",
+        "x = 1",
+        "x",
+    ]) == (0, [[0, 1, 2], [3, 4]])
+
+
+def test_independent_chains_shared_state():
+    sources = [
+        "x = 1",
+        "def save():\n    _ = open('a.txt', 'w').write('a')",
+        "y = 2",
+        "save()",
+        "import shutil as sh\nsh.copy('a.txt', 'b.txt')",
+        "y",
+    ]
+    # Cells using files are kept in one chain, and out of the prefix
+    assert independent_chains(sources) == (0, [[0], [1, 3, 4], [2, 5]])
+    assert independent_chains(["_ = open('a.txt', 'w').write('a')", "x = 1", "y = 2"]) == (
+        0, [[0], [1], [2]])
+
+
+def test_split_independent(testdir):
+    nb = build_nb([
+        "data = [3, 1, 2]",
+        "def sort_in_place(xs):\n    xs.sort()",
+        "sort_in_place(data)",
+        "data",
+        "a = 1",
+        "'a' in globals()",
+    ], mark_run=True)
+    add_expected_plaintext_outputs(nb, [None, None, None, '[1, 2, 3]', None, 'False'])
+    nbformat.write(nb, os.path.join(str(testdir.tmpdir), 'test_a.ipynb'))
+
+    # The last cell runs in a kernel of its own, without a
+    result = testdir.runpytest_subprocess(
+        '--nbval', '--nbval-current-env', '--nbval-split-independent', '-v')
+    result.assert_outcomes(passed=6)
+    result.stdout.fnmatch_lines(['*Cell %d PASSED*' % i for i in range(1, 7)])
+
+    # Functions called by a cell bind the globals they declare
+    counter = build_nb([
+        "n = 0",
+        "def inc():\n    global n\n    n += 1",
+        "inc()",
+        "print(n)",
+    ], mark_run=True)
+    counter.cells[3].outputs.append(nbformat.v4.new_output('stream', text=u'1\n'))
+    nbformat.write(counter, os.path.join(str(testdir.tmpdir), 'test_b.ipynb'))
+    result = testdir.runpytest_subprocess(
+        '--nbval', '--nbval-current-env', '--nbval-split-independent', 'test_b.ipynb')
+    result.assert_outcomes(passed=4)
+
+    # Cells with hidden side effects are not split from the others
+    nb.cells[4].source = "# NBVAL_SIDE_EFFECTS\n" + nb.cells[4].source
+    nb.cells[5].outputs[0]['data']['text/plain'] = 'True'
+    nbformat.write(nb, os.path.join(str(testdir.tmpdir), 'test_a.ipynb'))
+    result = testdir.runpytest_subprocess(
+        '--nbval', '--nbval-current-env', '--nbval-split-independent', 'test_a.ipynb')
+    result.assert_outcomes(passed=6)
@@ -0,0 +1,99 @@
+import os
+import time
+
+import nbformat
+import pytest
+
+from nbval.store import LocalDirectoryStore, StoredRun, main, open_store, parse_size
+from utils import build_nb, add_expected_plaintext_outputs
+
+pytest_plugins = "pytester"
+
+
+def test_parse_size():
+    assert parse_size('100') == 100
+    assert parse_size('2K') == 2048
+    assert parse_size('1.5mb') == 1536 * 1024
+    assert parse_size('1G') == 1024 ** 3
+
+
+def test_open_store(tmpdir):
+    assert isinstance(open_store(str(tmpdir)), LocalDirectoryStore)
+    assert open_store('file://' + str(tmpdir)).path == str(tmpdir)
+    with pytest.raises(ValueError):
+        open_store('s3://bucket/nbval')
+
+
+def test_local_directory_store(tmpdir):
+    store = LocalDirectoryStore(str(tmpdir))
+    assert store.get('ab01') is None
+    store.put('ab01', {'cells': {'1': {'outputs': []}}})
+    assert store.contains('ab01')
+    assert store.get('ab01') == {'cells': {'1': {'outputs': []}}}
+
+    # Least recently used entries are evicted first
+    store.put('cd02', {'cells': {}})
+    past = time.time() - 3600
+    os.utime(store._path('cd02'), (past, past))
+    store.put('ef03', {'cells': {}})
+    size = sum(entry[1] for entry in store.entries())
+    store.max_size = size + 1
+    store.put('gh04', {'cells': {}})
+    assert not store.contains('cd02')
+    assert all(store.contains(key) for key in ('ab01', 'ef03', 'gh04'))
+
+    assert main(['prune', str(tmpdir), '--max-size', '0']) == 0
+    assert store.entries() == []
+
+
+def test_store_option(testdir):
+    nb = build_nb(["_ = open('runs.txt', 'a').write('x')", "1 + 1"], mark_run=True)
+    add_expected_plaintext_outputs(nb, [None, '3'])
+    path = os.path.join(str(testdir.tmpdir), 'test_a.ipynb')
+    nbformat.write(nb, path)
+    args = ('--nbval', '--nbval-current-env', '--nbval-store', 'store')
+
+    result = testdir.runpytest_subprocess(*args)
+    result.assert_outcomes(passed=1, failed=1)
+    # Stored outputs are compared again, without running the notebook
+    result = testdir.runpytest_subprocess(*args)
+    result.assert_outcomes(passed=1, failed=1)
+    result.stdout.fnmatch_lines(["*mismatch 'text/plain'*"])
+    assert testdir.tmpdir.join('runs.txt').read() == 'x'
+
+    # Expected outputs are not part of the key
+    nb.cells[1].outputs[0]['data']['text/plain'] = '2'
+    nbformat.write(nb, path)
+    result = testdir.runpytest_subprocess(*args)
+    result.assert_outcomes(passed=2)
+    assert testdir.tmpdir.join('runs.txt').read() == 'x'
+
+    nb.cells[1].source = '1 + 1  # changed'
+    nbformat.write(nb, path)
+    result = testdir.runpytest_subprocess(*args)
+    result.assert_outcomes(passed=2)
+    assert testdir.tmpdir.join('runs.txt').read() == 'xx'
+
+
+def test_store_cell_options(testdir):
+    nb = build_nb(["_ = open('runs.txt', 'a').write('x')", "1 + 1"], mark_run=True)
+    add_expected_plaintext_outputs(nb, [None, '2'])
+    nb.cells[1].metadata['tags'] = ['nbval-skip']
+    path = os.path.join(str(testdir.tmpdir), 'test_a.ipynb')
+    nbformat.write(nb, path)
+    args = ('--nbval', '--nbval-current-env', '--nbval-store', 'store')
+
+    result = testdir.runpytest_subprocess(*args)
+    result.assert_outcomes(passed=1, skipped=1)
+    # The cell that was skipped has to run
+    nb.cells[1].metadata['tags'] = []
+    nbformat.write(nb, path)
+    result = testdir.runpytest_subprocess(*args)
+    result.assert_outcomes(passed=2)
+    assert testdir.tmpdir.join('runs.txt').read() == 'xx'
+
+
+def test_stored_run_covers():
+    run = StoredRun({'cells': {'1': {}, '3': {}}})
+    assert run.covers([1, 3])
+    assert not run.covers([1, 2, 3])
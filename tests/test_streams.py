@@ -0,0 +1,64 @@
+import random
+import re
+
+from nbformat import NotebookNode
+
+from nbval.plugin import coalesce_streams
+from nbval.streams import StreamNormalizer
+
+
+# How carriage returns were applied before StreamNormalizer
+carriagereturn_pat = re.compile(r'^.*\r(?=[^\n])', re.MULTILINE)
+
+
+def stream(name, text):
+    return NotebookNode(output_type='stream', name=name, text=text)
+
+
+def test_normalizer_matches_regex():
+    rng = random.Random(0)
+    for _ in range(2000):
+        text = ''.join(rng.choice('ab\r\n\b') for _ in range(rng.randint(0, 20)))
+        normalizer = StreamNormalizer()
+        position = 0
+        while position < len(text):
+            end = position + rng.randint(1, 5)
+            normalizer.feed(text[position:end])
+            position = end
+        assert normalizer.getvalue() == carriagereturn_pat.sub('', text), repr(text)
+
+
+def test_coalesce_streams():
+    outputs = [
+        stream('stdout', '0%\r'),
+        stream('stderr', 'warning\n'),
+        NotebookNode(output_type='display_data', data={'text/plain': 'x'}, metadata={}),
+        stream('stdout', '50%\r'),
+        stream('stdout', '100%\r\ndone\b\n'),
+    ]
+    coalesced = coalesce_streams(outputs)
+    assert [out.output_type for out in coalesced] == ['stream', 'stream', 'display_data']
+    assert coalesced[0].text == '100%\r\ndone\b\n'
+    assert coalesced[1].text == 'warning\n'
+    # The outputs given are left as they are
+    assert outputs[0].text == '0%\r'
+    assert coalesce_streams(coalesced) == coalesced
+
+
+def test_normalizer_budget():
+    lines = ['line %d\n' % i for i in range(1000)]
+    text = ''.join(lines)
+    normalizer = StreamNormalizer(budget=100, sanitize=str.upper)
+    for line in lines:
+        normalizer.feed(line)
+    value = normalizer.getvalue()
+    assert value.size == len(text)
+    assert value.startswith(text[:50]) and value.endswith(text[-50:])
+    assert '[... %d characters truncated ...]' % (len(text) - 100) in value
+    assert len(normalizer._tail) <= 8
+    assert value.matches(text.upper())
+    assert not value.matches(text)
+
+    normalizer = StreamNormalizer(budget=len(text))
+    normalizer.feed(text)
+    assert type(normalizer.getvalue()) is str
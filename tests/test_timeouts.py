@@ -10,7 +10,8 @@ from utils import build_nb
 pytest_plugins = "pytester"
 
 
-def test_timeouts(testdir):
+@pytest.mark.parametrize('pipeline_depth', ['0', '10'])
+def test_timeouts(testdir, pipeline_depth):
     # This test uses the testdir fixture from pytester, which is useful for
     # testing pytest plugins. It writes a notebook to a temporary dir
     # and then runs pytest.
@@ -46,7 +47,8 @@ def test_timeouts(testdir):
         str(testdir.tmpdir), 'test_timeouts.ipynb'))
 
     # Run tests
-    result = testdir.inline_run('--nbval', '--nbval-current-env', '--nbval-cell-timeout', '5', '-s')
+    result = testdir.inline_run('--nbval', '--nbval-current-env', '--nbval-cell-timeout', '5', '-s',
+                                '--nbval-pipeline-depth', pipeline_depth)
     reports = result.getreports('pytest_runtest_logreport')
 
     # Setup and teardown of cells should have no issues:
@@ -0,0 +1,41 @@
+import os
+
+import nbformat
+import pytest
+
+from nbval.forkserver import ForkServer
+from nbval.kernel import RunningKernel, CURRENT_ENV_KERNEL_NAME
+from utils import build_nb
+
+pytest_plugins = "pytester"
+
+pytestmark = pytest.mark.skipif(os.name == 'nt', reason='ipc transport is not available on Windows')
+
+
+@pytest.mark.parametrize('fork', [False, True])
+def test_ipc_kernel(tmpdir, fork):
+    server = ForkServer() if fork else None
+    kernel = RunningKernel(CURRENT_ENV_KERNEL_NAME, fork_server=server,
+                           transport='ipc', runtime_dir=str(tmpdir))
+    try:
+        assert kernel.km.transport == 'ipc'
+        assert os.path.dirname(kernel.km.connection_file) == str(tmpdir)
+        assert len(tmpdir.listdir()) == 6  # connection file and five sockets
+        reply = kernel.run_silently('pass', user_expressions={'a': '1 + 1'})
+        assert reply['user_expressions']['a']['data']['text/plain'] == '2'
+    finally:
+        kernel.stop()
+        if server is not None:
+            server.stop()
+    assert tmpdir.listdir() == []
+
+
+def test_ipc_run(testdir):
+    nb = build_nb(["a = 1", "print(a + 1)"], mark_run=True)
+    nb.cells[1].outputs.append(nbformat.v4.new_output('stream', text=u'2\n'))
+    nbformat.write(nb, os.path.join(str(testdir.tmpdir), 'test_ipc.ipynb'))
+
+    result = testdir.runpytest_subprocess(
+        '--nbval', '--nbval-current-env', '--nbval-transport', 'ipc')
+
+    result.assert_outcomes(passed=2)
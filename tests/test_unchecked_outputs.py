@@ -0,0 +1,29 @@
+import os
+
+import nbformat
+
+from utils import build_nb
+
+pytest_plugins = "pytester"
+
+
+def test_unchecked_outputs(testdir):
+    nb = build_nb([
+        "for i in range(1000):\n"
+        "    print(i)",
+        "# NBVAL_IGNORE_OUTPUT\n"
+        "'ignored'",
+        "# NBVAL_IGNORE_OUTPUT\n"
+        "raise ValueError('still reported')",
+        "# NBVAL_IGNORE_OUTPUT\n"
+        "# NBVAL_RAISES_EXCEPTION\n"
+        "raise ValueError('expected')",
+    ], mark_run=True)
+    nbformat.write(nb, os.path.join(str(testdir.tmpdir), 'test_a.ipynb'))
+
+    result = testdir.runpytest_subprocess('--nbval', '--nbval-current-env')
+    result.assert_outcomes(failed=2, passed=2)
+    for args in [('--nbval-lax',), ('--nbval-lax', '--nbval-concurrency', '2')]:
+        result = testdir.runpytest_subprocess('--nbval-current-env', *args)
+        result.assert_outcomes(failed=1, passed=3)
+        result.stdout.fnmatch_lines(['*ValueError*still reported*'])